@@ -0,0 +1,129 @@
+import hashlib
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+REPLAY_CHUNK_CHARS = 64  # size of the pieces a cached answer is streamed in
+
+
+def answer_signature(model, document_ids, context_messages):
+    """Hash of what an answer depends on besides the question.
+
+    ``context_messages`` are the prompt messages before the question (system
+    prompt with the passage texts, and the chat history), so an answer stops
+    matching as soon as a source passage, the history or the model changes.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((model, sorted(document_ids))).encode("utf-8"))
+    for message in context_messages:
+        digest.update(f"\0{message['role']}\0{message['content']}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def replay(answer, chunk_chars=REPLAY_CHUNK_CHARS):
+    """Yield a cached answer in pieces, like the model stream it was recorded from."""
+    for start in range(0, len(answer), chunk_chars):
+        yield answer[start:start + chunk_chars]
+
+
+class _Answer:
+    __slots__ = ("signature", "vector", "text", "created_at", "size")
+
+    def __init__(self, signature, vector, text, created_at):
+        self.signature = signature
+        self.vector = vector
+        self.text = text
+        self.created_at = created_at
+        self.size = len(text.encode("utf-8"))
+
+
+class AnswerCache:
+    """Semantic cache of complete answers.
+
+    An answer is reused for a new question when the prompt around it has the
+    same signature (see answer_signature) and the cosine similarity of the
+    question embeddings is at least ``similarity``. Entries are evicted
+    least recently used first once ``max_entries`` or ``max_bytes`` of
+    answer text is exceeded, and expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=32 * 1024 * 1024, ttl=6 * 3600, similarity=0.97):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.similarity = similarity
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._entries = OrderedDict()  # entry id -> _Answer
+        self._by_signature = {}  # signature -> set of entry ids
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalise(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        self.bytes -= entry.size
+        bucket = self._by_signature[entry.signature]
+        bucket.discard(entry_id)
+        if not bucket:
+            del self._by_signature[entry.signature]
+
+    def get(self, query_embedding, signature):
+        """Return the cached answer text for a similar question with the same signature, or None."""
+        vector = self._normalise(query_embedding)
+        now = time.time()
+        with self._lock:
+            best_id, best_similarity = None, self.similarity
+            for entry_id in list(self._by_signature.get(signature, ())):
+                entry = self._entries[entry_id]
+                if now - entry.created_at > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                similarity = float(np.dot(entry.vector, vector))
+                if similarity >= best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+            if best_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            self.hits += 1
+            return self._entries[best_id].text
+
+    def put(self, query_embedding, signature, answer):
+        """Store a complete answer; answers larger than max_bytes are not cached."""
+        entry = _Answer(signature, self._normalise(query_embedding), answer, time.time())
+        if not answer or entry.size > self.max_bytes:
+            return
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = entry
+            self._by_signature.setdefault(signature, set()).add(entry_id)
+            self.bytes += entry.size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_signature.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
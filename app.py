@@ -1,11 +1,36 @@
 import os
+import threading
+import time
+
+_import_started_at = time.perf_counter()
+
+import numpy as np
 from flask import Flask, request, jsonify, send_from_directory, Response
-from google.cloud import bigquery
-from vertexai.preview.language_models import ChatModel  # Correct import
-from vertexai.language_models import TextEmbeddingModel
-from mistralai_gcp import MistralGoogleCloud # Correct import
-from google.cloud import aiplatform
-import pandas as pd
+from exactSearch import ExactSearch
+from quantization import QuantizedSearch, add_quantized_sections
+from indexSegments import DocumentRows, SegmentedIndex, stored_source_hashes
+from sharedSnapshots import SharedSnapshots
+from embeddingCache import EmbeddingCache, SqliteEmbeddingStore, normalize_query
+from corpusGeneration import CorpusGeneration
+from resultCache import ResultCache, embedding_key
+from embeddingBatcher import EmbeddingBatcher
+from promptBudget import assemble_prompt
+from answerCache import AnswerCache, answer_signature, replay
+import metrics
+from metrics import QueryTrace, StartupReport
+from lexicalIndex import LexicalIndex, reciprocal_rank_fusion
+from metadataFilter import MetadataColumns, fetch_metadata, parse_filters
+from embeddingSnapshot import decode_source_hash, parse_embedding
+from passages import to_matches
+
+# The Google Cloud, Vertex AI and Mistral SDKs take seconds to import, so they
+# are imported by init_services() (see import_sdks) instead of at module load.
+aiplatform = None
+bigquery = None
+storage = None
+TextEmbeddingModel = None
+MistralGoogleCloud = None
+
 app = Flask(__name__)
 
 # Google Cloud Config
@@ -13,60 +38,551 @@ PROJECT_ID = "corded-forge-417909"
 REGION = "europe-west4"
 BQ_DATASET_ID = "ProjectRAGMart"
 EMBEDDING_TABLE_ID = f"{PROJECT_ID}.{BQ_DATASET_ID}.document_embeddings"
+DOCUMENTS_TABLE_ID = f"{PROJECT_ID}.{BQ_DATASET_ID}.documents"  # OData metadata used by query filters
 TOP_N = int(os.environ.get("TOP_N", 3))
+# Passages (chunks) retrieved per question, then packed into the prompt up to the token budget
+CANDIDATE_PASSAGES = int(os.environ.get("CANDIDATE_PASSAGES", 12))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 3000))
+# Chat history sent by the client: the last turns verbatim, older ones compacted, all within the budget
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", 1500))
+HISTORY_RECENT_TURNS = int(os.environ.get("HISTORY_RECENT_TURNS", 4))
+QUESTION_TOKEN_BUDGET = int(os.environ.get("QUESTION_TOKEN_BUDGET", 500))
+# BM25 index over the passage texts, fused with the vector results (reciprocal rank fusion)
+LEXICAL_INDEX = os.environ.get("LEXICAL_INDEX", "1") == "1"
 MODEL_NAME = "mistral-nemo"
 MODEL_VERSION = "2407"
+# Optional local vector index snapshot (see vectorIndex.py); BigQuery is used when unset
+VECTOR_INDEX_PATH = os.environ.get("VECTOR_INDEX_PATH")
+VECTOR_INDEX_METRIC = os.environ.get("VECTOR_INDEX_METRIC")  # l2, cosine or dot
+VECTOR_INDEX_NPROBE = int(os.environ.get("VECTOR_INDEX_NPROBE", 8))
+VECTOR_INDEX_VERIFY = os.environ.get("VECTOR_INDEX_VERIFY", "1") == "1"  # CRC check at startup
+VECTOR_INDEX_EXACT = os.environ.get("VECTOR_INDEX_EXACT", "0") == "1"  # brute force instead of IVF
+VECTOR_INDEX_QUANTIZATION = os.environ.get("VECTOR_INDEX_QUANTIZATION")  # int8 or pq codes, re-ranked in full precision
+VECTOR_INDEX_RERANK = int(os.environ.get("VECTOR_INDEX_RERANK", 100))
+# Apply documents added, changed or deleted after the snapshot to the local index (see indexSegments.py)
+VECTOR_INDEX_UPDATES = os.environ.get("VECTOR_INDEX_UPDATES", "1") == "1"
+VECTOR_INDEX_COMPACT_ROWS = int(os.environ.get("VECTOR_INDEX_COMPACT_ROWS", 20000))  # appended rows before compaction
+# Snapshots derived at startup or by compaction, mapped by all workers of the instance; default next to the snapshot
+VECTOR_INDEX_SHARED_DIR = os.environ.get("VECTOR_INDEX_SHARED_DIR")
+EMBEDDING_MODEL_NAME = "text-multilingual-embedding-002"
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 1024))
+EMBEDDING_CACHE_TTL = int(os.environ.get("EMBEDDING_CACHE_TTL", 24 * 3600))  # seconds
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH")  # optional SQLite file shared by workers
+# Coalesce concurrent embedding calls (only useful with several gunicorn threads); 0 disables batching
+EMBEDDING_BATCH_WINDOW_MS = float(os.environ.get("EMBEDDING_BATCH_WINDOW_MS", 0))
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 32))
+GCS_BUCKET = "projectragmart"
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 2048))
+CORPUS_GENERATION_POLL = int(os.environ.get("CORPUS_GENERATION_POLL", 30))  # seconds
+# Complete answers reused for near-identical questions over the same passages; 0 disables
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 1024))
+ANSWER_CACHE_MAX_BYTES = int(os.environ.get("ANSWER_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", 6 * 3600))  # seconds
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", 0.97))  # cosine of the question embeddings
+# One JSON line per /query with its trace id and stage timings (stage metrics are always kept, see /metrics)
+TRACE_LOGS = os.environ.get("TRACE_LOGS", "0") == "1"
+TOKEN_RATE_BUCKETS = (5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)  # streamed tokens per second
+# Run init_services() in a background thread at import, so the SDK imports, clients and index load overlap
+# with the server start instead of delaying the first request (do not combine with gunicorn --preload)
+PREWARM_SERVICES = os.environ.get("PREWARM_SERVICES", "0") == "1"
+
+MISTRAL_MODEL = f"{MODEL_NAME}-{MODEL_VERSION}"
+SYSTEM_INSTRUCTIONS = (
+    "Jij bent een behulpzame assistent op het gebied van Nederlandse politiek (met een tikje humor en je bent ook een beetje grof). "
+    "Je hebt toegang tot de volgende informatie:"
+)
+CHUNK_ERROR = "Fout in het ontvangen antwoord. Probeer het opnieuw."
+NO_MATCHES_CONTEXT = (
+    "Jij weet zoveel dingen van de wereld, ook deze vraag kan jij beantwoorden "
+    "ondanks dat je er niet helemaal zeker van bent, geef antwoord op deze vraag:"
+)
+
+# Clients and models are created by init_services() from a startup hook (the
+# first Flask request, or Quart's before_serving in asgi.py), not at import.
+bq_client = None
+storage_client = None
+embedding_model = None
+mistral_client = None
+embedding_batcher = None
+corpus_generation = None
+shared_snapshots = None
+vector_index = None
+exact_search = None
+metadata_columns = None  # soort/datum/fractie columns of the snapshot rows, for filtered search
+segmented_index = None  # the snapshot plus the documents changed since; queries search segmented_index.view
+lexical_index = None
+lexical_base = None  # base index whose rows the lexical rows line up with (for filtered hybrid search)
+lexical_ready = threading.Event()  # set once the initial lexical index build has finished
+_services_lock = threading.Lock()
+_services_ready = False
+startup = StartupReport()  # where the cold start goes: printed after init_services, gauges in /metrics
+
+embedding_cache = EmbeddingCache(
+    max_entries=EMBEDDING_CACHE_SIZE,
+    ttl=EMBEDDING_CACHE_TTL,
+    store=SqliteEmbeddingStore(EMBEDDING_CACHE_PATH) if EMBEDDING_CACHE_PATH else None,
+    namespace=EMBEDDING_MODEL_NAME,
+)
+result_cache = ResultCache(max_entries=RESULT_CACHE_SIZE)
+answer_cache = AnswerCache(
+    max_entries=ANSWER_CACHE_SIZE,
+    max_bytes=ANSWER_CACHE_MAX_BYTES,
+    ttl=ANSWER_CACHE_TTL,
+    similarity=ANSWER_CACHE_SIMILARITY,
+) if ANSWER_CACHE_SIZE > 0 else None
+
+def import_sdks():
+    """Import the Google Cloud, Vertex AI and Mistral SDKs into the module globals."""
+    global aiplatform, bigquery, storage, TextEmbeddingModel, MistralGoogleCloud
+    from google.cloud import aiplatform, bigquery, storage
+    from vertexai.language_models import TextEmbeddingModel
+    from mistralai_gcp import MistralGoogleCloud
+
+def init_services():
+    """Initialize clients, models and the local index (ONCE per process)."""
+    global bq_client, storage_client, embedding_model, mistral_client, embedding_batcher
+    global corpus_generation, vector_index, exact_search, segmented_index, lexical_index, metadata_columns
+    global _services_ready
+    with _services_lock:
+        if _services_ready:
+            return
+        with startup.step("import_sdks"):
+            import_sdks()
+        with startup.step("clients"):
+            aiplatform.init(project=PROJECT_ID, location=REGION)
+            bq_client = bigquery.Client()
+            storage_client = storage.Client()
+        with startup.step("embedding_model"):
+            embedding_model = TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL_NAME)
+        with startup.step("mistral_client"):
+            mistral_client = MistralGoogleCloud(region=REGION, project_id=PROJECT_ID)
+        if EMBEDDING_BATCH_WINDOW_MS > 0:
+            embedding_batcher = EmbeddingBatcher(
+                embedding_model, max_batch_size=EMBEDDING_BATCH_SIZE, max_wait=EMBEDDING_BATCH_WINDOW_MS / 1000
+            )
+        with startup.step("corpus_generation"):
+            corpus_generation = CorpusGeneration(storage_client, GCS_BUCKET, poll_interval=CORPUS_GENERATION_POLL)
+        with startup.step("vector_index"):
+            vector_index = load_vector_index()
+            exact_search = ExactSearch.from_index(vector_index) if vector_index is not None else None
+            metadata_columns = MetadataColumns.from_snapshot(vector_index.snapshot) if vector_index is not None else None
+            if vector_index is not None:
+                segmented_index = SegmentedIndex(
+                    vector_index, make_base_search, shared_snapshots, metadata=metadata_columns, prepare=prepare_compacted_snapshot, on_swap=on_index_swap,
+                    compact_rows=VECTOR_INDEX_COMPACT_ROWS,
+                )
+        if segmented_index is not None and VECTOR_INDEX_UPDATES:
+            # Catch up with the documents ingested since the export, then follow every new generation.
+            threading.Thread(target=refresh_vector_index, name="vector-index-refresh", daemon=True).start()
+            corpus_generation.subscribe(
+                lambda generation: threading.Thread(target=refresh_vector_index, daemon=True).start()
+            )
+        if LEXICAL_INDEX:
+            lexical_index = LexicalIndex(base=vector_index)
+            # Built in the background; queries are vector-only until it is ready.
+            threading.Thread(target=build_lexical_index, name="lexical-index", daemon=True).start()
+            corpus_generation.subscribe(on_lexical_generation)
+        if (segmented_index is not None and VECTOR_INDEX_UPDATES) or LEXICAL_INDEX:
+            corpus_generation.watch()  # new generations are picked up even while no queries arrive
+        _services_ready = True
+        print(f"Startup: {startup.report()}")
+
+def load_vector_index():
+    """Load the local vector index snapshot, or return None to use BigQuery."""
+    global shared_snapshots
+    if not VECTOR_INDEX_PATH or not os.path.exists(VECTOR_INDEX_PATH):
+        return None
+    shared_snapshots = SharedSnapshots(VECTOR_INDEX_SHARED_DIR or os.path.dirname(os.path.abspath(VECTOR_INDEX_PATH)))
+    index = shared_snapshots.load(VECTOR_INDEX_PATH, metric=VECTOR_INDEX_METRIC, nprobe=VECTOR_INDEX_NPROBE,
+                                  verify=VECTOR_INDEX_VERIFY, quantization=VECTOR_INDEX_QUANTIZATION)
+    print(f"Loaded vector index with {len(index)} embeddings ({index.metric}) from {VECTOR_INDEX_PATH}")
+    return index
+
+def make_base_search(index):
+    """Search function ``(query, top_n, mask) -> rows`` over a snapshot index: exact, quantised or IVF."""
+    if VECTOR_INDEX_EXACT:
+        exact = exact_search if index is vector_index else ExactSearch.from_index(index)
+        return lambda query, top_n, mask: exact.top_matches([query], top_n, mask)[0]
+    if VECTOR_INDEX_QUANTIZATION:
+        quantized = QuantizedSearch.from_index(index, VECTOR_INDEX_QUANTIZATION, VECTOR_INDEX_RERANK)
+        return lambda query, top_n, mask: quantized.top_matches(query, top_n, mask=mask)
+    return lambda query, top_n, mask: index.top_matches(query, top_n, mask=mask)
+
+def prepare_compacted_snapshot(writer):
+    """Store quantised codes in compacted snapshots too, so they load without retraining."""
+    if VECTOR_INDEX_QUANTIZATION:
+        add_quantized_sections(writer, VECTOR_INDEX_QUANTIZATION, vector_index.metric)
 
-# Initialize Clients and Models (ONCE at app startup)
-aiplatform.init(project=PROJECT_ID, location=REGION)
-bq_client = bigquery.Client()
-embedding_model = TextEmbeddingModel.from_pretrained("text-multilingual-embedding-002")
-mistral_client = MistralGoogleCloud(region=REGION, project_id=PROJECT_ID)
+_vector_refresh_lock = threading.Lock()
+
+def refresh_vector_index():
+    """Apply the documents added, changed (by source_hash) or deleted in document_embeddings to the local index."""
+    try:
+        with _vector_refresh_lock:
+            generation = corpus_generation.current()
+            indexed = segmented_index.source_hashes()
+            current = {
+                row["document_id"]: row["source_hash"] for row in bq_client.query(
+                    f"SELECT document_id, ANY_VALUE(source_hash) AS source_hash FROM `{EMBEDDING_TABLE_ID}` GROUP BY document_id"
+                ).result()
+            }
+            # Documents of a snapshot exported without source hashes count as unchanged.
+            changed = [
+                document_id for document_id, source_hash in current.items()
+                if document_id not in indexed or indexed[document_id] not in (None, source_hash)
+            ]
+            deleted = [document_id for document_id in indexed if document_id not in current]
+            if not changed and not deleted:
+                return 0
+            upserts = fetch_document_rows(changed)
+            segmented_index.apply(upserts, deleted, generation)
+            print(f"Vector index: {len(upserts)} documents added or replaced, {len(deleted)} deleted "
+                  f"({segmented_index.stats()})")
+            return len(upserts) + len(deleted)
+    except Exception as e:
+        print(f"Error refreshing vector index: {e}")
+
+def fetch_document_rows(document_ids, batch_size=1000):
+    """Passages, embeddings, source_hash and metadata of documents in document_embeddings, as DocumentRows."""
+    documents = []
+    for start in range(0, len(document_ids), batch_size):
+        batch = document_ids[start:start + batch_size]
+        records = (fetch_metadata(bq_client, DOCUMENTS_TABLE_ID, batch)
+                   if segmented_index.view.metadata is not None else {})
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("ids", "STRING", batch)]
+        )
+        rows = bq_client.query(f"""
+        SELECT document_id, text, embedding, source_hash
+        FROM `{EMBEDDING_TABLE_ID}`
+        WHERE document_id IN UNNEST(@ids)
+        ORDER BY document_id, chunk_index
+        """, job_config=job_config).result()
+        passages = {}
+        for row in rows:
+            passages.setdefault(row["document_id"], (row["source_hash"], [], []))
+            passages[row["document_id"]][1].append(row["text"])
+            passages[row["document_id"]][2].append(parse_embedding(row["embedding"]))
+        for document_id, (source_hash, texts, embeddings) in passages.items():
+            documents.append(DocumentRows(document_id, source_hash, texts, np.asarray(embeddings, dtype=np.float32),
+                                          records.get(document_id)))
+    return documents
+
+def on_index_swap(view):
+    """After a compaction, rebuild the lexical index on the new base so filtered hybrid search works again."""
+    if LEXICAL_INDEX:
+        threading.Thread(target=rebuild_lexical_index, args=(view,), name="lexical-index", daemon=True).start()
+
+def add_snapshot_passages(index):
+    """Index the rows of the snapshot behind a lexical index's base; their texts stay in the shared snapshot."""
+    stored = stored_source_hashes(index.base)
+    index.add_base((decode_source_hash(row) for row in stored) if stored is not None else None)
+
+def rebuild_lexical_index(view):
+    """Index the passages of a compacted view in a new lexical index and swap it in."""
+    global lexical_index, lexical_base
+    try:
+        with _refresh_lock:
+            index = LexicalIndex(base=view.base)
+            add_snapshot_passages(index)
+            for document in view.segment.documents.values():
+                for text in document.texts:
+                    index.add(document.document_id, text, document.source_hash)
+            lexical_base = None  # no filtered hybrid search while the two are switched
+            lexical_index = index
+            lexical_base = view.base
+        refresh_lexical_index()  # documents changed while the new index was built
+        print(f"Lexical index rebuilt with {len(index)} passages")
+    except Exception as e:
+        print(f"Error rebuilding lexical index: {e}")
+
+def build_lexical_index():
+    """Index the passages of the local snapshot, or of document_embeddings when there is none."""
+    global lexical_base
+    try:
+        if vector_index is not None:
+            with startup.step("lexical_index"), _refresh_lock:
+                add_snapshot_passages(lexical_index)
+                lexical_base = vector_index
+        else:
+            with startup.step("lexical_index"):
+                refresh_lexical_index()
+        lexical_ready.set()
+        print(f"Lexical index ready with {len(lexical_index)} passages")
+        # Generations seen during the build were not applied (see on_lexical_generation); catch up now.
+        refresh_lexical_index()
+    except Exception as e:
+        print(f"Error building lexical index: {e}")
+
+def on_lexical_generation(generation):
+    """Apply a new corpus generation to the lexical index once its initial build has finished."""
+    if not lexical_ready.is_set():
+        return  # build_lexical_index catches up when it is done
+    threading.Thread(target=refresh_lexical_index, daemon=True).start()
+
+_refresh_lock = threading.Lock()
+
+def refresh_lexical_index():
+    """Add new documents, re-index changed ones (by source_hash) and remove deleted ones from document_embeddings."""
+    with _refresh_lock:
+        indexed = lexical_index.indexed_documents()
+        job_config = None
+        if indexed:
+            current = {
+                row["document_id"]: row["source_hash"] for row in bq_client.query(
+                    f"SELECT document_id, ANY_VALUE(source_hash) AS source_hash FROM `{EMBEDDING_TABLE_ID}` GROUP BY document_id"
+                ).result()
+            }
+            # Removing bumps the lexical index version, which drops cached results that fused the deleted passages.
+            deleted = [document_id for document_id in indexed if document_id not in current]
+            for document_id in deleted:
+                lexical_index.remove(document_id)
+            if deleted:
+                print(f"Lexical index: removed {len(deleted)} deleted documents")
+            stale = [
+                document_id for document_id, source_hash in current.items()
+                if document_id not in indexed or lexical_index.source_hashes.get(document_id, source_hash) != source_hash
+            ]
+            if not stale:
+                return len(deleted)
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[bigquery.ArrayQueryParameter("ids", "STRING", stale)]
+            )
+        query = f"""
+        SELECT document_id, text, source_hash
+        FROM `{EMBEDDING_TABLE_ID}`
+        {"WHERE document_id IN UNNEST(@ids)" if job_config else ""}
+        ORDER BY document_id, chunk_index
+        """
+        rows = bq_client.query(query, job_config=job_config).result()
+        added = 0
+        previous = None
+        for row in rows:
+            if row["document_id"] != previous:
+                lexical_index.remove(row["document_id"])  # drops the passages of the old text
+                previous = row["document_id"]
+            lexical_index.add(row["document_id"], row["text"], row["source_hash"])
+            added += 1
+        print(f"Lexical index: added {added} passages")
+        return added
+
+@app.before_request
+def ensure_services():
+    init_services()
 
 def generate_pdf_links(top_matches):
     """Generate download links for the top matches."""
     base_url = "https://gegevensmagazijn.tweedekamer.nl/OData/v4/2.0/Document"
     sources = []
-    for _, row in top_matches.iterrows():
-        document_id = row["document_id"]
+    seen = set()
+    for match in top_matches:
+        document_id = match.document_id
+        if document_id in seen:
+            continue  # several passages of the same document share one link
+        seen.add(document_id)
         download_link = f"{base_url}({document_id})/resource"
         sources.append({
             "document_id": document_id,
             "download_link": download_link,
-            "distance": row["distance"]  # Include distance for reference
+            "distance": match.distance  # Include distance for reference
         })
     return sources
 
 def get_query_embedding(query_text):
-    """Generate an embedding for the input query."""
-    response = embedding_model.get_embeddings([query_text])
+    """Generate an embedding for the input query, reusing cached embeddings."""
+    return embedding_cache.get_or_compute(query_text, embed_text)
+
+def embed_text(text):
+    """Call the embedding model for a single text."""
+    if embedding_batcher is not None:
+        return embedding_batcher.embed(text)
+    response = embedding_model.get_embeddings([text])
     return response[0].values
-def get_top_matches(query_embedding, top_n=TOP_N):
-    """Retrieve the top N documents that match the query embedding."""
-    query_embedding_str = ', '.join(map(str, query_embedding))  # Convert embedding to string for SQL
+def get_top_matches(query_embedding, top_n=CANDIDATE_PASSAGES, query_text=None, filters=None):
+    """Retrieve the top N passages that match the query, memoised per corpus generation.
+
+    With ``query_text`` and a ready lexical index the vector results are
+    fused with the BM25 results. ``filters`` (see metadataFilter.py) restrict
+    the search to matching documents before ranking.
+    """
+    view = segmented_index.view if segmented_index is not None else None  # read once: one consistent state
+    local = view is not None and (not filters or view.metadata is not None)
+    # The BM25 rows only line up with the filter mask when the index was built from the same base.
+    hybrid = query_text is not None and lexical_ready.is_set() and (
+        not filters or (local and lexical_base is view.base))
+    key = embedding_key(query_embedding, top_n, normalize_query(query_text) if hybrid else None,
+                        repr(sorted(filters.items())) if filters else None)
+    # Updates applied to the local or lexical index invalidate cached results like a new generation does,
+    # so results fused before the lexical index caught up with a generation are not served for all of it.
+    generation = (corpus_generation.current(), view.version if view is not None else None,
+                  lexical_index.version if lexical_ready.is_set() else None)
+    top_matches = result_cache.get(key, generation)
+    if top_matches is None:
+        if local:
+            top_matches = to_matches(view.top_matches(query_embedding, top_n, filters))
+        else:
+            top_matches = get_top_matches_bigquery(query_embedding, top_n, filters)
+        if hybrid:
+            mask = lexical_row_mask(view, filters) if filters else None
+            top_matches = fuse_lexical_matches(top_matches, query_text, top_n, mask)
+        if top_matches:
+            result_cache.put(key, generation, top_matches)
+    return top_matches
+
+def lexical_row_mask(view, filters):
+    """Filter mask over the lexical rows, which start with the rows of ``view.base`` in the same order.
+
+    Rows added after the base belong to new and changed documents; they are
+    selected by the metadata of those documents in the append segment. A
+    document the segment does not hold yet is left out until it does.
+    """
+    mask = view.metadata.mask(filters)
+    added = lexical_index.document_ids[:]  # the rows after the base rows (copied: refreshes append to it)
+    if not added:
+        return mask
+    segment = view.segment
+    matching = {segment.document_ids[row] for row in np.flatnonzero(segment.metadata.mask(filters))} if len(segment) else set()
+    return np.concatenate([mask, np.fromiter((document_id in matching for document_id in added), dtype=bool, count=len(added))])
+
+def fuse_lexical_matches(vector_matches, query_text, top_n=CANDIDATE_PASSAGES, mask=None):
+    """Reciprocal rank fusion of the vector matches and the BM25 matches for the query text."""
+    lexical_matches = lexical_index.top_matches(query_text, top_n, mask)
+    fused = reciprocal_rank_fusion([vector_matches, lexical_matches], top_n)
+    # Passages found only by BM25 have no vector distance.
+    return to_matches(fused)
+
+def get_top_matches_batch(query_embeddings, top_n=TOP_N):
+    """Retrieve the exact top N documents for several query embeddings at once."""
+    if exact_search is None:
+        return [get_top_matches_bigquery(embedding, top_n) for embedding in query_embeddings]
+    return [to_matches(matches) for matches in exact_search.top_matches(query_embeddings, top_n)]
+
+def get_top_matches_bigquery(query_embedding, top_n=TOP_N, filters=None):
+    """Retrieve the top N documents with a full distance scan in BigQuery."""
+    parameters = [bigquery.ArrayQueryParameter("query_embedding", "FLOAT64", list(map(float, query_embedding)))]
+    join, conditions = "", []
+    if filters:
+        # Filter on the latest version of each document's metadata before computing distances.
+        join = f"""JOIN (
+        SELECT Id, Soort, DATE(Datum) AS Datum, Fracties FROM `{DOCUMENTS_TABLE_ID}`
+        WHERE true
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY Id ORDER BY GewijzigdOp DESC) = 1
+    ) AS m ON m.Id = d.document_id"""
+        if "soort" in filters:
+            conditions.append("LOWER(m.Soort) IN UNNEST(@soort)")
+            parameters.append(bigquery.ArrayQueryParameter("soort", "STRING", [v.lower() for v in filters["soort"]]))
+        if "fractie" in filters:
+            conditions.append("EXISTS (SELECT 1 FROM UNNEST(m.Fracties) AS f WHERE LOWER(f) IN UNNEST(@fractie))")
+            parameters.append(bigquery.ArrayQueryParameter("fractie", "STRING", [v.lower() for v in filters["fractie"]]))
+        if "datum_van" in filters:
+            conditions.append("m.Datum >= DATE_FROM_UNIX_DATE(@datum_van)")
+            parameters.append(bigquery.ScalarQueryParameter("datum_van", "INT64", filters["datum_van"]))
+        if "datum_tot" in filters:
+            conditions.append("m.Datum <= DATE_FROM_UNIX_DATE(@datum_tot)")
+            parameters.append(bigquery.ScalarQueryParameter("datum_tot", "INT64", filters["datum_tot"]))
+    # The query vector is a parameter and ML.DISTANCE works on the native array,
+    # so there is no SQL literal to parse and no UNNEST/GROUP BY per row.
     query = f"""
-    WITH query_embedding AS (
-        SELECT ARRAY[{query_embedding_str}] AS query_embedding  -- Rename query embedding
-    )
     SELECT 
         d.document_id, 
+        d.chunk_id, 
         d.text, 
-        SQRT(SUM(POW(d.embedding[OFFSET(i)] - qe.query_embedding[OFFSET(i)], 2))) AS distance
-    FROM `{EMBEDDING_TABLE_ID}` AS d, 
-         query_embedding AS qe,
-         UNNEST(d.embedding) WITH OFFSET i  -- Explicitly use 'd.embedding'
-    GROUP BY d.document_id, d.text
+        ML.DISTANCE(d.embedding, @query_embedding, 'EUCLIDEAN') AS distance
+    FROM `{EMBEDDING_TABLE_ID}` AS d
+    {join}
+    {"WHERE " + " AND ".join(conditions) if conditions else ""}
     ORDER BY distance ASC
     LIMIT {top_n}
     """
+    job_config = bigquery.QueryJobConfig(query_parameters=parameters)
     try:
-        # Execute the query and convert the results to a DataFrame
-        results = bq_client.query(query).to_dataframe()
-        return results
+        # Read the rows directly; a DataFrame would only add conversion time per query
+        return to_matches(bq_client.query(query, job_config=job_config).result())
     except Exception as e:
         print(f"Error querying BigQuery: {e}")
-        return pd.DataFrame(columns=["document_id", "text"])
+        return []
+
+
 
+def build_messages(query_text, chat_history, top_matches):
+    """Build the Mistral message list, the source links and a prompt size report for a question."""
+    messages, used_matches, report = assemble_prompt(
+        SYSTEM_INSTRUCTIONS, query_text, chat_history, top_matches,
+        context_budget=CONTEXT_TOKEN_BUDGET,
+        history_budget=HISTORY_TOKEN_BUDGET,
+        recent_turns=HISTORY_RECENT_TURNS,
+        question_budget=QUESTION_TOKEN_BUDGET,
+        # No matches found, fallback to generic context
+        no_matches_context=NO_MATCHES_CONTEXT,
+    )
+    sources = generate_pdf_links(used_matches)
+    return messages, sources, report
+
+def format_sources(sources):
+    """The 'Bronnen' preamble streamed before the answer."""
+    pdf_links = "\n".join([f"<a href='{source['download_link']}' target='_blank'>{source['download_link']}</a>" for source in sources])
+    return f"Bronnen:\n{pdf_links}\n\n"
+
+def chunk_text(chunk):
+    """Text delta of a streamed Mistral chunk."""
+    try:
+        return chunk.data.choices[0].delta.content or ""
+    except (IndexError, AttributeError, KeyError) as e:
+        print(f"Error parsing chunk: {e}")
+        return CHUNK_ERROR
+
+def start_trace(headers):
+    """Trace of one /query request, reusing the caller's X-Request-Id or the Cloud Run trace id when present."""
+    trace_id = headers.get("X-Request-Id") or headers.get("X-Cloud-Trace-Context", "").split("/")[0] or None
+    metrics.counter("query_requests_total", "Questions received by /query").inc()
+    return QueryTrace("query_stage_seconds", trace_id, log=TRACE_LOGS)
+
+def finish_answer(trace, streamed_at, first_token_at, parts, **fields):
+    """Record time to first token, stream duration and tokens/sec of a Mistral answer, then finish the trace.
+
+    Mistral streams about one token per chunk, so chunks are counted as tokens.
+    """
+    now = time.perf_counter()
+    if first_token_at is not None:
+        trace.record("llm_first_token", first_token_at - streamed_at)
+        if len(parts) > 1 and now > first_token_at:
+            metrics.histogram("llm_tokens_per_second", "Streamed answer tokens per second after the first token",
+                              TOKEN_RATE_BUCKETS).observe((len(parts) - 1) / (now - first_token_at))
+    trace.record("llm_stream", now - streamed_at)
+    trace.finish(answer_tokens=len(parts), **fields)
+
+def cache_metrics():
+    """Hit/miss gauges of the in-process caches for /metrics."""
+    for name, cache in (("embedding", embedding_cache), ("result", result_cache), ("answer", answer_cache)):
+        if cache is None:
+            continue
+        stats = cache.stats()
+        for field in ("entries", "hits", "misses", "hit_ratio"):
+            yield f"cache_{field}", {"cache": name}, stats[field]
+
+def index_metrics():
+    """Size of the local index segments and number of compactions for /metrics."""
+    if segmented_index is None:
+        return
+    for field, value in segmented_index.stats().items():
+        yield f"vector_index_{field}", {}, value
+
+metrics.collect(cache_metrics)
+metrics.collect(index_metrics)
+metrics.collect(metrics.memory_gauges)
+metrics.collect(startup.gauges)
+
+def lookup_answer(query_embedding, messages, sources):
+    """Return (signature, cached answer or None); the signature is None when the cache is off."""
+    if answer_cache is None:
+        return None, None
+    signature = answer_signature(MISTRAL_MODEL, [source["document_id"] for source in sources], messages[:-1])
+    return signature, answer_cache.get(query_embedding, signature)
+
+def remember_answer(query_embedding, signature, parts):
+    """Cache a streamed answer unless a chunk could not be parsed."""
+    if signature is not None and CHUNK_ERROR not in parts:
+        answer_cache.put(query_embedding, signature, "".join(parts))
 
 
 @app.route("/query", methods=["POST"])
@@ -74,81 +590,85 @@ def query():
     data = request.get_json()
     query_text = data.get("query", "")
     chat_history = data.get("chat_history", [])
+    try:
+        filters = parse_filters(data.get("filters"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    trace = start_trace(request.headers)
 
     # Step 1: Generate query embedding
-    query_embedding = get_query_embedding(query_text)
+    with trace.stage("embedding"):
+        query_embedding = get_query_embedding(query_text)
 
-    # Step 2: Retrieve top matching documents
-    top_matches = get_top_matches(query_embedding)
+    # Step 2: Retrieve top matching passages
+    with trace.stage("retrieval"):
+        top_matches = get_top_matches(query_embedding, query_text=query_text, filters=filters)
 
-    if top_matches.empty:
-        # No matches found, fallback to generic context
-        context = (
-            "Jij weet zoveel dingen van de wereld, ook deze vraag kan jij beantwoorden "
-            "ondanks dat je er niet helemaal zeker van bent, geef antwoord op deze vraag:"
-        )
-        sources = []
-    else:
-        # Matches found, use documents as context
-        context = "\n\n".join(top_matches["text"].tolist())
-        sources = generate_pdf_links(top_matches)
-
-    # Prepare the message structure
-    messages = [
-        {
-            "role": "system",
-            "content": (
-                f"Jij bent een behulpzame assistent op het gebied van Nederlandse politiek (met een tikje humor en je bent ook een beetje grof). "
-                f"Je hebt toegang tot de volgende informatie:\n\n{context}"
-            ),
-        },
-    ]
-
-    # Add previous chat history (if any)
-    for entry in chat_history:
-        messages.append({
-            "role": entry["role"],
-            "content": entry["content"],
-        })
-
-    # Add the current user question
-    messages.append({
-        "role": "user",
-        "content": query_text,
-    })
+    with trace.stage("prompt"):
+        messages, sources, prompt_report = build_messages(query_text, chat_history, top_matches)
+        signature, cached_answer = lookup_answer(query_embedding, messages, sources)
+    print(f"Prompt size: {prompt_report}")
 
     # Stream response from the model
     def generate_response():
         try:
             if sources:
-                pdf_links = "\n".join([f"<a href='{source['download_link']}' target='_blank'>{source['download_link']}</a>" for source in sources])
-                yield f"Bronnen:\n{pdf_links}\n\n"
+                yield format_sources(sources)
+
+            if cached_answer is not None:
+                # Same passages and history, near-identical question: replay the earlier answer
+                yield from replay(cached_answer)
+                trace.finish(answer_cache="hit", prompt_tokens=prompt_report["prompt_tokens"])
+                return
 
+            streamed_at = time.perf_counter()
+            first_token_at = None
             stream = mistral_client.chat.stream(
-                model="mistral-nemo-2407",
+                model=MISTRAL_MODEL,
                 max_tokens=1024,
                 messages=messages,
             )
-            print(f"the full prompt is:{messages}")
+            parts = []
             for chunk in stream:
-                #print("Raw chunk:", chunk)  # Log the raw chunk to inspect the response
-                try:
-                    yield chunk.data.choices[0].delta.content
-                except (IndexError, AttributeError, KeyError) as e:
-                    print(f"Error parsing chunk: {e}")
-                    yield "Fout in het ontvangen antwoord. Probeer het opnieuw."
+                text = chunk_text(chunk)
+                if first_token_at is None and text:
+                    first_token_at = time.perf_counter()
+                parts.append(text)
+                yield text
+            remember_answer(query_embedding, signature, parts)
+            finish_answer(trace, streamed_at, first_token_at, parts,
+                          answer_cache="miss", prompt_tokens=prompt_report["prompt_tokens"])
         except Exception as e:
             print(f"Error during streaming: {e}")
+            metrics.counter("query_errors_total", "Answers that failed while streaming").inc()
+            trace.finish(error=str(e))
             yield f"An error occurred: {e}"
 
     # Stream the response to the frontend
-    return Response(generate_response(), content_type="text/plain")
+    return Response(generate_response(), content_type="text/plain", headers={
+        "X-Prompt-Tokens": str(prompt_report["prompt_tokens"]),
+        "X-Answer-Cache": "hit" if cached_answer is not None else "miss",
+        "X-Trace-Id": trace.trace_id,
+    })
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """Prometheus scrape endpoint (metrics of this worker process); ?format=json gives p50/p95/p99."""
+    if request.args.get("format") == "json":
+        return jsonify(metrics.summaries())
+    return Response(metrics.render_prometheus(), content_type="text/plain; version=0.0.4")
 
 
 @app.route("/")
 def index():
     return send_from_directory(".", "index.html")  # Assumes `index.html` is in the same directory as app.py
     
+startup.record("app_import", time.perf_counter() - _import_started_at)
+if PREWARM_SERVICES:
+    threading.Thread(target=init_services, name="prewarm-services", daemon=True).start()
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port, debug=True)  # Only for local
@@ -0,0 +1,124 @@
+import asyncio
+import os
+import time
+
+from quart import Quart, Response, request, send_from_directory
+
+import app as service
+import metrics
+from answerCache import replay
+from metadataFilter import parse_filters
+
+# Async serving mode: the same /query and / routes as app.py, but embedding,
+# retrieval and the Mistral stream are awaited, so one process can hold many
+# concurrent streams. Run with: uvicorn asgi:app --host 0.0.0.0 --port 8080
+app = Quart(__name__)
+
+
+@app.before_serving
+async def startup():
+    """Create the clients and load the index before the first request."""
+    await asyncio.to_thread(service.init_services)
+
+
+async def get_query_embedding(query_text):
+    """Await the query embedding, using the cache and the batcher when enabled.
+
+    The cache may be backed by SQLite (EMBEDDING_CACHE_PATH), so its lookups
+    and writes run in a worker thread instead of on the event loop.
+    """
+    cached = await asyncio.to_thread(service.embedding_cache.get, query_text)
+    if cached is not None:
+        return cached
+    if service.embedding_batcher is not None:
+        vector = await asyncio.wrap_future(service.embedding_batcher.submit(query_text))
+    else:
+        vector = await asyncio.to_thread(service.embed_text, query_text)
+    await asyncio.to_thread(service.embedding_cache.put, query_text, vector)
+    return vector
+
+
+async def get_top_matches(query_embedding, query_text, filters=None):
+    """Run the retrieval in a worker thread (NumPy and BigQuery release the GIL)."""
+    return await asyncio.to_thread(service.get_top_matches, query_embedding, query_text=query_text, filters=filters)
+
+
+async def stream_answer(messages):
+    """Yield the text deltas of the Mistral answer."""
+    stream = await service.mistral_client.chat.stream_async(
+        model=service.MISTRAL_MODEL,
+        max_tokens=1024,
+        messages=messages,
+    )
+    async for chunk in stream:
+        yield service.chunk_text(chunk)
+
+
+@app.route("/query", methods=["POST"])
+async def query():
+    data = await request.get_json()
+    query_text = data.get("query", "")
+    chat_history = data.get("chat_history", [])
+    try:
+        filters = parse_filters(data.get("filters"))
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    trace = service.start_trace(request.headers)
+    with trace.stage("embedding"):
+        query_embedding = await get_query_embedding(query_text)
+    with trace.stage("retrieval"):
+        top_matches = await get_top_matches(query_embedding, query_text, filters)
+    with trace.stage("prompt"):
+        messages, sources, prompt_report = service.build_messages(query_text, chat_history, top_matches)
+        signature, cached_answer = service.lookup_answer(query_embedding, messages, sources)
+    print(f"Prompt size: {prompt_report}")
+
+    async def generate_response():
+        try:
+            if sources:
+                yield service.format_sources(sources)
+            if cached_answer is not None:
+                for text in replay(cached_answer):
+                    yield text
+                trace.finish(answer_cache="hit", prompt_tokens=prompt_report["prompt_tokens"])
+                return
+            streamed_at = time.perf_counter()
+            first_token_at = None
+            parts = []
+            async for text in stream_answer(messages):
+                if first_token_at is None and text:
+                    first_token_at = time.perf_counter()
+                parts.append(text)
+                yield text
+            service.remember_answer(query_embedding, signature, parts)
+            service.finish_answer(trace, streamed_at, first_token_at, parts,
+                                  answer_cache="miss", prompt_tokens=prompt_report["prompt_tokens"])
+        except Exception as e:
+            print(f"Error during streaming: {e}")
+            metrics.counter("query_errors_total", "Answers that failed while streaming").inc()
+            trace.finish(error=str(e))
+            yield f"An error occurred: {e}"
+
+    return Response(generate_response(), content_type="text/plain", headers={
+        "X-Prompt-Tokens": str(prompt_report["prompt_tokens"]),
+        "X-Answer-Cache": "hit" if cached_answer is not None else "miss",
+        "X-Trace-Id": trace.trace_id,
+    })
+
+
+@app.route("/metrics")
+async def prometheus_metrics():
+    if request.args.get("format") == "json":
+        return metrics.summaries()
+    return Response(metrics.render_prometheus(), content_type="text/plain; version=0.0.4")
+
+
+@app.route("/")
+async def index():
+    return await send_from_directory(os.path.dirname(os.path.abspath(__file__)), "index.html")
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 8080))
+    app.run(host="0.0.0.0", port=port)  # Only for local
@@ -0,0 +1,644 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from embeddingSnapshot import SnapshotWriter, normalize_rows
+from exactSearch import ExactSearch, recall_at_k
+from indexSegments import SegmentedIndex
+from lexicalIndex import LexicalIndex
+from metadataFilter import MISSING_DAY, MetadataColumns
+from quantization import QuantizedSearch, add_quantized_sections
+from sharedSnapshots import SharedSnapshots
+from vectorIndex import DEFAULT_NPROBE, MIN_ROWS_FOR_IVF, VectorIndex, add_index_sections
+
+# Offline benchmark of the whole RAG path on a synthetic corpus, with local
+# fakes for Vertex AI, Mistral, the OData API and BigQuery. Results are
+# written as JSON so two runs can be compared with the ``compare`` command.
+#
+#   python benchmark.py run --vectors 100000 --output before.json
+#   python benchmark.py compare before.json after.json
+RESULT_VERSION = 1
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SOORTEN = ("Motie", "Amendement", "Brief regering", "Verslag", "Kamervragen", "Wetsvoorstel")
+FRACTIES = ("VVD", "PVV", "GL-PvdA", "NSC", "D66", "BBB", "CDA", "SP", "ChristenUnie", "SGP", "PvdD", "Volt")
+VOCABULARY = """
+stikstof woningbouw begroting zorgverzekering asielbeleid klimaatakkoord onderwijs defensie landbouw
+pensioen toeslagen belasting energieprijzen netcongestie huurwoningen jeugdzorg politie rechtspraak
+gaswinning groningen migratie arbeidsmarkt minimumloon kinderopvang studiefinanciering spoorwegen
+luchtvaart schiphol natuur water infrastructuur digitalisering privacy cybersecurity europa oekraine
+ontwikkelingshulp handel subsidie gemeentefonds provincies verkiezingen grondwet staatsrecht integriteit
+""".split()
+FILLER = "de het een van en in op voor met dat die door over regering kamer minister motie verzoekt overwegende".split()
+# Days since 1970-01-01 of the synthetic document dates (2015-01-01 .. 2024-12-31).
+FIRST_DAY, LAST_DAY = 16436, 20088
+
+
+def latency_summary(seconds):
+    """p50/p95/p99/mean in milliseconds plus throughput of a list of durations."""
+    if not len(seconds):
+        return {}
+    values = np.asarray(seconds, dtype=np.float64) * 1000.0
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50_ms": round(p50, 3), "p95_ms": round(p95, 3), "p99_ms": round(p99, 3),
+            "mean_ms": round(values.mean(), 3), "per_second": round(1000.0 / values.mean(), 2)}
+
+
+def synthetic_text(rng, topic, words=60):
+    """Passage text about one topic: topic words mixed with filler and a Kamerstuk number."""
+    topic_words = [VOCABULARY[(topic * 7 + j) % len(VOCABULARY)] for j in range(4)]
+    choices = rng.integers(0, 3, words)
+    text = [topic_words[rng.integers(4)] if c == 0 else VOCABULARY[rng.integers(len(VOCABULARY))] if c == 1
+            else FILLER[rng.integers(len(FILLER))] for c in choices]
+    return " ".join(text) + f" kamerstuk {36000 + topic}-{rng.integers(1, 200)}"
+
+
+def write_corpus(path, vectors, dimension, dtype="float32", passages_per_document=4, quantization=(),
+                 seed=0, batch_rows=50_000):
+    """Write a clustered synthetic corpus with metadata as a cosine index snapshot at path.
+
+    Vectors are drawn around one centre per topic, so IVF and quantisation
+    behave like they do on real embeddings; the passage text of a row is
+    about the same topic, so BM25 has something to find.
+    """
+    rng = np.random.default_rng(seed)
+    n_topics = max(16, int(np.sqrt(vectors) / 4))
+    centres = normalize_rows(rng.normal(size=(n_topics, dimension)).astype(np.float32))
+    topics = rng.integers(0, n_topics, vectors)
+    writer = SnapshotWriter(path, dimension, dtype)
+    for start in range(0, vectors, batch_rows):
+        rows = np.arange(start, min(start + batch_rows, vectors))
+        noise = rng.normal(scale=0.7 / np.sqrt(dimension), size=(len(rows), dimension)).astype(np.float32)
+        matrix = normalize_rows(centres[topics[rows]] + noise)
+        ids = [f"doc-{row // passages_per_document:08d}" for row in rows]
+        texts = [synthetic_text(rng, int(topics[row])) for row in rows]
+        writer.add_batch(ids, texts, matrix)
+
+    documents = (vectors + passages_per_document - 1) // passages_per_document
+    document_rows = np.arange(vectors) // passages_per_document
+    soort = rng.integers(0, len(SOORTEN), documents).astype(np.uint16)[document_rows]
+    days = rng.integers(FIRST_DAY, LAST_DAY, documents).astype(np.int32)[document_rows]
+    days[rng.random(vectors) < 0.01] = MISSING_DAY
+    bits = (rng.random((len(FRACTIES), documents)) < 0.2)[:, document_rows]
+    MetadataColumns(soort, SOORTEN, days, np.packbits(bits, axis=1, bitorder="little"), FRACTIES).add_sections(writer)
+
+    add_index_sections(writer, "cosine", DEFAULT_NPROBE, MIN_ROWS_FOR_IVF)
+    for kind in quantization:
+        add_quantized_sections(writer, kind, "cosine")
+    writer.close()
+
+
+def sample_queries(index, n_queries, seed=1):
+    """Perturbed corpus rows, so every query has true neighbours."""
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(index), min(n_queries, len(index)), replace=False))
+    queries = np.asarray(index.matrix[rows], dtype=np.float32)
+    queries = queries + rng.normal(scale=0.3 / np.sqrt(index.dimension), size=queries.shape).astype(np.float32)
+    return normalize_rows(queries)
+
+
+def timed(search, queries):
+    """Run one search per query; returns (durations, result rows)."""
+    durations, results = [], []
+    for query in queries:
+        started = time.perf_counter()
+        rows = search(query)
+        durations.append(time.perf_counter() - started)
+        results.append(rows)
+    return durations, results
+
+
+def bench_retrieval(index, metadata, args):
+    """Latency percentiles and recall@k of each search path against the exact search."""
+    queries = sample_queries(index, args.queries)
+    exact = ExactSearch.from_index(index)
+    k = args.top_k
+    durations, exact_rows = timed(lambda q: exact.search(q, k)[0][0], queries)
+    results = {"exact": dict(latency_summary(durations), recall=1.0)}
+
+    if index.centroids is not None:
+        for nprobe in args.nprobe:
+            durations, rows = timed(lambda q: index.search(q, k, nprobe=nprobe)[0], queries)
+            results[f"ivf_nprobe_{nprobe}"] = dict(latency_summary(durations), recall=recall_at_k(rows, exact_rows))
+
+    for kind in args.quantization:
+        search = QuantizedSearch.from_index(index, kind, rerank=args.rerank)
+        durations, rows = timed(lambda q: search.search(q, k)[0], queries)
+        results[kind] = dict(latency_summary(durations), recall=recall_at_k(rows, exact_rows),
+                             scan_mib=round(search.memory_bytes() / 2**20, 1))
+
+    if metadata is not None:
+        # A selective filter (one document type in one year range) and a broad one (one party).
+        for name, filters in (("filter_soort_dates", {"soort": ["Motie"], "datum_van": FIRST_DAY + 1461,
+                                                      "datum_tot": FIRST_DAY + 2191}),
+                              ("filter_fractie", {"fractie": ["VVD"]})):
+            mask_started = time.perf_counter()
+            mask = metadata.mask(filters)
+            mask_seconds = time.perf_counter() - mask_started
+            filtered_exact = [exact.search(q, k, mask=mask)[0][0] for q in queries]
+            durations, rows = timed(lambda q: index.search(q, k, mask=mask)[0], queries)
+            results[name] = dict(latency_summary(durations), recall=recall_at_k(rows, filtered_exact),
+                                 selected_rows=int(mask.sum()), mask_ms=round(mask_seconds * 1000, 3))
+    return results
+
+
+def build_lexical(index):
+    started = time.perf_counter()
+    lexical = LexicalIndex(base=index)
+    lexical.add_base()
+    return lexical, time.perf_counter() - started
+
+
+def bench_lexical(lexical, args):
+    rng = np.random.default_rng(2)
+    questions = [" ".join(rng.choice(VOCABULARY, 3)) for _ in range(args.queries)]
+    durations, _ = timed(lambda question: lexical.search(question, args.top_k), questions)
+    return latency_summary(durations)
+
+
+class _Delta:
+    def __init__(self, content):
+        self.data = types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=content))])
+
+
+class FakeMistral:
+    """Local stand-in for MistralGoogleCloud: streams canned tokens after a first-token delay."""
+
+    def __init__(self, first_token_latency=0.3, tokens_per_second=60.0, answer_tokens=200):
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.chat = self
+
+    def stream(self, model, max_tokens, messages):
+        time.sleep(self.first_token_latency)
+        for i in range(min(self.answer_tokens, max_tokens)):
+            if i:
+                time.sleep(1.0 / self.tokens_per_second)
+            yield _Delta(f"{FILLER[i % len(FILLER)]} ")
+
+
+class FixedGeneration:
+    """Corpus generation that never changes (no GCS polling)."""
+
+    def current(self):
+        return 0
+
+    def subscribe(self, callback):
+        pass
+
+
+def bench_query(index, metadata, lexical, args):
+    """Throughput and latency of /query (Flask app, fake embedding model and Mistral) under concurrent load."""
+    sys.path.append(os.path.join(ROOT, "source", "embed"))
+    from backfill import FakeEmbeddingModel
+
+    import app as service
+    import metrics
+
+    service._services_ready = True
+    service.embedding_model = FakeEmbeddingModel(index.dimension, latency=args.embedding_latency)
+    service.mistral_client = FakeMistral(args.llm_first_token, args.llm_tokens_per_second, args.answer_tokens)
+    service.corpus_generation = FixedGeneration()
+    service.vector_index = index
+    service.exact_search = ExactSearch.from_index(index)
+    service.metadata_columns = metadata
+    service.segmented_index = SegmentedIndex(index, service.make_base_search,
+                                             SharedSnapshots(os.path.dirname(index.snapshot.path)), metadata=metadata)
+    if lexical is not None:
+        service.lexical_index = lexical
+        service.lexical_base = index
+        service.lexical_ready.set()
+    if not args.answer_cache:
+        service.answer_cache = None
+
+    rng = np.random.default_rng(3)
+    results = {}
+    for concurrency in args.concurrency:
+        counter = iter(range(args.requests))
+        lock = threading.Lock()
+        latencies, first_bytes, errors = [], [], []
+
+        def worker():
+            client = service.app.test_client()
+            while True:
+                with lock:
+                    i = next(counter, None)
+                    question = " ".join(rng.choice(VOCABULARY, 4)) + f" vraag {i}"
+                if i is None:
+                    return
+                started = time.perf_counter()
+                response = client.post("/query", json={"query": question}, buffered=False)
+                first_byte = None
+                body = []
+                for chunk in response.response:
+                    if first_byte is None:
+                        first_byte = time.perf_counter() - started
+                    body.append(chunk)
+                response.close()
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+                    first_bytes.append(first_byte or 0.0)
+                    if response.status_code != 200 or b"An error occurred" in b"".join(body):
+                        errors.append(i)
+
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # the app prints per request
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                for future in [pool.submit(worker) for _ in range(concurrency)]:
+                    future.result()
+        elapsed = time.perf_counter() - started
+        results[f"concurrency_{concurrency}"] = {
+            "requests": len(latencies),
+            "errors": len(errors),
+            "requests_per_second": round(len(latencies) / elapsed, 2),
+            "latency": latency_summary(latencies),
+            "first_byte": latency_summary(first_bytes),
+        }
+    results["server_stages"] = {name: {key: round(value, 6) for key, value in summary.items()}
+                                for name, summary in metrics.summaries().items()
+                                if name.startswith(("query_stage_seconds", "llm_tokens_per_second"))}
+    return results
+
+
+class FakeODataSession:
+    """Local stand-in for the OData API: pages of synthetic Document records linked by @odata.nextLink."""
+
+    def __init__(self, total, page_size=250, latency=0.05):
+        self.total = total
+        self.page_size = page_size
+        self.latency = latency
+
+    def get(self, url, timeout=None):
+        time.sleep(self.latency)
+        page = int(url.rsplit("page=", 1)[1]) if "page=" in url else 0
+        start = page * self.page_size
+        rng = np.random.default_rng(page)
+        records = [{
+            "@odata.etag": f"W/\"{row}\"",
+            "Id": f"doc-{row:08d}",
+            "Soort": SOORTEN[row % len(SOORTEN)],
+            "Titel": synthetic_text(rng, row % 50, words=8),
+            "Onderwerp": synthetic_text(rng, row % 50, words=16),
+            "ContentType": "application/pdf",
+            "GewijzigdOp": f"2024-01-01T00:00:{row % 60:02d}Z",
+            "Fracties": list(rng.choice(FRACTIES, rng.integers(0, 3), replace=False)),
+        } for row in range(start, min(start + self.page_size, self.total))]
+        body = {"value": records}
+        if start + self.page_size < self.total:
+            body["@odata.nextLink"] = f"https://odata.invalid/Document?page={page + 1}"
+        return types.SimpleNamespace(json=lambda: body, raise_for_status=lambda: None)
+
+
+def synthetic_pdf(pages):
+    """A minimal PDF with one text page per string, readable by PyPDF2."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        words = text.split()
+        lines = [" ".join(words[i:i + 12]) for i in range(0, len(words), 12)]
+        stream = ("BT /F1 10 Tf 14 TL 50 800 Td " + " ".join(f"({line}) '" for line in lines) + " ET").encode("latin-1")
+        kids.append(len(objects) + 1)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> "
+                       f"/Contents {len(objects) + 2} 0 R >>".encode())
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{kid} 0 R' for kid in kids)}] /Count {len(kids)} >>".encode()
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def bench_fetch(args, directory):
+    """OData pages -> records -> Parquet batches written to a local directory."""
+    from odataStream import batched, iter_pages, iter_records, records_to_parquet
+
+    http = FakeODataSession(args.documents, latency=args.page_latency)
+    started = time.perf_counter()
+    records = written = 0
+    for number, batch in enumerate(batched(iter_records(iter_pages(http, "https://odata.invalid/Document")), 5000)):
+        buffer = records_to_parquet(batch)
+        with open(os.path.join(directory, f"documents-{number:05d}.parquet"), "wb") as handle:
+            written += handle.write(buffer.getbuffer())
+        records += len(batch)
+    elapsed = time.perf_counter() - started
+    return {"records": records, "seconds": round(elapsed, 2), "records_per_second": round(records / elapsed, 2),
+            "parquet_mb": round(written / 1e6, 2)}
+
+
+def bench_store(args, directory):
+    """The PDF pipeline with fake downloads spooled to disk, the extraction pool and a local Parquet sink."""
+    from documentSink import DocumentSink, LocalParquetBackend
+    from pdfExtract import ExtractionPool, SpooledPdf
+    from pipeline import DocumentPipeline
+
+    rng = np.random.default_rng(4)
+    pdfs = [synthetic_pdf([synthetic_text(rng, topic, words=300) for _ in range(args.pdf_pages)])
+            for topic in range(16)]
+    sink = DocumentSink(LocalParquetBackend(directory))
+
+    def download(session, row):
+        time.sleep(args.download_latency)
+        pdf = pdfs[zlib.crc32(row["Id"].encode()) % len(pdfs)]
+        return SpooledPdf.from_chunks([pdf[i:i + 65536] for i in range(0, len(pdf), 65536)], directory)
+
+    def store(records):
+        for row, text in records:
+            sink.add(row["Id"], row["Titel"], row["Onderwerp"], text)
+        return []
+
+    rows = [{"Id": f"doc-{i:08d}", "Titel": "Titel", "Onderwerp": "Onderwerp"} for i in range(args.pdfs)]
+    with ExtractionPool() as extractor:
+        pipeline = DocumentPipeline(download, extractor.extract, store, download_workers=args.download_workers,
+                                    extract_workers=extractor.workers, session=types.SimpleNamespace(close=lambda: None))
+        summary = pipeline.run(rows)
+    sink.close()
+    return dict(summary, pdf_kb=round(np.mean([len(pdf) for pdf in pdfs]) / 1024, 1))
+
+
+def import_create_embeddings(directory):
+    """Import the embed Cloud Function offline: fake model, SQLite hash store, no quota and mocked clients."""
+    from unittest import mock
+
+    settings = {"EMBEDDING_MODEL": "fake", "EMBEDDING_HASH_STORE": os.path.join(directory, "hashes.sqlite"),
+                "EMBEDDING_REQUESTS_PER_MINUTE": "0"}
+    with mock.patch.dict(os.environ, settings), mock.patch("google.cloud.aiplatform.init"), \
+            mock.patch("google.cloud.bigquery.Client"), mock.patch("google.cloud.storage.Client"):
+        import createEmbeddings
+    return createEmbeddings
+
+
+def bench_embed(args, directory):
+    """Chunk, hash and embed documents with createEmbeddings.embed_shard driven by the backfill.
+
+    Documents are read from memory and the BigQuery deletes and loads go to a
+    mocked client; chunking, the hash store lookups, the model calls and the
+    float16 packing are the production code. The second run finds every
+    passage in the hash store, which is the cost of re-embedding an
+    unchanged corpus.
+    """
+    import pandas as pd
+    from backfill import EmbeddingBackfill, FakeEmbeddingModel, LocalCheckpoint
+
+    embed = import_create_embeddings(directory)
+    rng = np.random.default_rng(5)
+    documents = {f"doc-{i:08d}": " ".join(synthetic_text(rng, i % 50) for _ in range(25)) for i in range(args.documents)}
+    embed.model = model = FakeEmbeddingModel(args.dimension, latency=args.embedding_latency)
+    embed.fetch_documents = lambda ids: pd.DataFrame(
+        [{"document_id": i, "text": documents[i], "subject": "Onderwerp", "title": "Titel"} for i in ids])
+    embed_chunks = embed.embed_chunks
+    passages = []
+
+    def counted_chunks(shard):
+        df = embed_chunks(shard)
+        passages.append(len(df))
+        return df
+
+    embed.embed_chunks = counted_chunks
+    results = {}
+    for run in ("cold", "warm"):
+        passages.clear()
+        backfill = EmbeddingBackfill(lambda: list(documents), embed.embed_shard,
+                                     LocalCheckpoint(os.path.join(directory, f"checkpoint-{run}.json")),
+                                     shard_size=args.shard_size, workers=args.embed_workers)
+        summary = backfill.run()
+        results[run] = dict(summary, passages=sum(passages),
+                            passages_per_second=round(sum(passages) / summary["seconds"], 2) if summary["seconds"] else 0.0)
+    results["model_calls"] = model.calls
+    return results
+
+
+def import_times(stderr, module):
+    """Cumulative import time (ms) of the direct imports of ``module`` from ``python -X importtime`` output."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            entries.append(((len(name) - len(name.lstrip()) - 1) // 2, name.strip(), int(cumulative) / 1000))
+    # Children are printed before their parent; the module's direct imports sit one level deeper.
+    for end, (depth, name, total) in enumerate(entries):
+        if depth == 0 and name == module:
+            start = max([i + 1 for i, entry in enumerate(entries[:end]) if entry[0] == 0] or [0])
+            children = {name: ms for depth, name, ms in entries[start:end] if depth == 1}
+            return total, dict(sorted(children.items(), key=lambda item: item[1], reverse=True))
+    return None, {}
+
+
+def bench_startup(args):
+    """Cold import of app.py in a fresh interpreter and the imports it spends that time on."""
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                               cwd=ROOT, capture_output=True, text=True)
+    wall = time.perf_counter() - started
+    total, children = import_times(completed.stderr, "app")
+    if completed.returncode != 0:
+        return {"error": completed.stderr.strip().splitlines()[-1]}
+    return {"interpreter_seconds": round(wall, 3), "import_ms": round(total, 1),
+            "slowest_imports_ms": {name: round(ms, 1) for name, ms in list(children.items())[:args.startup_top]}}
+
+
+def _worker_memory(path, directory, quantization, lexical, queries, barrier, results):
+    """One simulated gunicorn worker: load the snapshot like app.py does, search it and report its memory."""
+    import metrics
+
+    index = SharedSnapshots(directory).load(path, quantization=quantization)
+    exact = ExactSearch.from_index(index)
+    quantized = QuantizedSearch.from_index(index, quantization) if quantization else None
+    if lexical:
+        lexical_index = LexicalIndex(base=index)
+        lexical_index.add_base()
+        lexical_index.top_matches(" ".join(VOCABULARY[:3]), 10)
+    for query in queries:
+        exact.search(query, 10)  # touches every row
+        if quantized is not None:
+            quantized.search(query, 10)
+    barrier.wait()  # measure while every worker has the index mapped
+    results.put({labels["kind"]: value for _, labels, value in metrics.memory_gauges()})
+    barrier.wait()
+
+
+def bench_workers(path, args):
+    """Resident memory per worker process when several workers serve the same snapshot."""
+    context = multiprocessing.get_context("spawn")  # fresh interpreters, like gunicorn workers without --preload
+    queries = sample_queries(VectorIndex.load(path, verify=False), 32)
+    quantization = args.quantization[0] if args.quantization else None
+    with tempfile.TemporaryDirectory(dir=args.workdir) as directory:
+        barrier, results = context.Barrier(args.workers), context.Queue()
+        processes = [context.Process(target=_worker_memory, args=(path, directory, quantization, args.lexical, queries, barrier, results))
+                     for _ in range(args.workers)]
+        for process in processes:
+            process.start()
+        memory = [results.get(timeout=600) for _ in processes]
+        for process in processes:
+            process.join()
+        serving = [name for name in os.listdir(directory) if name.endswith(".snapshot")]
+    if not memory[0]:
+        return {"error": "/proc/self/smaps_rollup is not available"}
+    mib = lambda value: round(value / 2**20, 1)
+    return {
+        "workers": args.workers,
+        "lexical_index": args.lexical,
+        "serving_snapshots": len(serving),
+        **{f"{kind}_mib_per_worker": mib(max(sample[kind] for sample in memory)) for kind in memory[0]},
+        "proportional_mib_total": mib(sum(sample["proportional"] for sample in memory)),
+    }
+
+
+def bench_ingestion(args):
+    # The Cloud Function directories are not packages; their modules import each other by name.
+    # source/fetch still carries an older createEmbeddings.py, so source/embed goes first.
+    for name in ("embed", "store", "fetch"):
+        path = os.path.join(ROOT, "source", name)
+        if path not in sys.path:
+            sys.path.append(path)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for stage, bench in (("fetch", bench_fetch), ("store", bench_store), ("embed", bench_embed)):
+            stage_directory = os.path.join(directory, stage)
+            os.makedirs(stage_directory)
+            results[stage] = bench(args, stage_directory)
+    return results
+
+
+def run(args):
+    result = {
+        "version": RESULT_VERSION,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "machine": platform.machine(), "cpus": os.cpu_count()},
+        "config": vars(args),
+    }
+    stages = set(args.stages)
+    if "startup" in stages:
+        result["startup"] = bench_startup(args)
+    with tempfile.TemporaryDirectory(dir=args.workdir) as directory:
+        if stages & {"retrieval", "query", "workers"}:
+            path = args.snapshot or os.path.join(directory, "corpus.snapshot")
+            started = time.perf_counter()
+            if not args.snapshot:
+                write_corpus(path, args.vectors, args.dimension, args.dtype, quantization=args.quantization)
+            index = VectorIndex.load(path, verify=False)
+            metadata = MetadataColumns.from_snapshot(index.snapshot)
+            result["corpus"] = {"vectors": len(index), "dimension": index.dimension,
+                                "ivf_lists": 0 if index.centroids is None else len(index.centroids),
+                                "snapshot_mb": round(os.path.getsize(path) / 1e6, 1),
+                                "build_seconds": round(time.perf_counter() - started, 2)}
+            lexical = None
+            if args.lexical:
+                lexical, seconds = build_lexical(index)
+                result["corpus"]["lexical_build_seconds"] = round(seconds, 2)
+            if "retrieval" in stages:
+                result["retrieval"] = bench_retrieval(index, metadata, args)
+                if lexical is not None:
+                    result["retrieval"]["bm25"] = bench_lexical(lexical, args)
+            if "query" in stages:
+                result["query"] = bench_query(index, metadata, lexical, args)
+            if "workers" in stages:
+                result["workers"] = bench_workers(path, args)
+        if "ingestion" in stages:
+            result["ingestion"] = bench_ingestion(args)
+
+    output = json.dumps(result, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(output + "\n")
+    print(output)
+
+
+def flatten(value, prefix=""):
+    """{"a.b.c": number} for every numeric leaf of a result."""
+    if isinstance(value, dict):
+        items = {}
+        for key, child in value.items():
+            items.update(flatten(child, f"{prefix}{key}."))
+        return items
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix[:-1]: value}
+    return {}
+
+
+def compare(before_path, after_path):
+    """Print every numeric result of two runs with its relative change."""
+    with open(before_path) as handle:
+        before = flatten({key: value for key, value in json.load(handle).items() if key != "config"})
+    with open(after_path) as handle:
+        after = flatten({key: value for key, value in json.load(handle).items() if key != "config"})
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        change = f"{(new - old) / old:+.1%}" if old else "n/a"
+        print(f"{key:70} {old:>14} {new:>14} {change:>8}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Offline benchmark of retrieval, /query and ingestion.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    run_parser = commands.add_parser("run", help="run the benchmark and write JSON results")
+    run_parser.add_argument("--stages", nargs="+", default=["startup", "retrieval", "query", "workers", "ingestion"],
+                            choices=["startup", "retrieval", "query", "workers", "ingestion"])
+    run_parser.add_argument("--startup-top", type=int, default=15, help="slowest app imports to report")
+    run_parser.add_argument("--output", help="JSON result file (also printed)")
+    run_parser.add_argument("--workdir", help="directory for the temporary snapshot (default: system temp)")
+    corpus = run_parser.add_argument_group("corpus")
+    corpus.add_argument("--vectors", type=int, default=10_000, help="synthetic passages (10k .. 5M)")
+    corpus.add_argument("--dimension", type=int, default=768)
+    corpus.add_argument("--dtype", default="float32", choices=["float32", "float16", "int8"])
+    corpus.add_argument("--snapshot", help="benchmark an existing snapshot instead of a synthetic corpus")
+    corpus.add_argument("--quantization", nargs="*", default=["int8"], choices=["int8", "pq"])
+    corpus.add_argument("--no-lexical", dest="lexical", action="store_false", help="skip the BM25 index")
+    retrieval = run_parser.add_argument_group("retrieval")
+    retrieval.add_argument("--queries", type=int, default=200)
+    retrieval.add_argument("--top-k", type=int, default=10)
+    retrieval.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16])
+    retrieval.add_argument("--rerank", type=int, default=100)
+    query = run_parser.add_argument_group("/query load")
+    query.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    query.add_argument("--requests", type=int, default=200, help="requests per concurrency level")
+    query.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per fake embedding call")
+    query.add_argument("--llm-first-token", type=float, default=0.3, help="seconds until the first fake token")
+    query.add_argument("--llm-tokens-per-second", type=float, default=60.0)
+    query.add_argument("--answer-tokens", type=int, default=200)
+    query.add_argument("--answer-cache", action="store_true", help="leave the answer cache on")
+    run_parser.add_argument("--workers", type=int, default=4, help="worker processes sharing the snapshot")
+    ingestion = run_parser.add_argument_group("ingestion")
+    ingestion.add_argument("--documents", type=int, default=2000, help="OData records and documents to embed")
+    ingestion.add_argument("--page-latency", type=float, default=0.05, help="seconds per fake OData page")
+    ingestion.add_argument("--pdfs", type=int, default=200)
+    ingestion.add_argument("--pdf-pages", type=int, default=5)
+    ingestion.add_argument("--download-latency", type=float, default=0.05)
+    ingestion.add_argument("--download-workers", type=int, default=8)
+    ingestion.add_argument("--shard-size", type=int, default=100)
+    ingestion.add_argument("--embed-workers", type=int, default=4)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_args(sys.argv[1:])
+    if arguments.command == "compare":
+        compare(arguments.before, arguments.after)
+    else:
+        run(arguments)
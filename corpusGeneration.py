@@ -0,0 +1,71 @@
+import threading
+import time
+
+# The embedding pipeline (source/embed/createEmbeddings.py) increments this
+# counter in GCS every time it adds rows to document_embeddings; serving
+# processes poll it to find out that cached results are stale.
+GENERATION_BLOB = "corpus_generation"
+
+
+class CorpusGeneration:
+    """Polls the corpus generation counter stored as a small GCS object.
+
+    ``current()`` is cheap: the object is read at most once per
+    ``poll_interval`` seconds, the last known value is returned otherwise
+    (and when GCS cannot be reached). The first value read is the baseline:
+    listeners are only called for generations that change after it.
+    """
+
+    def __init__(self, storage_client, bucket_name, blob_name=GENERATION_BLOB, poll_interval=30):
+        self.storage_client = storage_client
+        self.bucket_name = bucket_name
+        self.blob_name = blob_name
+        self.poll_interval = poll_interval
+        self._generation = 0
+        self._seen = False  # whether a generation has been read yet
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def subscribe(self, callback):
+        """Call ``callback(generation)`` whenever a new generation is seen."""
+        self._listeners.append(callback)
+
+    def watch(self):
+        """Poll in a background thread, so listeners hear of new generations even without queries."""
+        def poll():
+            while True:
+                time.sleep(self.poll_interval)
+                self.current()
+
+        threading.Thread(target=poll, name="corpus-generation", daemon=True).start()
+
+    def current(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked_at < self.poll_interval:
+                return self._generation
+            self._checked_at = now
+            previous = self._generation
+
+        generation = self._read()
+        if generation is None:
+            return previous
+        with self._lock:
+            self._generation = generation
+            first, self._seen = not self._seen, True
+        if generation != previous and not first:
+            print(f"Corpus generation changed from {previous} to {generation}")
+            for callback in self._listeners:
+                callback(generation)
+        return generation
+
+    def _read(self):
+        try:
+            blob = self.storage_client.bucket(self.bucket_name).blob(self.blob_name)
+            if not blob.exists():
+                return 0
+            return int(blob.download_as_text().strip() or 0)
+        except Exception as e:
+            print(f"Error reading corpus generation: {e}")
+            return None
@@ -0,0 +1,122 @@
+import hashlib
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+import metrics
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 250)
+
+
+class FakeEmbedding:
+    def __init__(self, values):
+        self.values = values
+
+
+class FakeEmbeddingModel:
+    """Local stand-in for TextEmbeddingModel with a configurable latency.
+
+    Vectors are deterministic per text (seeded from a hash of the text), so
+    tests and benchmarks get stable results without calling Vertex AI.
+    """
+
+    def __init__(self, dimension=768, latency=0.05, per_text_latency=0.0):
+        self.dimension = dimension
+        self.latency = latency
+        self.per_text_latency = per_text_latency
+        self.calls = 0
+        self.texts_embedded = 0
+
+    def get_embeddings(self, texts):
+        time.sleep(self.latency + self.per_text_latency * len(texts))
+        self.calls += 1
+        self.texts_embedded += len(texts)
+        return [FakeEmbedding(self.vector(text)) for text in texts]
+
+    def vector(self, text):
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+        return np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32).tolist()
+
+
+class EmbeddingBatcher:
+    """Coalesces concurrent single-text embedding requests into batch calls.
+
+    ``model`` is anything with ``get_embeddings(texts)`` returning objects
+    with a ``values`` attribute (TextEmbeddingModel, FakeEmbeddingModel).
+    A background thread waits for the first request, keeps collecting for up
+    to ``max_wait`` seconds or ``max_batch_size`` texts, then sends a single
+    model call and resolves each caller's future.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_wait=0.01):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_sizes = metrics.histogram("embedding_batch_size", "Texts per embedding call", BATCH_SIZE_BUCKETS)
+        self.wait_times = metrics.histogram("embedding_batch_wait_seconds", "Time a request waited for its batch")
+        self._requests = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, text):
+        """Queue a text and return a Future resolving to its embedding values."""
+        if self._closed:
+            raise RuntimeError("EmbeddingBatcher is closed")
+        future = Future()
+        self._requests.put((text, future, time.monotonic()))
+        return future
+
+    def embed(self, text, timeout=None):
+        return self.submit(text).result(timeout)
+
+    def close(self):
+        self._closed = True
+        self._requests.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        """Block for the first request, then gather more until the window closes."""
+        first = self._requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._requests.put(None)  # let the loop see the shutdown after this batch
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            dispatched_at = time.monotonic()
+            for _, _, submitted_at in batch:
+                self.wait_times.observe(dispatched_at - submitted_at)
+
+            # Identical texts in one window are embedded once.
+            texts = list(dict.fromkeys(text for text, _, _ in batch))
+            self.batch_sizes.observe(len(texts))
+            try:
+                response = self.model.get_embeddings(texts)
+                vectors = {text: embedding.values for text, embedding in zip(texts, response)}
+                for text, future, _ in batch:
+                    future.set_result(vectors[text])
+            except Exception as e:
+                print(f"Error generating batched embeddings: {e}")
+                for _, future, _ in batch:
+                    future.set_exception(e)
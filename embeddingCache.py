@@ -0,0 +1,146 @@
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+EVICT_EVERY_PUTS = 100  # how often the SQLite store trims itself to max_entries
+
+
+def normalize_query(text):
+    """Cache key for a query: case-folded with whitespace collapsed."""
+    return " ".join(text.casefold().split())
+
+
+class EmbeddingCache:
+    """Bounded LRU cache of query embeddings with a time-to-live.
+
+    Entries live in memory; with a ``store`` (e.g. SqliteEmbeddingStore) misses
+    fall through to the shared store, so gunicorn workers and restarted
+    instances reuse each other's embeddings.
+    """
+
+    def __init__(self, max_entries=1024, ttl=24 * 3600, store=None, namespace=""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (created_at, vector)
+        self._lock = threading.Lock()
+
+    def _key(self, text):
+        return f"{self.namespace}:{normalize_query(text)}"
+
+    def get(self, text):
+        """Return the cached embedding for text, or None."""
+        key = self._key(text)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+        if self.store is not None:
+            stored = self.store.get(key, now - self.ttl)
+            if stored is not None:
+                created_at, vector = stored
+                self._remember(key, created_at, vector)
+                with self._lock:
+                    self.hits += 1
+                return vector
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, text, vector):
+        key = self._key(text)
+        created_at = time.time()
+        vector = list(vector)
+        self._remember(key, created_at, vector)
+        if self.store is not None:
+            self.store.put(key, created_at, vector)
+
+    def get_or_compute(self, text, compute):
+        """Return the cached embedding or compute, cache and return it."""
+        vector = self.get(text)
+        if vector is None:
+            vector = compute(text)
+            self.put(text, vector)
+        return vector
+
+    def _remember(self, key, created_at, vector):
+        with self._lock:
+            self._entries[key] = (created_at, vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SqliteEmbeddingStore:
+    """Embedding store in a SQLite file shared by all processes on an instance."""
+
+    def __init__(self, path, max_entries=100_000):
+        self.path = path
+        self.max_entries = max_entries
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, created_at REAL NOT NULL, last_used REAL NOT NULL, vector BLOB NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+
+    def get(self, key, not_before):
+        """Return (created_at, vector) if the key exists and is newer than not_before."""
+        try:
+            with self._lock, self._connection:
+                row = self._connection.execute(
+                    "SELECT created_at, vector FROM embeddings WHERE key = ? AND created_at >= ?",
+                    (key, not_before),
+                ).fetchone()
+                if row is None:
+                    return None
+                self._connection.execute("UPDATE embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error as e:
+            print(f"Error reading embedding cache: {e}")
+            return None
+        return row[0], array("d", row[1]).tolist()
+
+    def put(self, key, created_at, vector):
+        try:
+            with self._lock, self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, created_at, last_used, vector) VALUES (?, ?, ?, ?)",
+                    (key, created_at, created_at, array("d", vector).tobytes()),
+                )
+                self._puts += 1
+                if self._puts % EVICT_EVERY_PUTS:
+                    return
+                # Evict the least recently used rows beyond the size limit.
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE key IN ("
+                    "SELECT key FROM embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+        except sqlite3.Error as e:
+            print(f"Error writing embedding cache: {e}")
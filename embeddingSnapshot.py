@@ -0,0 +1,350 @@
+import json
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+
+# On-disk layout of an embedding snapshot (all integers little endian):
+#
+#   header      fixed HEADER_SIZE bytes, see HEADER_FORMAT
+#   sections    raw arrays, each aligned to ALIGNMENT bytes so they can be
+#               viewed straight out of the memory map
+#   directory   JSON with the section table (name, dtype, shape, offset,
+#               length) and free-form metadata
+#
+# The checksum is a CRC32 over everything after the header.
+MAGIC = b"QRSNAP\x00\x00"
+VERSION = 1
+HEADER_FORMAT = "<8sHHIQQQI"  # magic, version, dtype code, dimension, rows, directory offset, directory length, crc32
+HEADER_SIZE = 64
+ALIGNMENT = 64
+DTYPES = {"float32": 0, "float16": 1, "int8": 2}
+CHUNK_ROWS = 65_536
+CHECKSUM_CHUNK_BYTES = 16 * 1024 * 1024
+SOURCE_HASH_BYTES = 32  # SHA-256 of the document text per row ("source_hashes" section), zeros when unknown
+
+
+class SnapshotError(ValueError):
+    """Raised when a snapshot file is missing, corrupt or of an unknown version."""
+
+
+class StringColumn:
+    """Read-only sequence of strings stored as an offset array plus a UTF-8 blob.
+
+    Values are decoded on access, so opening a snapshot does not materialise
+    any Python strings.
+    """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self)))]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return bytes(self.blob[start:end]).decode("utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def quantize_int8(matrix):
+    """Symmetric per-row int8 quantisation, returns (codes, scales)."""
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class SnapshotWriter:
+    """Streams rows into a snapshot file.
+
+    Rows are staged in float32 temporary files so arbitrarily large tables can
+    be exported without holding them in memory; ``close`` converts the staged
+    matrix to the target dtype and writes the final file atomically.
+    """
+
+    def __init__(self, path, dimension, dtype="float32"):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported dtype {dtype} (expected one of {list(DTYPES)})")
+        self.path = path
+        self.dimension = dimension
+        self.dtype = dtype
+        self.rows = 0
+        self.meta = {}
+        self.sections = {}
+        staging_dir = os.path.dirname(os.path.abspath(path))
+        self._staging = tempfile.TemporaryFile(dir=staging_dir)
+        self._ids = tempfile.TemporaryFile(dir=staging_dir)
+        self._texts = tempfile.TemporaryFile(dir=staging_dir)
+        self._id_offsets = [0]
+        self._text_offsets = [0]
+
+    def add(self, document_id, text, embedding):
+        self.add_batch([document_id], [text], [embedding])
+
+    def add_batch(self, document_ids, texts, embeddings):
+        """Append a batch of rows."""
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.ndim != 2 or matrix.shape[1] != self.dimension:
+            raise ValueError(f"Expected embeddings of dimension {self.dimension}, got shape {matrix.shape}")
+        if not len(matrix) == len(document_ids) == len(texts):
+            raise ValueError("document_ids, texts and embeddings must have the same length")
+        self._staging.write(matrix.tobytes())
+        for document_id, text in zip(document_ids, texts):
+            encoded_id = str(document_id).encode("utf-8")
+            encoded_text = (text or "").encode("utf-8")
+            self._ids.write(encoded_id)
+            self._texts.write(encoded_text)
+            self._id_offsets.append(self._id_offsets[-1] + len(encoded_id))
+            self._text_offsets.append(self._text_offsets[-1] + len(encoded_text))
+        self.rows += len(matrix)
+
+    def staged_matrix(self):
+        """Read-only float32 view of the rows written so far."""
+        if not self.rows:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        self._staging.flush()
+        return np.memmap(self._staging, dtype=np.float32, mode="r", shape=(self.rows, self.dimension))
+
+    def staged_document_ids(self):
+        """The document_ids of the rows written so far, in row order."""
+        self._ids.flush()
+        self._ids.seek(0)
+        blob = np.frombuffer(self._ids.read(), dtype=np.uint8)
+        self._ids.seek(0, os.SEEK_END)
+        return StringColumn(np.asarray(self._id_offsets, dtype=np.uint64), blob)
+
+    def add_section(self, name, array):
+        """Store an extra named array (e.g. index structures) in the snapshot."""
+        self.sections[name] = np.ascontiguousarray(array)
+
+    def close(self):
+        """Write the snapshot to its final path and release the staging files."""
+        tmp_path = f"{self.path}.tmp"
+        directory = []
+        crc = 0
+        try:
+            with open(tmp_path, "wb") as out:
+                out.write(b"\x00" * HEADER_SIZE)
+
+                def write_section(name, dtype, shape, chunks):
+                    nonlocal crc
+                    padding = -out.tell() % ALIGNMENT
+                    out.write(b"\x00" * padding)
+                    crc = zlib.crc32(b"\x00" * padding, crc)
+                    offset = out.tell()
+                    for chunk in chunks:
+                        data = memoryview(np.ascontiguousarray(chunk)).cast("B")
+                        out.write(data)
+                        crc = zlib.crc32(data, crc)
+                    directory.append({
+                        "name": name, "dtype": dtype, "shape": list(shape),
+                        "offset": offset, "length": out.tell() - offset,
+                    })
+
+                scales = []
+                write_section("embeddings", self.dtype, (self.rows, self.dimension),
+                              self._converted_chunks(scales))
+                if self.dtype == "int8":
+                    write_section("scales", "float32", (self.rows,), scales)
+                write_section("id_offsets", "uint64", (self.rows + 1,), [np.asarray(self._id_offsets, dtype=np.uint64)])
+                write_section("ids", "uint8", (self._id_offsets[-1],), self._blob_chunks(self._ids))
+                write_section("text_offsets", "uint64", (self.rows + 1,), [np.asarray(self._text_offsets, dtype=np.uint64)])
+                write_section("texts", "uint8", (self._text_offsets[-1],), self._blob_chunks(self._texts))
+                for name, array in self.sections.items():
+                    write_section(name, array.dtype.str, array.shape, [array])
+
+                directory_bytes = json.dumps({"sections": directory, "meta": self.meta}).encode("utf-8")
+                directory_offset = out.tell()
+                out.write(directory_bytes)
+                crc = zlib.crc32(directory_bytes, crc)
+
+                out.seek(0)
+                out.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, DTYPES[self.dtype], self.dimension,
+                                      self.rows, directory_offset, len(directory_bytes), crc))
+            os.replace(tmp_path, self.path)
+        finally:
+            for handle in (self._staging, self._ids, self._texts):
+                handle.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _converted_chunks(self, scales):
+        """Yield the staged matrix in the target dtype, collecting int8 scales."""
+        matrix = self.staged_matrix()
+        for start in range(0, self.rows, CHUNK_ROWS):
+            chunk = np.asarray(matrix[start:start + CHUNK_ROWS])
+            if self.dtype == "float16":
+                yield chunk.astype(np.float16)
+            elif self.dtype == "int8":
+                codes, chunk_scales = quantize_int8(chunk)
+                scales.append(chunk_scales)
+                yield codes
+            else:
+                yield chunk
+
+    @staticmethod
+    def _blob_chunks(handle):
+        handle.flush()
+        handle.seek(0)
+        while True:
+            data = handle.read(CHECKSUM_CHUNK_BYTES)
+            if not data:
+                return
+            yield np.frombuffer(data, dtype=np.uint8)
+
+
+class Snapshot:
+    """Memory-mapped, read-only view of a snapshot file.
+
+    Opening a snapshot parses only the header and the JSON directory; every
+    array is a view into the page cache, so processes sharing the file also
+    share its memory.
+    """
+
+    def __init__(self, path, verify=True):
+        self.path = path
+        try:
+            self._raw = np.memmap(path, dtype=np.uint8, mode="r")
+        except (OSError, ValueError) as e:
+            raise SnapshotError(f"Cannot open snapshot {path}: {e}") from e
+        if len(self._raw) < HEADER_SIZE:
+            raise SnapshotError(f"{path} is too small to be a snapshot")
+
+        header = struct.unpack_from(HEADER_FORMAT, bytes(self._raw[:HEADER_SIZE]))
+        magic, version, dtype_code, self.dimension, self.rows, directory_offset, directory_length, crc = header
+        if magic != MAGIC:
+            raise SnapshotError(f"{path} is not an embedding snapshot")
+        if version != VERSION:
+            raise SnapshotError(f"{path} has snapshot version {version}, expected {VERSION}")
+        if verify and self.checksum() != crc:
+            raise SnapshotError(f"Checksum mismatch in {path}, the file is corrupt or truncated")
+
+        self.crc = crc
+        self.dtype = {code: name for name, code in DTYPES.items()}[dtype_code]
+        directory = json.loads(bytes(self._raw[directory_offset:directory_offset + directory_length]))
+        self.meta = directory["meta"]
+        self._sections = {section["name"]: section for section in directory["sections"]}
+        self.document_ids = StringColumn(self.section("id_offsets"), self.section("ids"))
+        self.texts = StringColumn(self.section("text_offsets"), self.section("texts"))
+
+    def __len__(self):
+        return self.rows
+
+    def checksum(self):
+        """CRC32 of everything after the header."""
+        crc = 0
+        for start in range(HEADER_SIZE, len(self._raw), CHECKSUM_CHUNK_BYTES):
+            crc = zlib.crc32(memoryview(self._raw[start:start + CHECKSUM_CHUNK_BYTES]), crc)
+        return crc
+
+    def has_section(self, name):
+        return name in self._sections
+
+    def section_names(self):
+        return list(self._sections)
+
+    def section(self, name):
+        """Zero-copy view of a named section."""
+        section = self._sections[name]
+        start = section["offset"]
+        data = self._raw[start:start + section["length"]]
+        return np.asarray(data).view(np.dtype(section["dtype"])).reshape(section["shape"])
+
+    @property
+    def embeddings(self):
+        """The stored embedding matrix in its on-disk dtype."""
+        return self.section("embeddings")
+
+    def float32_matrix(self):
+        """The embeddings as float32: zero-copy for float32 snapshots, decoded otherwise."""
+        embeddings = self.embeddings
+        if self.dtype == "float32":
+            return embeddings
+        if self.dtype == "int8":
+            return embeddings.astype(np.float32) * self.section("scales")[:, None]
+        return embeddings.astype(np.float32)
+
+
+def parse_embedding(value):
+    """BigQuery returns embeddings as arrays or packed float16 bytes, older rows hold JSON strings."""
+    if isinstance(value, bytes):
+        return np.frombuffer(value, dtype="<f2").astype(np.float32)
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def encode_source_hash(value):
+    """The hex source_hash of an embedding row as SOURCE_HASH_BYTES bytes (zeros when missing)."""
+    return bytes.fromhex(value) if value else bytes(SOURCE_HASH_BYTES)
+
+
+def decode_source_hash(row):
+    """Inverse of encode_source_hash for one row of the "source_hashes" section."""
+    value = bytes(row)
+    return value.hex() if any(value) else None
+
+
+def normalize_rows(matrix):
+    """L2-normalise the rows of a float32 matrix (zero rows stay zero)."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def export_from_bigquery(bq_client, table_id, path, dtype="float32", page_size=10_000,
+                         normalize=False, prepare=None, packed=False):
+    """Stream the embedding table into a snapshot file.
+
+    With ``normalize`` the rows are stored L2-normalised (for the cosine
+    metric). With ``packed`` the float16 ``embedding_f16`` column is
+    downloaded instead of the FLOAT64 array, a quarter of the bytes; rows
+    stored before that column existed fall back to the array. Rows are
+    exported in document and chunk order. ``prepare(writer)`` is called
+    before the file is finalised so callers can add sections computed from
+    ``writer.staged_matrix()``. The source_hash
+    of every row is stored too, so a serving process can tell which
+    documents changed after the export (see indexSegments.py).
+    """
+    if packed:
+        columns = "embedding_f16, IF(embedding_f16 IS NULL, embedding, NULL) AS embedding"
+    else:
+        columns = "NULL AS embedding_f16, embedding"
+    query = (f"SELECT document_id, text, {columns}, source_hash FROM `{table_id}` "
+             f"ORDER BY document_id, chunk_index")
+    writer = None
+    batch = ([], [], [])
+    source_hashes = bytearray()
+
+    def flush(batch):
+        matrix = np.asarray(batch[2], dtype=np.float32)
+        writer.add_batch(batch[0], batch[1], normalize_rows(matrix) if normalize else matrix)
+
+    for row in bq_client.query(query).result(page_size=page_size):
+        packed_embedding = row["embedding_f16"]
+        embedding = parse_embedding(packed_embedding if packed_embedding is not None else row["embedding"])
+        if writer is None:
+            writer = SnapshotWriter(path, len(embedding), dtype)
+        batch[0].append(row["document_id"])
+        batch[1].append(row["text"])
+        batch[2].append(embedding)
+        source_hashes += encode_source_hash(row["source_hash"])
+        if len(batch[0]) >= page_size:
+            flush(batch)
+            batch = ([], [], [])
+    if writer is None:
+        raise SnapshotError(f"{table_id} contains no embeddings to export")
+    if batch[0]:
+        flush(batch)
+    writer.meta.update(source_table=table_id, normalized=normalize)
+    writer.add_section("source_hashes", np.frombuffer(bytes(source_hashes), dtype=np.uint8).reshape(-1, SOURCE_HASH_BYTES))
+    if prepare is not None:
+        prepare(writer)
+    writer.close()
+    return writer.rows
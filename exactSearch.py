@@ -0,0 +1,173 @@
+import numpy as np
+
+from embeddingSnapshot import normalize_rows
+
+# Supported similarity metrics. Distances are always "lower is better" so the
+# results can be ordered the same way as the BigQuery query in app.py.
+METRICS = ("l2", "cosine", "dot")
+# Upper bound on the (queries x rows) score matrix computed in one BLAS call.
+MAX_SCORE_ELEMENTS = 32 * 1024 * 1024
+# Masks selecting at most this fraction of the rows are scored on a copy of
+# those rows; broader ones (such as the live rows) score every row in place.
+MASK_GATHER_FRACTION = 0.25
+
+
+def compute_distances(matrix, query, metric, norms=None):
+    """Distance from one query vector to every row of the matrix."""
+    return batch_distances(matrix, query[None, :], metric, norms)[0]
+
+
+def batch_distances(matrix, queries, metric, norms=None):
+    """Distances from every query (rows of ``queries``) to every matrix row.
+
+    One matrix multiply scores the whole batch. For the cosine metric the
+    matrix rows are expected to be normalised already.
+    """
+    scores = queries @ matrix.T
+    if metric == "l2":
+        if norms is None:
+            norms = np.einsum("ij,ij->i", matrix, matrix)
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        squared = norms[None, :] - 2.0 * scores + query_norms[:, None]
+        return np.sqrt(np.maximum(squared, 0.0))
+    if metric == "cosine":
+        query_norms = np.linalg.norm(queries, axis=1)
+        query_norms[query_norms == 0] = 1.0
+        return 1.0 - scores / query_norms[:, None]
+    if metric == "dot":
+        return -scores
+    raise ValueError(f"Unknown metric: {metric}")
+
+
+def selected_rows(mask):
+    """Row ids selected by a boolean mask, or None when it is cheaper to score every row and mask the distances."""
+    if np.count_nonzero(mask) > MASK_GATHER_FRACTION * len(mask):
+        return None
+    return np.flatnonzero(mask)
+
+
+def mask_distances(distances, mask):
+    """Give the rows not selected by ``mask`` an infinite distance, in place (the last axis is the row)."""
+    np.copyto(distances, np.inf, where=~mask)
+    return distances
+
+
+def top_k(distances, k):
+    """Indices of the k smallest distances, sorted ascending."""
+    return batch_top_k(distances[None, :], k)[0]
+
+
+def batch_top_k(distances, k):
+    """Per row, the column indices of the k smallest distances, sorted ascending.
+
+    ``np.argpartition`` selects the k candidates in linear time; only those k
+    are sorted.
+    """
+    k = min(k, distances.shape[1])
+    if k <= 0:
+        return np.empty((len(distances), 0), dtype=np.int64)
+    if k < distances.shape[1]:
+        candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(k), distances.shape).copy()
+    order = np.argsort(np.take_along_axis(distances, candidates, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def l2_distances_float64(matrix, rows, query):
+    """Direct float64 Euclidean distances, matching the BigQuery SQL."""
+    difference = np.asarray(matrix[rows], dtype=np.float64) - np.asarray(query, dtype=np.float64)
+    return np.sqrt(np.einsum("ij,ij->i", difference, difference))
+
+
+class ExactSearch:
+    """Exact (brute force) top-k search over a pre-normalised float32 matrix.
+
+    This is the ground truth for the approximate VectorIndex and the path for
+    scoring many query embeddings at once: a batch of queries costs one matrix
+    multiply instead of one BigQuery job per query.
+    """
+
+    def __init__(self, embeddings, document_ids, texts, metric="l2", normalized=False, norms=None):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric} (expected one of {METRICS})")
+        matrix = np.ascontiguousarray(np.asarray(embeddings, dtype=np.float32))
+        if metric == "cosine" and not normalized:
+            matrix = np.ascontiguousarray(normalize_rows(matrix))
+        if metric == "l2" and norms is None:
+            norms = np.einsum("ij,ij->i", matrix, matrix)
+        self.metric = metric
+        self.matrix = matrix
+        self.norms = norms if metric == "l2" else None
+        self.document_ids = document_ids
+        self.texts = texts
+
+    @classmethod
+    def from_index(cls, index):
+        """Share the (already normalised) matrix and side table of a VectorIndex."""
+        return cls(index.matrix, index.document_ids, index.texts, metric=index.metric,
+                   normalized=True, norms=index.norms)
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def search(self, query_embeddings, top_n, mask=None):
+        """Return (rows, distances), each shaped (number of queries, top_n).
+
+        For the l2 metric the returned distances are recomputed in float64
+        directly from the vectors, so they equal the values of the BigQuery
+        distance query. With a boolean ``mask`` only the selected rows are
+        returned.
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        if queries.shape[1] != self.matrix.shape[1]:
+            raise ValueError(f"Queries have dimension {queries.shape[1]}, index expects {self.matrix.shape[1]}")
+
+        matrix, norms, selected = self.matrix, self.norms, None
+        if mask is not None:
+            selected = selected_rows(mask)
+            if selected is not None:
+                matrix = self.matrix[selected]
+                norms = self.norms[selected] if self.norms is not None else None
+                mask = None
+
+        top_n = min(top_n, len(matrix) if mask is None else int(np.count_nonzero(mask)))
+        rows = np.empty((len(queries), top_n), dtype=np.int64)
+        distances = np.empty((len(queries), top_n), dtype=np.float64)
+        # Bound the score matrix so large batches do not allocate queries x corpus floats at once.
+        step = max(1, MAX_SCORE_ELEMENTS // max(1, len(matrix)))
+        for start in range(0, len(queries), step):
+            block = queries[start:start + step]
+            block_distances = batch_distances(matrix, block, self.metric, norms)
+            if mask is not None:
+                mask_distances(block_distances, mask)
+            block_rows = batch_top_k(block_distances, top_n)
+            rows[start:start + step] = block_rows if selected is None else selected[block_rows]
+            distances[start:start + step] = np.take_along_axis(block_distances, block_rows, axis=1)
+
+        if self.metric == "l2":
+            for i, query in enumerate(queries):
+                distances[i] = l2_distances_float64(self.matrix, rows[i], query)
+                order = np.argsort(distances[i], kind="stable")
+                rows[i], distances[i] = rows[i][order], distances[i][order]
+        return rows, distances
+
+    def top_matches(self, query_embeddings, top_n, mask=None):
+        """Per query, a list of dicts with document_id, text and distance."""
+        rows, distances = self.search(query_embeddings, top_n, mask)
+        return [
+            [
+                {"document_id": self.document_ids[row], "text": self.texts[row], "distance": float(distance)}
+                for row, distance in zip(query_rows, query_distances)
+            ]
+            for query_rows, query_distances in zip(rows, distances)
+        ]
+
+
+def recall_at_k(approximate_rows, exact_rows):
+    """Mean fraction of the exact top-k rows that the approximate search found."""
+    hits = [len(set(approx) & set(exact)) / max(1, len(exact))
+            for approx, exact in zip(approximate_rows, exact_rows)]
+    return float(np.mean(hits)) if hits else 0.0
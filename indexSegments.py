@@ -0,0 +1,311 @@
+import hashlib
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from embeddingSnapshot import SOURCE_HASH_BYTES, SnapshotWriter, decode_source_hash, encode_source_hash, normalize_rows
+from exactSearch import compute_distances, l2_distances_float64, top_k
+from metadataFilter import MetadataColumns
+from vectorIndex import MIN_ROWS_FOR_IVF, SAVE_BATCH_ROWS, VectorIndex, add_index_sections
+
+# Compact once the append segment holds this many rows, or this fraction of the base rows is deleted.
+COMPACT_ROWS = 20_000
+COMPACT_DELETED_FRACTION = 0.1
+# After a failed compaction the next one waits this long, doubling per failure up to the maximum.
+COMPACT_RETRY_SECONDS = 30.0
+COMPACT_MAX_RETRY_SECONDS = 3600.0
+
+# The passages of one added or changed document: ``texts`` and the ``matrix``
+# rows are in chunk order, ``record`` is its metadata (soort, datum, fracties) or None.
+DocumentRows = namedtuple("DocumentRows", "document_id source_hash texts matrix record")
+
+
+def stored_source_hashes(index):
+    """The "source_hashes" section of the snapshot behind an index, or None."""
+    snapshot = getattr(index, "snapshot", None)
+    if snapshot is None or not snapshot.has_section("source_hashes"):
+        return None
+    return snapshot.section("source_hashes")
+
+
+class AppendSegment:
+    """Passages of the documents added or replaced since the base snapshot.
+
+    The segment is small and searched exactly. It is immutable:
+    ``with_changes`` returns a new segment, so a query keeps searching the
+    segment it started with while updates are applied.
+    """
+
+    def __init__(self, dimension, metric, documents=None):
+        self.dimension = dimension
+        self.metric = metric
+        self.documents = documents or {}  # document_id -> DocumentRows, in the order they were added
+        parts = list(self.documents.values())
+        matrix = (np.concatenate([np.asarray(part.matrix, dtype=np.float32) for part in parts])
+                  if parts else np.empty((0, dimension), dtype=np.float32))
+        self.matrix = np.ascontiguousarray(normalize_rows(matrix) if metric == "cosine" else matrix)
+        self.norms = np.einsum("ij,ij->i", self.matrix, self.matrix) if metric == "l2" else None
+        self.document_ids = [part.document_id for part in parts for _ in part.texts]
+        self.texts = [text for part in parts for text in part.texts]
+        self.records = [part.record or {} for part in parts for _ in part.texts]
+        self.metadata = MetadataColumns.from_records(self.records)
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def with_changes(self, upserts=(), deletes=()):
+        """A new segment with the documents in ``deletes`` removed and ``upserts`` added or replaced."""
+        documents = dict(self.documents)
+        for document_id in deletes:
+            documents.pop(document_id, None)
+        for document in upserts:
+            documents.pop(document.document_id, None)
+            documents[document.document_id] = document
+        return AppendSegment(self.dimension, self.metric, documents)
+
+    def top_matches(self, query, top_n, filters=None):
+        """Exact search; returns rows as dicts with document_id, text and distance."""
+        if not len(self):
+            return []
+        distances = compute_distances(self.matrix, query, self.metric, self.norms)
+        if filters:
+            distances = np.where(self.metadata.mask(filters), distances, np.inf)
+        rows = top_k(distances, top_n)
+        rows = rows[np.isfinite(distances[rows])]
+        if self.metric == "l2":
+            distances = l2_distances_float64(self.matrix, rows, query)  # same precision as the base index
+        else:
+            distances = distances[rows]
+        return [
+            {"document_id": self.document_ids[row], "text": self.texts[row], "distance": float(distance)}
+            for row, distance in zip(rows, distances)
+        ]
+
+
+class IndexView:
+    """One consistent state of a SegmentedIndex.
+
+    ``base`` is the immutable snapshot index and ``search(query, top_n,
+    mask)`` its configured search (IVF, exact or quantised). ``live`` masks
+    out the base rows of deleted or replaced documents (None when there are
+    none). ``segment`` holds the rows added since.
+    """
+
+    def __init__(self, base, search, metadata, live, segment, generation, version):
+        self.base = base
+        self.search = search
+        self.metadata = metadata
+        self.live = live
+        self.segment = segment
+        self.generation = generation
+        self.version = version
+
+    @property
+    def deleted_rows(self):
+        return 0 if self.live is None else int(len(self.live) - np.count_nonzero(self.live))
+
+    def top_matches(self, query_embedding, top_n, filters=None):
+        """Top passages of the base and the segment, merged on distance."""
+        query = np.asarray(query_embedding, dtype=np.float32)
+        mask = self.metadata.mask(filters) if filters and self.metadata is not None else None
+        if self.live is not None:
+            mask = self.live if mask is None else mask & self.live
+        matches = self.search(query, top_n, mask) + self.segment.top_matches(query, top_n, filters)
+        return sorted(matches, key=lambda match: match["distance"])[:top_n]
+
+
+class SegmentedIndex:
+    """A base snapshot index plus an append segment, with background compaction.
+
+    ``apply(upserts, deletes)`` tombstones the base rows of the affected
+    documents and puts their new passages in the append segment. Every change
+    builds a new IndexView and replaces ``view`` with a single assignment;
+    queries read ``view`` once and never take a lock, so they neither block
+    on updates nor see half of one.
+
+    Changes are also kept in an append log. Once the segment reaches
+    ``compact_rows`` rows (or enough base rows are deleted), ``compact()``
+    writes the live base rows and the segment to a new snapshot in the
+    ``snapshots`` directory (a SharedSnapshots) in a background thread. The
+    file is named after its content, so workers that reach the same state
+    map one file. The log entries that arrived during compaction are
+    replayed on the new base, which is then swapped in. ``prepare(writer)``
+    can add sections (e.g. quantised codes) to the new snapshot;
+    ``on_swap(view)`` is called after every compaction. After a failed
+    compaction, ``apply`` waits with exponential backoff before it starts
+    the next one.
+    """
+
+    def __init__(self, base, make_search, snapshots, metadata=None, prepare=None, on_swap=None,
+                 compact_rows=COMPACT_ROWS, min_rows_for_ivf=MIN_ROWS_FOR_IVF):
+        self.make_search = make_search
+        self.snapshots = snapshots
+        self.prepare = prepare
+        self.on_swap = on_swap
+        self.compact_rows = compact_rows
+        self.min_rows_for_ivf = min_rows_for_ivf
+        self.compactions = 0
+        self.compaction_failures = 0  # consecutive; reset by a successful compaction
+        self._retry_at = 0.0  # monotonic time before which apply does not start a compaction
+        self.view = IndexView(base, make_search(base), metadata, None,
+                              AppendSegment(base.dimension, base.metric), None, 0)
+        self._log = []  # (upserts, deletes, generation) applied since the base of the current view
+        self._lock = threading.Lock()  # serialises writers; queries never take it
+        self._compacting = False
+        self._base_documents = (None, None)  # (base, document_id -> base rows)
+
+    def top_matches(self, query_embedding, top_n, filters=None):
+        return self.view.top_matches(query_embedding, top_n, filters)
+
+    def _document_rows(self, base):
+        """document_id -> row ids of a base index (computed once per base)."""
+        cached_base, rows = self._base_documents
+        if cached_base is base:
+            return rows
+        rows = {}
+        for row, document_id in enumerate(base.document_ids):
+            rows.setdefault(document_id, []).append(row)
+        rows = {document_id: np.asarray(ids, dtype=np.int64) for document_id, ids in rows.items()}
+        self._base_documents = (base, rows)
+        return rows
+
+    def source_hashes(self):
+        """document_id -> source_hash of every searchable document (None when the snapshot does not store it)."""
+        view = self.view
+        base = view.base
+        stored = stored_source_hashes(base)
+        hashes = {}
+        for document_id, rows in self._document_rows(base).items():
+            if view.live is None or view.live[rows[0]]:
+                hashes[document_id] = decode_source_hash(stored[rows[0]]) if stored is not None else None
+        for document_id, document in view.segment.documents.items():
+            hashes[document_id] = document.source_hash
+        return hashes
+
+    def _replay(self, view, upserts, deletes, generation):
+        """A new view with the changes applied on top of ``view``."""
+        rows_by_document = self._document_rows(view.base)
+        affected = [rows_by_document[document_id] for document_id in
+                    list(deletes) + [document.document_id for document in upserts] if document_id in rows_by_document]
+        live = view.live
+        if affected:
+            live = np.ones(len(view.base), dtype=bool) if live is None else live.copy()
+            live[np.concatenate(affected)] = False
+        segment = view.segment.with_changes(upserts, deletes)
+        return IndexView(view.base, view.search, view.metadata, live, segment,
+                         generation if generation is not None else view.generation, view.version + 1)
+
+    def apply(self, upserts=(), deletes=(), generation=None):
+        """Add or replace the documents in ``upserts`` and delete those in ``deletes``; returns the new view."""
+        upserts, deletes = list(upserts), list(deletes)
+        for document in upserts:
+            if np.asarray(document.matrix).shape[1:] != (self.view.base.dimension,):
+                raise ValueError(f"{document.document_id}: expected embeddings of dimension {self.view.base.dimension}")
+        with self._lock:
+            self._log.append((upserts, deletes, generation))
+            self.view = self._replay(self.view, upserts, deletes, generation)
+            view = self.view
+        if self.needs_compaction(view) and time.monotonic() >= self._retry_at:
+            self.compact_in_background()
+        return view
+
+    def needs_compaction(self, view=None):
+        view = view or self.view
+        return (len(view.segment) >= self.compact_rows
+                or view.deleted_rows > COMPACT_DELETED_FRACTION * len(view.base))
+
+    def compact_in_background(self):
+        thread = threading.Thread(target=self.compact, name="index-compaction", daemon=True)
+        thread.start()
+        return thread
+
+    def compact(self):
+        """Merge the live base rows and the segment into a new snapshot and swap it in; False if already running."""
+        with self._lock:
+            if self._compacting:
+                return False
+            self._compacting = True
+            view, position = self.view, len(self._log)
+        try:
+            started = time.monotonic()
+            path = self.snapshots.publish(f"compacted-{self._content_key(view)}.snapshot",
+                                          lambda target: self._write_snapshot(view, target))
+            base = VectorIndex.load(path, metric=view.base.metric, nprobe=view.base.nprobe, verify=False)
+            compacted = IndexView(base, self.make_search(base), MetadataColumns.from_snapshot(base.snapshot), None,
+                                  AppendSegment(base.dimension, base.metric), view.generation, view.version)
+            with self._lock:
+                for upserts, deletes, generation in self._log[position:]:
+                    compacted = self._replay(compacted, upserts, deletes, generation)
+                del self._log[:position]
+                compacted.version = self.view.version + 1
+                self.view = compacted
+                self.compactions += 1
+            print(f"Compacted index: {len(base)} rows, {len(compacted.segment)} in the new segment "
+                  f"({time.monotonic() - started:.1f}s)")
+            if self.on_swap is not None:
+                self.on_swap(compacted)
+            if view.base.snapshot.path != path:
+                # Queries still on the old view keep their memory map of a removed file.
+                self.snapshots.unpin(view.base.snapshot.path)
+                self.snapshots.remove_unused()
+            self.compaction_failures, self._retry_at = 0, 0.0
+            return True
+        except Exception:
+            self.compaction_failures += 1
+            delay = min(COMPACT_MAX_RETRY_SECONDS, COMPACT_RETRY_SECONDS * 2 ** (self.compaction_failures - 1))
+            self._retry_at = time.monotonic() + delay
+            print(f"Compaction failed ({self.compaction_failures} in a row), next attempt in {delay:.0f}s")
+            raise
+        finally:
+            self._compacting = False
+
+    @staticmethod
+    def _content_key(view):
+        """Hash of the rows a compaction of ``view`` writes."""
+        digest = hashlib.sha256(f"{view.base.snapshot.crc}:{view.base.metric}".encode())
+        if view.live is not None:
+            digest.update(np.packbits(view.live).tobytes())
+        for document_id in sorted(view.segment.documents):
+            document = view.segment.documents[document_id]
+            digest.update(repr((document_id, document.source_hash, document.texts, document.record)).encode())
+            digest.update(np.asarray(document.matrix, dtype=np.float32).tobytes())
+        return digest.hexdigest()[:16]
+
+    def _write_snapshot(self, view, path):
+        base, segment = view.base, view.segment
+        live_rows = np.arange(len(base)) if view.live is None else np.flatnonzero(view.live)
+        writer = SnapshotWriter(path, base.dimension)
+        stored = stored_source_hashes(base)
+        source_hashes = bytearray()
+        for start in range(0, len(live_rows), SAVE_BATCH_ROWS):
+            rows = live_rows[start:start + SAVE_BATCH_ROWS]
+            writer.add_batch([base.document_ids[row] for row in rows], [base.texts[row] for row in rows],
+                             np.asarray(base.matrix[rows]))
+            source_hashes += (stored[rows].tobytes() if stored is not None
+                              else bytes(SOURCE_HASH_BYTES * len(rows)))
+        for document in segment.documents.values():
+            source_hashes += encode_source_hash(document.source_hash) * len(document.texts)
+        if len(segment):
+            writer.add_batch(segment.document_ids, segment.texts, segment.matrix)
+        add_index_sections(writer, base.metric, base.nprobe, self.min_rows_for_ivf)
+        writer.add_section("source_hashes", np.frombuffer(bytes(source_hashes), dtype=np.uint8)
+                           .reshape(-1, SOURCE_HASH_BYTES))
+        if view.metadata is not None:
+            MetadataColumns.from_records(view.metadata.to_records(live_rows) + segment.records).add_sections(writer)
+        if self.prepare is not None:
+            self.prepare(writer)
+        writer.close()
+
+    def stats(self):
+        view = self.view
+        return {
+            "base_rows": len(view.base),
+            "deleted_rows": view.deleted_rows,
+            "segment_rows": len(view.segment),
+            "segment_documents": len(view.segment.documents),
+            "version": view.version,
+            "compactions": self.compactions,
+            "compaction_failures": self.compaction_failures,
+        }
@@ -0,0 +1,267 @@
+import itertools
+import re
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+import numpy as np
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60  # reciprocal rank fusion constant; larger values flatten the rank weights
+MAX_TERM_FREQUENCY = 255  # term frequencies are stored as single bytes
+DECODED_CACHE_TERMS = 512  # decoded posting lists kept for frequent query terms
+_VERSIONS = itertools.count(1)  # shared by all indexes, so a rebuilt index never repeats a version
+
+# Kamerstuk and motion numbers ("36.410", "21501-20", "2024Z01234") are kept
+# whole as well as split, party names keep their hyphenated form ("GL-PvdA").
+_TOKEN = re.compile(r"\d+(?:[.\-/]\d+)*[a-z]*\d*|\w+(?:-\w+)*")
+STOPWORDS = frozenset("""
+aan al alle als ben bij dan dat de der deze die dit doch doen door dus een en er ge geen had heb hebben
+heeft het hier hij hoe hun ik in is ja je kan kon maar me meer men met mij mijn na naar niet niets nog nu
+of om omdat ons ook op over te tegen toch toen tot u uit uw van veel voor want waren was wat we wel
+werd wie wij wordt worden zal ze zei zich zij zijn zo zou
+""".split())
+
+
+def _fold(text):
+    """Case-fold and strip accents ("financiële" -> "financiele")."""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def _stem(word):
+    """Light Dutch suffix stripping for plurals and inflections (moties -> moti, kosten -> kost)."""
+    if len(word) <= 4 or not word.isalpha():
+        return word
+    for suffix in ("heden", "en", "es", "s", "e"):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)] + ("heid" if suffix == "heden" else "")
+            break
+    if len(word) > 3 and word[-1] == word[-2] and word[-1] not in "aeiou":
+        word = word[:-1]  # undouble: "motten" -> "mott" -> "mot"
+    return word
+
+
+def tokenize(text):
+    """Dutch search terms of a text: folded, stopwords removed, stemmed, compounds and numbers also split."""
+    terms = []
+    for token in _TOKEN.findall(_fold(text or "")):
+        if token in STOPWORDS:
+            continue
+        if any(c in token for c in ".-/"):
+            terms.append(re.sub(r"[.]", "", token))  # "36.410" -> "36410", "gl-pvda" stays
+            terms.extend(_stem(part) for part in re.split(r"[.\-/]", token) if part and part not in STOPWORDS)
+        else:
+            terms.append(_stem(token))
+    return terms
+
+
+def encode_varints(values, out):
+    """Append unsigned integers to a bytearray, 7 bits per byte, high bit = more bytes follow."""
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+
+def decode_varints(buffer):
+    """Decode a buffer of varints into a uint64 array (vectorised, no Python loop per value)."""
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if not len(data):
+        return np.empty(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    group_start = np.repeat(starts, ends - starts + 1)
+    shifts = (7 * (np.arange(len(data)) - group_start)).astype(np.uint64)
+    return np.add.reduceat((data & 0x7F).astype(np.uint64) << shifts, starts)
+
+
+class _Postings:
+    __slots__ = ("deltas", "frequencies", "last", "count")
+
+    def __init__(self):
+        self.deltas = bytearray()  # varint gaps between row ids
+        self.frequencies = bytearray()  # one byte per posting
+        self.last = 0
+        self.count = 0
+
+
+class LexicalIndex:
+    """In-process BM25 index over passages with varint delta-compressed postings.
+
+    Rows are appended with ``add``; because row ids only grow, new postings
+    are appended to the compressed lists without rebuilding anything.
+    ``remove`` hides the rows of a document (changed or deleted text).
+    ``version`` changes with every ``add`` and ``remove``.
+
+    ``add_base`` indexes the rows of ``base`` (e.g. a memory-mapped snapshot
+    index) as the first rows. Their document_ids and texts are read from
+    ``base`` when a match is returned, so several processes indexing the same
+    snapshot do not each hold a copy of its passages.
+    """
+
+    def __init__(self, k1=BM25_K1, b=BM25_B, base=None):
+        self.k1 = k1
+        self.b = b
+        self.base = base
+        self.base_rows = 0  # rows indexed from base; they come before the rows below
+        self.document_ids = []  # rows added with add()
+        self.texts = []
+        self.lengths = array("I")
+        self.total_length = 0
+        self.postings = {}
+        self.removed = set()  # row ids hidden by remove()
+        self.source_hashes = {}  # document_id -> source_hash of the indexed text, when known
+        self._rows_by_document = {}
+        self._decoded = OrderedDict()  # term -> (posting count, rows, frequencies)
+        self._length_norms = None  # per-row BM25 length normalisation, recomputed when rows are added
+        self._lock = threading.RLock()
+        self.version = next(_VERSIONS)
+
+    def __len__(self):
+        return self.rows - len(self.removed)
+
+    @property
+    def rows(self):
+        return self.base_rows + len(self.document_ids)
+
+    def add_base(self, source_hashes=None):
+        """Index every row of ``base`` in order, before any ``add``; ``source_hashes`` yields one per row."""
+        if self.rows:
+            raise ValueError("The base rows have to be indexed before any other row")
+        hashes = source_hashes if source_hashes is not None else itertools.repeat(None)
+        for document_id, text, source_hash in zip(self.base.document_ids, self.base.texts, hashes):
+            self._index(document_id, text, source_hash, stored=False)
+
+    def add(self, document_id, text, source_hash=None):
+        """Index one passage; returns its row id."""
+        return self._index(document_id, text, source_hash, stored=True)
+
+    def _index(self, document_id, text, source_hash, stored):
+        terms = tokenize(text)
+        counts = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        with self._lock:
+            row = self.rows
+            if stored:
+                self.document_ids.append(document_id)
+                self.texts.append(text)
+            else:
+                self.base_rows += 1
+            self.lengths.append(len(terms))
+            self.total_length += len(terms)
+            self._rows_by_document.setdefault(document_id, []).append(row)
+            if source_hash is not None:
+                self.source_hashes[document_id] = source_hash
+            for term, count in counts.items():
+                postings = self.postings.get(term)
+                if postings is None:
+                    postings = self.postings[term] = _Postings()
+                encode_varints((row - postings.last,), postings.deltas)
+                postings.frequencies.append(min(count, MAX_TERM_FREQUENCY))
+                postings.last = row
+                postings.count += 1
+            self.version = next(_VERSIONS)
+            return row
+
+    def remove(self, document_id):
+        """Hide every passage of a document from search results."""
+        with self._lock:
+            self.removed.update(self._rows_by_document.pop(document_id, ()))
+            self.source_hashes.pop(document_id, None)
+            self.version = next(_VERSIONS)
+
+    def document_id(self, row):
+        return self.base.document_ids[row] if row < self.base_rows else self.document_ids[row - self.base_rows]
+
+    def text(self, row):
+        return self.base.texts[row] if row < self.base_rows else self.texts[row - self.base_rows]
+
+    def indexed_documents(self):
+        with self._lock:
+            return set(self._rows_by_document)
+
+    def _decode(self, term, postings):
+        """Decoded (rows, frequencies) of a term, cached until the term gets new postings."""
+        cached = self._decoded.get(term)
+        if cached is not None and cached[0] == postings.count:
+            self._decoded.move_to_end(term)
+            return cached[1], cached[2]
+        rows = np.cumsum(decode_varints(bytes(postings.deltas))).astype(np.int64)
+        frequencies = np.frombuffer(bytes(postings.frequencies), dtype=np.uint8).astype(np.float32)
+        self._decoded[term] = (postings.count, rows, frequencies)
+        if len(self._decoded) > DECODED_CACHE_TERMS:
+            self._decoded.popitem(last=False)
+        return rows, frequencies
+
+    def _norms(self, n_rows):
+        if self._length_norms is None or len(self._length_norms) != n_rows:
+            lengths = np.frombuffer(self.lengths, dtype=np.uint32).astype(np.float32)
+            average_length = self.total_length / n_rows or 1.0
+            self._length_norms = self.k1 * (1.0 - self.b + self.b * lengths / average_length)
+        return self._length_norms
+
+    def search(self, query_text, top_n, row_mask=None):
+        """Return (row ids, BM25 scores) of the best matching passages, best first.
+
+        ``row_mask`` (booleans for the first rows) excludes rows before the
+        top-k selection; rows beyond the end of the mask are excluded too.
+        """
+        terms = set(tokenize(query_text))
+        with self._lock:
+            n_rows = self.rows
+            if not n_rows:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            # Decode under the lock so that concurrent adds cannot change a list mid-query.
+            matched = [
+                (postings.count, *self._decode(term, postings))
+                for term, postings in ((term, self.postings.get(term)) for term in terms) if postings is not None
+            ]
+            norms = self._norms(n_rows)
+            removed = np.fromiter(self.removed, dtype=np.int64) if self.removed else None
+        if not matched:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        scores = np.zeros(n_rows, dtype=np.float32)
+        for count, rows, frequencies in matched:
+            idf = np.float32(np.log1p((n_rows - count + 0.5) / (count + 0.5)))
+            scores[rows] += idf * frequencies * (self.k1 + 1.0) / (frequencies + norms[rows])
+        if removed is not None:
+            scores[removed] = 0.0
+        if row_mask is not None:
+            scores[len(row_mask):] = 0.0
+            scores[:len(row_mask)][~row_mask[:n_rows]] = 0.0
+
+        hits = np.flatnonzero(scores)
+        if len(hits) > top_n:
+            hits = hits[np.argpartition(-scores[hits], top_n - 1)[:top_n]]
+        hits = hits[np.argsort(-scores[hits], kind="stable")]
+        return hits, scores[hits]
+
+    def top_matches(self, query_text, top_n, row_mask=None):
+        """Search and return rows as dicts with document_id, text and score."""
+        rows, scores = self.search(query_text, top_n, row_mask)
+        return [
+            {"document_id": self.document_id(row), "text": self.text(row), "score": float(score)}
+            for row, score in zip(rows, scores)
+        ]
+
+
+def reciprocal_rank_fusion(ranked_lists, top_n, k=RRF_K):
+    """Fuse ranked lists of match dicts on (document_id, text); each list contributes 1 / (k + rank).
+
+    The fused dicts keep the fields of the first list that contained the
+    passage (e.g. the vector distance) and get an ``rrf_score``.
+    """
+    fused = {}
+    for matches in ranked_lists:
+        for rank, match in enumerate(matches, start=1):
+            key = (match["document_id"], match["text"])
+            if key not in fused:
+                fused[key] = dict(match, rrf_score=0.0)
+            fused[key]["rrf_score"] += 1.0 / (k + rank)
+    return sorted(fused.values(), key=lambda match: match["rrf_score"], reverse=True)[:top_n]
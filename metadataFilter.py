@@ -0,0 +1,176 @@
+import datetime
+
+import numpy as np
+
+# Optional /query body fields: {"filters": {"soort": "Motie", "fractie": ["VVD", "SP"],
+# "datum_van": "2023-01-01", "datum_tot": "2023-12-31"}}. Values of one field are OR-ed,
+# fields are AND-ed.
+FILTER_FIELDS = ("soort", "fractie", "datum_van", "datum_tot")
+MISSING_DAY = np.iinfo(np.int32).min  # rows without a date never pass a date filter
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def _day_number(value):
+    """Days since 1970-01-01 of an ISO date or timestamp string (None when missing)."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        value = value.isoformat()
+    return (datetime.date.fromisoformat(str(value)[:10]) - EPOCH).days
+
+
+def parse_filters(data):
+    """Validate the ``filters`` object of a request; returns None when nothing is filtered.
+
+    Raises ValueError with a message suitable for a 400 response.
+    """
+    if not data:
+        return None
+    if not isinstance(data, dict):
+        raise ValueError("filters must be an object")
+    unknown = set(data) - set(FILTER_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown filter fields: {sorted(unknown)} (expected {list(FILTER_FIELDS)})")
+    filters = {}
+    for field in ("soort", "fractie"):
+        values = data.get(field)
+        if values:
+            values = [values] if isinstance(values, str) else values
+            if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+                raise ValueError(f"{field} must be a string or a list of strings")
+            filters[field] = values
+    for field in ("datum_van", "datum_tot"):
+        if data.get(field):
+            try:
+                filters[field] = _day_number(data[field])
+            except ValueError:
+                raise ValueError(f"{field} must be an ISO date (YYYY-MM-DD)") from None
+    return filters or None
+
+
+class MetadataColumns:
+    """Per-row document metadata stored as columns next to the vectors.
+
+    * ``soort``: one uint16 code per row into a vocabulary of document types
+    * ``datum``: int32 days since 1970-01-01
+    * ``fractie``: one bitmap (bit per row) per party, since a document can
+      have several
+
+    ``mask(filters)`` turns a filter into a boolean row mask with vectorised
+    operations only, so it can be applied before the vector search.
+    """
+
+    def __init__(self, soort_codes, soort_values, days, fractie_bitmaps, fractie_values):
+        self.soort_codes = soort_codes
+        self.soort_values = list(soort_values)
+        self.days = days
+        self.fractie_bitmaps = fractie_bitmaps
+        self.fractie_values = list(fractie_values)
+        self.rows = len(days)
+
+    @classmethod
+    def from_records(cls, records):
+        """Build the columns from one dict per row with soort, datum and fracties."""
+        soort_values, fractie_values = {}, {}
+        soort_codes = np.empty(len(records), dtype=np.uint16)
+        days = np.full(len(records), MISSING_DAY, dtype=np.int32)
+        members = []  # (fractie code, row)
+        for row, record in enumerate(records):
+            soort = record.get("soort") or ""
+            soort_codes[row] = soort_values.setdefault(soort, len(soort_values))
+            day = _day_number(record.get("datum"))
+            if day is not None:
+                days[row] = day
+            for fractie in record.get("fracties") or ():
+                members.append((fractie_values.setdefault(fractie, len(fractie_values)), row))
+        bits = np.zeros((len(fractie_values), len(records)), dtype=bool)
+        for code, row in members:
+            bits[code, row] = True
+        bitmaps = np.packbits(bits, axis=1, bitorder="little")
+        return cls(soort_codes, soort_values, days, bitmaps, fractie_values)
+
+    def add_sections(self, writer):
+        """Store the columns in a snapshot being written."""
+        writer.add_section("meta.soort", self.soort_codes)
+        writer.add_section("meta.datum", self.days)
+        writer.add_section("meta.fractie", self.fractie_bitmaps)
+        writer.meta["metadata"] = {"soort": self.soort_values, "fractie": self.fractie_values}
+
+    def to_records(self, rows):
+        """The metadata of the given rows as dicts for from_records (used when rows are copied to a new snapshot)."""
+        rows = np.asarray(rows, dtype=np.int64)
+        members = np.unpackbits(self.fractie_bitmaps, axis=1, count=self.rows, bitorder="little")[:, rows].astype(bool)
+        records = []
+        for position, row in enumerate(rows):
+            day = int(self.days[row])
+            records.append({
+                "soort": self.soort_values[self.soort_codes[row]],
+                "datum": None if day == MISSING_DAY else (EPOCH + datetime.timedelta(days=day)).isoformat(),
+                "fracties": [self.fractie_values[code] for code in np.flatnonzero(members[:, position])],
+            })
+        return records
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Columns stored in a snapshot, or None for snapshots exported without metadata."""
+        if not snapshot.has_section("meta.soort"):
+            return None
+        vocabularies = snapshot.meta["metadata"]
+        return cls(snapshot.section("meta.soort"), vocabularies["soort"], snapshot.section("meta.datum"),
+                   snapshot.section("meta.fractie"), vocabularies["fractie"])
+
+    @staticmethod
+    def _codes(vocabulary, values):
+        wanted = {value.casefold() for value in values}
+        return [code for code, value in enumerate(vocabulary) if value.casefold() in wanted]
+
+    def mask(self, filters):
+        """Boolean array marking the rows that pass the filters (None means no filter)."""
+        if not filters:
+            return None
+        mask = np.ones(self.rows, dtype=bool)
+        if "soort" in filters:
+            mask &= np.isin(self.soort_codes, self._codes(self.soort_values, filters["soort"]))
+        if "datum_van" in filters:
+            mask &= self.days >= filters["datum_van"]
+        if "datum_tot" in filters:
+            mask &= (self.days <= filters["datum_tot"]) & (self.days != MISSING_DAY)
+        if "fractie" in filters:
+            codes = self._codes(self.fractie_values, filters["fractie"])
+            if codes:
+                merged = np.bitwise_or.reduce(self.fractie_bitmaps[codes], axis=0)
+                mask &= np.unpackbits(merged, count=self.rows, bitorder="little").astype(bool)
+            else:
+                mask[:] = False
+        return mask
+
+
+def fetch_metadata(bq_client, documents_table_id, document_ids=None):
+    """Latest soort, datum and fracties per document id (all documents, or only ``document_ids``)."""
+    from google.cloud import bigquery
+
+    query = f"""
+    SELECT Id AS document_id, Soort AS soort, CAST(Datum AS STRING) AS datum, {{fracties}} AS fracties
+    FROM `{documents_table_id}`
+    WHERE {"Id IN UNNEST(@ids)" if document_ids is not None else "true"}
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY Id ORDER BY GewijzigdOp DESC) = 1  -- latest version
+    """
+    job_config = None
+    if document_ids is not None:
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("ids", "STRING", list(document_ids))]
+        )
+    try:
+        rows = bq_client.query(query.format(fracties="Fracties"), job_config=job_config).result()
+    except Exception as e:
+        # Documents ingested before the Fracties column existed.
+        print(f"Reading metadata without parties: {e}")
+        rows = bq_client.query(query.format(fracties="ARRAY<STRING>[]"), job_config=job_config).result()
+    return {row["document_id"]: dict(row.items()) for row in rows}
+
+
+def export_metadata(bq_client, documents_table_id, writer):
+    """Look up the metadata of the snapshot rows in the documents table and store it as sections."""
+    by_document = fetch_metadata(bq_client, documents_table_id)
+    records = [by_document.get(document_id, {}) for document_id in writer.staged_document_ids()]
+    MetadataColumns.from_records(records).add_sections(writer)
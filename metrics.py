@@ -0,0 +1,231 @@
+import bisect
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Default histogram buckets (seconds), from 1 ms to 30 s.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = {}  # (name, labels) -> Histogram or Counter
+_collectors = []  # callbacks returning (name, labels, value) gauges at render time
+_registry_lock = threading.Lock()
+
+
+class Histogram:
+    """Cumulative bucketed histogram with approximate percentiles."""
+
+    def __init__(self, name, description="", buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.total += value
+            self.count += 1
+
+    def percentile(self, fraction):
+        """Estimate a percentile (0..1) by linear interpolation inside its bucket."""
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = fraction * self.count
+            seen = 0
+            for i, bucket_count in enumerate(self.counts):
+                if seen + bucket_count >= rank and bucket_count:
+                    lower = self.buckets[i - 1] if i > 0 else 0.0
+                    upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                    return lower + (upper - lower) * (rank - seen) / bucket_count
+                seen += bucket_count
+            return self.buckets[-1]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+        }
+
+    def render(self):
+        """Prometheus exposition lines (cumulative ``_bucket`` counts, ``_sum`` and ``_count``)."""
+        with self._lock:
+            counts, total, count = list(self.counts), self.total, self.count
+        lines, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels + (('le', bound),))} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labels)} {total:.6f}")
+        lines.append(f"{self.name}_count{_format_labels(self.labels)} {count}")
+        return lines
+
+
+class Counter:
+    """Monotonic counter."""
+
+    def __init__(self, name, description="", labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        return [f"{self.name}{_format_labels(self.labels)} {self.value}"]
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def _register(cls, name, description, labels, **kwargs):
+    key = (name, tuple(sorted(labels.items())))
+    with _registry_lock:
+        if key not in _registry:
+            _registry[key] = cls(name, description, labels=key[1], **kwargs)
+        return _registry[key]
+
+
+def histogram(name, description="", buckets=LATENCY_BUCKETS, **labels):
+    """Return the registered histogram with this name and labels, creating it if needed."""
+    return _register(Histogram, name, description, labels, buckets=buckets)
+
+
+def counter(name, description="", **labels):
+    """Return the registered counter with this name and labels, creating it if needed."""
+    return _register(Counter, name, description, labels)
+
+
+def collect(callback):
+    """Register a callback returning ``(name, labels dict, value)`` gauges, read on every render."""
+    with _registry_lock:
+        _collectors.append(callback)
+
+
+def memory_gauges():
+    """``process_memory_bytes`` gauges from /proc/self/smaps_rollup (Linux only).
+
+    ``shared`` counts pages also mapped by other processes (e.g. snapshot
+    pages in the page cache), ``private`` the pages of this process alone and
+    ``proportional`` (PSS) splits shared pages evenly between their users.
+    """
+    try:
+        with open("/proc/self/smaps_rollup") as handle:
+            fields = {line.split(":")[0]: int(line.split()[1]) * 1024 for line in handle if line.endswith("kB\n")}
+    except OSError:
+        return
+    yield "process_memory_bytes", {"kind": "resident"}, fields.get("Rss", 0)
+    yield "process_memory_bytes", {"kind": "proportional"}, fields.get("Pss", 0)
+    yield "process_memory_bytes", {"kind": "shared"}, fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0)
+    yield "process_memory_bytes", {"kind": "private"}, fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+
+
+def all_metrics():
+    with _registry_lock:
+        return dict(_registry)
+
+
+def summaries():
+    """p50/p95/p99 of every histogram, keyed by name and labels."""
+    return {
+        f"{metric.name}{_format_labels(metric.labels)}": metric.summary()
+        for metric in all_metrics().values() if isinstance(metric, Histogram)
+    }
+
+
+def render_prometheus():
+    """Every registered metric in the Prometheus text format (per process)."""
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda metric: (metric.name, metric.labels))
+        collectors = list(_collectors)
+    lines, described = [], set()
+    for metric in metrics:
+        if metric.name not in described:
+            described.add(metric.name)
+            kind = "histogram" if isinstance(metric, Histogram) else "counter"
+            lines += [f"# HELP {metric.name} {metric.description or metric.name}", f"# TYPE {metric.name} {kind}"]
+        lines += metric.render()
+    gauges = {}
+    for callback in collectors:
+        try:
+            for name, labels, value in callback():
+                gauges.setdefault(name, []).append(f"{name}{_format_labels(tuple(sorted(labels.items())))} {value}")
+        except Exception as e:
+            print(f"Error collecting metrics: {e}")
+    for name, series in sorted(gauges.items()):
+        lines += [f"# TYPE {name} gauge"] + series
+    return "\n".join(lines) + "\n"
+
+
+class QueryTrace:
+    """Stage timings of one request.
+
+    Each finished stage is observed in the ``stage_metric`` histogram with a
+    ``stage`` label. ``finish()`` adds the total and, when ``log`` is set,
+    prints the whole trace as one JSON line with its ``trace_id``.
+    """
+
+    def __init__(self, stage_metric, trace_id=None, log=False):
+        self.stage_metric = stage_metric
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.log = log
+        self.started_at = time.perf_counter()
+        self.stages = {}
+
+    def record(self, stage, seconds):
+        self.stages[stage] = round(seconds, 4)
+        histogram(self.stage_metric, "Query latency per stage (seconds)", stage=stage).observe(seconds)
+
+    @contextmanager
+    def stage(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started_at)
+
+    def finish(self, **fields):
+        self.record("total", time.perf_counter() - self.started_at)
+        if self.log:
+            print(json.dumps({"trace_id": self.trace_id, "stages": self.stages, **fields}, default=str))
+
+
+class StartupReport:
+    """Durations of the startup steps of a process, in the order they finished."""
+
+    def __init__(self):
+        self.steps = {}
+
+    def record(self, step, seconds):
+        self.steps[step] = round(seconds, 4)
+
+    @contextmanager
+    def step(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started_at)
+
+    def report(self):
+        return dict(self.steps, total=round(sum(self.steps.values()), 4))
+
+    def gauges(self):
+        """``startup_step_seconds`` gauges for collect()."""
+        for step, seconds in list(self.steps.items()):
+            yield "startup_step_seconds", {"step": step}, seconds
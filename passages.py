@@ -0,0 +1,65 @@
+import math
+import re
+
+# Same estimate as source/embed/chunking.py: ~1.4 model tokens per Dutch word or punctuation mark.
+TOKENS_PER_PIECE = 1.4
+TOKEN_PIECE = re.compile(r"\w+|[^\w\s]")
+
+
+def estimate_tokens(text):
+    """Approximate model token count of a text."""
+    return math.ceil(len(TOKEN_PIECE.findall(text or "")) * TOKENS_PER_PIECE)
+
+
+class Match:
+    """One retrieved passage.
+
+    A slotted row instead of a DataFrame row: retrieval returns a handful of
+    these per query, so building them costs a few object allocations. Fields
+    can also be read as ``match["text"]`` and ``dict(match)`` gives a dict.
+    """
+
+    __slots__ = ("document_id", "text", "distance")
+
+    def __init__(self, document_id, text, distance=None):
+        self.document_id = document_id
+        self.text = text
+        self.distance = distance  # None for passages found only by BM25
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def keys(self):
+        return self.__slots__
+
+    def __repr__(self):
+        return f"Match({self.document_id!r}, {self.text[:40]!r}, {self.distance!r})"
+
+
+def to_matches(rows):
+    """Match rows from dicts or BigQuery rows with document_id, text and an optional distance."""
+    return [Match(row["document_id"], row["text"], row.get("distance")) for row in rows]
+
+
+def select_passages(matches, token_budget):
+    """Keep the best-ranked passages that fit in token_budget.
+
+    ``matches`` is a list of Match rows ordered best first. Passages that are
+    contained in an already selected passage (chunk overlap, or a duplicate
+    row) are skipped; passages that do not fit are skipped so a smaller one
+    further down can still be used. The best match is always kept.
+    """
+    keep = []
+    selected = []
+    used = 0
+    for match in matches:
+        text = match.text or ""
+        if any(text in previous for previous in selected):
+            continue
+        tokens = estimate_tokens(text)
+        if selected and used + tokens > token_budget:
+            continue
+        keep.append(match)
+        selected.append(text)
+        used += tokens
+    return keep
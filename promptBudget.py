@@ -0,0 +1,106 @@
+from passages import TOKEN_PIECE, TOKENS_PER_PIECE, estimate_tokens, select_passages
+
+MESSAGE_OVERHEAD_TOKENS = 4  # role and separator tokens the chat template adds per message
+HISTORY_SUMMARY_TOKENS = 60  # tokens kept of each older turn once it is compacted
+CHAT_ROLES = ("user", "assistant")
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text after roughly max_tokens estimated tokens, at a word boundary."""
+    text = text or ""
+    max_pieces = int(max_tokens / TOKENS_PER_PIECE)
+    for count, piece in enumerate(TOKEN_PIECE.finditer(text), start=1):
+        if count > max_pieces:
+            return text[:piece.start()].rstrip() + " …"
+    return text
+
+
+def compact_history(chat_history, token_budget, recent_turns):
+    """Fit the client-supplied chat history into token_budget.
+
+    The last ``recent_turns`` turns are kept verbatim, newest first, while
+    they fit. Older turns are compacted to their first HISTORY_SUMMARY_TOKENS
+    tokens and returned as summary lines for the system prompt. Turns that
+    do not fit at all are dropped. Entries with an unknown role or non-text
+    content are ignored. A budget too small for one message (zero or
+    negative included) leaves the history empty.
+
+    Returns (messages, summary_lines, stats).
+    """
+    entries = [
+        {"role": entry["role"], "content": entry["content"]}
+        for entry in chat_history or []
+        if isinstance(entry, dict) and entry.get("role") in CHAT_ROLES and isinstance(entry.get("content"), str)
+    ]
+    split = max(0, len(entries) - recent_turns)
+    budget = max(0, token_budget)
+    remaining = budget
+    kept = []
+    for entry in reversed(entries[split:]):
+        tokens = estimate_tokens(entry["content"]) + MESSAGE_OVERHEAD_TOKENS
+        if tokens > remaining:
+            if kept or remaining - MESSAGE_OVERHEAD_TOKENS < TOKENS_PER_PIECE:
+                split = split + len(entries[split:]) - len(kept)  # older recent turns get compacted instead
+                break
+            # The last turn alone is over budget: keep its beginning.
+            entry = dict(entry, content=truncate_to_tokens(entry["content"], remaining - MESSAGE_OVERHEAD_TOKENS))
+            tokens = remaining
+        kept.insert(0, entry)
+        remaining -= tokens
+
+    summary = []
+    for entry in reversed(entries[:split]):
+        line = f"- {'gebruiker' if entry['role'] == 'user' else 'assistent'}: " \
+               f"{truncate_to_tokens(entry['content'], HISTORY_SUMMARY_TOKENS)}"
+        tokens = estimate_tokens(line)
+        if tokens > remaining:
+            break
+        summary.insert(0, line)
+        remaining -= tokens
+
+    stats = {
+        "history_turns": len(entries),
+        "history_kept": len(kept),
+        "history_compacted": len(summary),
+        "history_dropped": len(entries) - len(kept) - len(summary),
+        "history_tokens": budget - remaining,
+    }
+    return kept, summary, stats
+
+
+def assemble_prompt(instructions, query_text, chat_history, matches, context_budget, history_budget,
+                    recent_turns, question_budget, no_matches_context):
+    """Build the chat messages within fixed token budgets per part.
+
+    ``matches`` (Match rows, best first) is packed into ``context_budget``,
+    the history into ``history_budget`` and the question is cut at
+    ``question_budget``, so the prompt size has a fixed upper bound.
+    Returns (messages, used_matches, report) where report lists the token
+    estimate of each part.
+    """
+    if not matches:
+        used = []
+        context = no_matches_context
+    else:
+        used = select_passages(matches, context_budget)
+        passages = [match.text or "" for match in used]
+        # select_passages always keeps the best passage; cut it if it alone is over budget.
+        passages[0] = truncate_to_tokens(passages[0], context_budget)
+        context = "\n\n".join(passages)
+
+    history, summary, stats = compact_history(chat_history, history_budget, recent_turns)
+    system = f"{instructions}\n\n{context}"
+    if summary:
+        system += "\n\nEerder in dit gesprek:\n" + "\n".join(summary)
+    question = truncate_to_tokens(query_text, question_budget)
+
+    messages = [{"role": "system", "content": system}] + history + [{"role": "user", "content": question}]
+    report = dict(
+        stats,
+        passages=len(used),
+        passages_dropped=len(matches) - len(used),
+        context_tokens=estimate_tokens(context),
+        question_tokens=estimate_tokens(question),
+        prompt_tokens=sum(estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS for message in messages),
+    )
+    return messages, used, report
@@ -0,0 +1,296 @@
+import numpy as np
+
+from exactSearch import (
+    METRICS, ExactSearch, compute_distances, l2_distances_float64, mask_distances, recall_at_k, selected_rows, top_k,
+)
+from vectorIndex import assign_clusters, export_index, kmeans
+
+QUANTIZATIONS = ("int8", "pq")
+PQ_SUB_DIMENSION = 16  # dimensions per subvector: 768 dimensions -> 48 subvectors, 48 bytes per embedding
+PQ_CENTROIDS = 256  # one uint8 code per subvector
+DEFAULT_RERANK = 100  # approximate candidates re-scored with the full-precision vectors
+BLOCK_ROWS = 65_536
+
+
+class ScalarQuantizer:
+    """Per-dimension int8 quantisation: x ~ zero + code * scale (4x smaller than float32).
+
+    ``zero`` is the value of code 0, the middle of each dimension's range.
+    """
+
+    prefix = "sq"
+
+    def __init__(self, zero, scale):
+        self.zero = np.asarray(zero, dtype=np.float32)
+        self.scale = np.asarray(scale, dtype=np.float32)
+
+    @classmethod
+    def train(cls, matrix):
+        low = np.full(matrix.shape[1], np.inf, dtype=np.float32)
+        high = np.full(matrix.shape[1], -np.inf, dtype=np.float32)
+        for start in range(0, len(matrix), BLOCK_ROWS):
+            block = np.asarray(matrix[start:start + BLOCK_ROWS], dtype=np.float32)
+            low = np.minimum(low, block.min(axis=0))
+            high = np.maximum(high, block.max(axis=0))
+        scale = (high - low) / 255.0
+        scale[scale == 0] = 1.0
+        return cls(low + 128.0 * scale, scale)
+
+    def encode(self, matrix):
+        codes = np.empty(matrix.shape, dtype=np.int8)
+        for start in range(0, len(matrix), BLOCK_ROWS):
+            block = np.asarray(matrix[start:start + BLOCK_ROWS], dtype=np.float32)
+            codes[start:start + BLOCK_ROWS] = np.clip(np.rint((block - self.zero) / self.scale), -128, 127)
+        return codes
+
+    def decode(self, codes):
+        return self.zero + codes.astype(np.float32) * self.scale
+
+    def inner_products(self, codes, query):
+        """Approximate query . x for every coded row, without decoding the matrix."""
+        return codes.astype(np.float32) @ (query * self.scale) + float(query @ self.zero)
+
+    def sections(self):
+        return {"sq.zero": self.zero, "sq.scale": self.scale}
+
+    @classmethod
+    def from_sections(cls, snapshot):
+        # Older snapshots stored uint8 codes with the value of code 0 as "sq.low"; the formula is the same.
+        zero = snapshot.section("sq.zero" if snapshot.has_section("sq.zero") else "sq.low")
+        return cls(zero, snapshot.section("sq.scale"))
+
+
+def pq_subvectors(dimension):
+    """The divisor of ``dimension`` whose subvectors come closest to PQ_SUB_DIMENSION dimensions."""
+    divisors = [m for m in range(1, dimension + 1) if dimension % m == 0]
+    return min(divisors, key=lambda m: abs(dimension / m - PQ_SUB_DIMENSION))
+
+
+class ProductQuantizer:
+    """Product quantisation: each of ``m`` subvectors is replaced by the id of its nearest of 256 centroids."""
+
+    prefix = "pq"
+
+    def __init__(self, centroids):
+        self.centroids = np.asarray(centroids, dtype=np.float32)  # (m, n_centroids, dimension / m)
+        self.m, _, self.sub_dimension = self.centroids.shape
+
+    @classmethod
+    def train(cls, matrix, m=None, n_centroids=PQ_CENTROIDS):
+        dimension = matrix.shape[1]
+        m = m or pq_subvectors(dimension)
+        if dimension % m:
+            raise ValueError(f"Dimension {dimension} is not divisible into {m} subvectors")
+        sub = dimension // m
+        n_centroids = min(n_centroids, len(matrix))
+        # kmeans samples the rows itself; each subspace is trained independently.
+        return cls(np.stack([
+            kmeans(np.ascontiguousarray(matrix[:, j * sub:(j + 1) * sub], dtype=np.float32), n_centroids)
+            for j in range(m)
+        ]))
+
+    def encode(self, matrix):
+        codes = np.empty((len(matrix), self.m), dtype=np.uint8)
+        for start in range(0, len(matrix), BLOCK_ROWS):
+            block = np.asarray(matrix[start:start + BLOCK_ROWS], dtype=np.float32)
+            for j in range(self.m):
+                sub = np.ascontiguousarray(block[:, j * self.sub_dimension:(j + 1) * self.sub_dimension])
+                codes[start:start + len(block), j] = assign_clusters(sub, self.centroids[j])
+        return codes
+
+    def decode(self, codes):
+        return np.concatenate([self.centroids[j][codes[:, j]] for j in range(self.m)], axis=1)
+
+    def _lookup(self, codes, tables):
+        """Sum the per-subvector table entries selected by the codes (asymmetric distance)."""
+        result = np.empty(len(codes), dtype=np.float32)
+        columns = np.arange(self.m)
+        for start in range(0, len(codes), BLOCK_ROWS):
+            block = codes[start:start + BLOCK_ROWS]
+            result[start:start + len(block)] = tables[columns, block].sum(axis=1)
+        return result
+
+    def inner_products(self, codes, query):
+        return self._lookup(codes, np.einsum("mkd,md->mk", self.centroids, query.reshape(self.m, self.sub_dimension)))
+
+    def squared_l2(self, codes, query):
+        difference = self.centroids - query.reshape(self.m, 1, self.sub_dimension)
+        return self._lookup(codes, np.einsum("mkd,mkd->mk", difference, difference))
+
+    def sections(self):
+        return {"pq.centroids": self.centroids}
+
+    @classmethod
+    def from_sections(cls, snapshot):
+        return cls(snapshot.section("pq.centroids"))
+
+
+QUANTIZERS = {"int8": ScalarQuantizer, "pq": ProductQuantizer}
+
+
+class QuantizedSearch:
+    """Top-k search over quantised codes, re-ranked with full-precision vectors.
+
+    The codes (``matrix.nbytes / 4`` for int8, one byte per subvector for PQ) are
+    scanned in memory; only the ``rerank`` best candidates are re-scored
+    against ``matrix``, which can stay memory-mapped on disk. With an IVF
+    ``index`` only the rows of the probed clusters are scanned.
+    """
+
+    def __init__(self, quantizer, codes, matrix, document_ids, texts, metric="l2",
+                 code_norms=None, rerank=DEFAULT_RERANK, index=None):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric} (expected one of {METRICS})")
+        self.quantizer = quantizer
+        self.codes = codes
+        self.matrix = matrix
+        self.document_ids = document_ids
+        self.texts = texts
+        self.metric = metric
+        self.code_norms = code_norms
+        self.rerank = rerank
+        self.index = index
+
+    @classmethod
+    def from_index(cls, index, kind, rerank=DEFAULT_RERANK):
+        """Quantise the matrix of a VectorIndex in memory (or reuse the sections of its snapshot)."""
+        snapshot = getattr(index, "snapshot", None)
+        prefix = QUANTIZERS[kind].prefix
+        code_norms = None
+        if snapshot is not None and snapshot.has_section(f"{prefix}.codes"):
+            quantizer = QUANTIZERS[kind].from_sections(snapshot)
+            codes = snapshot.section(f"{prefix}.codes")
+            if snapshot.has_section(f"{prefix}.norms"):
+                code_norms = snapshot.section(f"{prefix}.norms")
+        else:
+            quantizer = QUANTIZERS[kind].train(index.matrix)
+            codes = quantizer.encode(index.matrix)
+        if index.metric == "l2" and kind == "int8" and code_norms is None:
+            code_norms = _code_norms(quantizer, codes)
+        return cls(quantizer, codes, index.matrix, index.document_ids, index.texts, index.metric,
+                   code_norms, rerank, index if index.centroids is not None else None)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def approximate_distances(self, rows, query):
+        codes = self.codes[rows] if rows is not None else self.codes
+        if self.metric == "l2":
+            if isinstance(self.quantizer, ProductQuantizer):
+                return np.sqrt(np.maximum(self.quantizer.squared_l2(codes, query), 0.0))
+            norms = self.code_norms[rows] if rows is not None else self.code_norms
+            squared = norms - 2.0 * self.quantizer.inner_products(codes, query) + float(query @ query)
+            return np.sqrt(np.maximum(squared, 0.0))
+        scores = self.quantizer.inner_products(codes, query)
+        if self.metric == "cosine":
+            return 1.0 - scores / (float(np.linalg.norm(query)) or 1.0)
+        return -scores
+
+    def search(self, query_embedding, top_n, rerank=None, nprobe=None, mask=None):
+        """Return (row ids, distances): approximate top ``rerank``, then exact re-ranking.
+
+        With a boolean ``mask`` only the selected rows are returned.
+        """
+        query = np.asarray(query_embedding, dtype=np.float32)
+        rerank = max(top_n, rerank or self.rerank)
+        if self.index is not None:
+            rows = self.index.candidate_rows(query, nprobe, mask, min_rows=rerank)
+        else:
+            rows = selected_rows(mask) if mask is not None else None
+        distances = self.approximate_distances(rows, query)
+        if rows is None and mask is not None:
+            # Broad masks scan every code; the rows outside them get an infinite distance.
+            mask_distances(distances, mask)
+            rerank = min(rerank, int(np.count_nonzero(mask)))
+        best = top_k(distances, rerank)
+        candidates = rows[best] if rows is not None else best
+        candidates = np.sort(candidates)  # sequential reads from the memory map
+        if self.metric == "l2":
+            exact = l2_distances_float64(self.matrix, candidates, query)
+        else:
+            exact = compute_distances(np.asarray(self.matrix[candidates]), query, self.metric)
+        order = top_k(exact, top_n)
+        return candidates[order], exact[order]
+
+    def top_matches(self, query_embedding, top_n, rerank=None, mask=None):
+        """Search and return rows as dicts with document_id, text and distance."""
+        rows, distances = self.search(query_embedding, top_n, rerank, mask=mask)
+        return [
+            {"document_id": self.document_ids[row], "text": self.texts[row], "distance": float(distance)}
+            for row, distance in zip(rows, distances)
+        ]
+
+    def memory_bytes(self):
+        """Bytes held in memory for the scan (codes and per-row norms)."""
+        return self.codes.nbytes + (self.code_norms.nbytes if self.code_norms is not None else 0)
+
+
+def _code_norms(quantizer, codes):
+    """Squared norms of the decoded rows, for approximate l2 distances."""
+    norms = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), BLOCK_ROWS):
+        decoded = quantizer.decode(codes[start:start + BLOCK_ROWS])
+        norms[start:start + len(decoded)] = np.einsum("ij,ij->i", decoded, decoded)
+    return norms
+
+
+def add_quantized_sections(writer, kind, metric):
+    """Train a quantizer on the staged rows of a snapshot writer and store it with the codes."""
+    matrix = writer.staged_matrix()
+    quantizer = QUANTIZERS[kind].train(matrix)
+    codes = quantizer.encode(matrix)
+    prefix = QUANTIZERS[kind].prefix
+    for name, array in quantizer.sections().items():
+        writer.add_section(name, array)
+    writer.add_section(f"{prefix}.codes", codes)
+    if metric == "l2" and kind == "int8":
+        writer.add_section(f"{prefix}.norms", _code_norms(quantizer, codes))
+    writer.meta.update(quantization=kind)
+
+
+def measure_recall(search, exact, queries, top_n=10):
+    """recall@top_n of a quantised search against the exact full-precision search."""
+    exact_rows, _ = exact.search(queries, top_n)
+    approximate_rows = [search.search(query, top_n)[0] for query in queries]
+    return recall_at_k(approximate_rows, exact_rows)
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Usage: python quantization.py export <table_id> <output.snapshot> <metric> <int8|pq> [packed]
+    #        python quantization.py recall <snapshot> <int8|pq> [queries] [rerank]
+    command = sys.argv[1]
+    if command == "export":
+        from google.cloud import bigquery
+        from metadataFilter import export_metadata
+
+        table_id, output_path, metric, kind = sys.argv[2:6]
+        client = bigquery.Client()
+        documents_table_id = table_id.rsplit(".", 1)[0] + ".documents"
+
+        def prepare(writer):
+            add_quantized_sections(writer, kind, metric)
+            export_metadata(client, documents_table_id, writer)
+
+        exported = export_index(client, table_id, output_path, metric, prepare=prepare,
+                                packed=sys.argv[6:7] == ["packed"])
+        print(f"Exported {exported} embeddings with {kind} codes to {output_path}")
+    elif command == "recall":
+        from vectorIndex import VectorIndex
+
+        path, kind = sys.argv[2], sys.argv[3]
+        n_queries = int(sys.argv[4]) if len(sys.argv) > 4 else 100
+        index = VectorIndex.load(path, verify=False)
+        search = QuantizedSearch.from_index(index, kind, rerank=int(sys.argv[5]) if len(sys.argv) > 5 else DEFAULT_RERANK)
+        rng = np.random.default_rng(0)
+        queries = np.asarray(index.matrix[np.sort(rng.choice(len(index), min(n_queries, len(index)), replace=False))])
+        queries = queries + rng.normal(0, 0.01, queries.shape).astype(np.float32)
+        exact = ExactSearch.from_index(index)
+        for rerank in (0, search.rerank):
+            search.rerank = rerank
+            print(f"{kind} rerank={rerank}: recall@10 = {measure_recall(search, exact, queries):.3f}")
+        print(f"Scan memory: {search.memory_bytes() / 2**20:.1f} MiB "
+              f"(float32 matrix: {index.matrix.nbytes / 2**20:.1f} MiB)")
+    else:
+        raise SystemExit(f"Unknown command: {command}")
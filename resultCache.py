@@ -0,0 +1,75 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Embeddings are L2-normalised and rounded to multiples of 1/QUANTIZATION_STEPS
+# before hashing, so float noise between identical queries maps to one key.
+QUANTIZATION_STEPS = 256
+
+
+def embedding_key(embedding, top_n, *extra):
+    """Hash of the quantised embedding plus top_n and any other search options."""
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector = vector / norm
+    quantized = np.rint(vector * QUANTIZATION_STEPS).astype(np.int16)
+    digest = hashlib.blake2b(quantized.tobytes(), digest_size=16)
+    digest.update(repr((top_n,) + extra).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """LRU cache of retrieval results tied to a corpus generation.
+
+    Every lookup passes the current corpus generation; when it differs from
+    the generation the entries were stored under, the cache is emptied.
+    """
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.generation = generation
+
+    def get(self, key, generation):
+        with self._lock:
+            self._check_generation(generation)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, value):
+        with self._lock:
+            self._check_generation(generation)
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "generation": self.generation,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,168 @@
+import contextlib
+import ctypes
+import fcntl
+import hashlib
+import os
+
+import numpy as np
+
+from embeddingSnapshot import Snapshot, SnapshotWriter, normalize_rows
+from quantization import QUANTIZERS, add_quantized_sections
+from vectorIndex import DEFAULT_NPROBE, MIN_ROWS_FOR_IVF, SAVE_BATCH_ROWS, VectorIndex, add_index_sections
+
+LOCK_FILE = ".snapshots.lock"
+# Snapshots derived by the service itself; only these are ever removed.
+DERIVED_PREFIXES = ("serving-", "compacted-")
+# Sections SnapshotWriter writes from the rows; the other sections of a source snapshot are copied.
+ROW_SECTIONS = {"embeddings", "scales", "id_offsets", "ids", "text_offsets", "texts"}
+QUANTIZED_PREFIXES = {quantizer.prefix for quantizer in QUANTIZERS.values()}
+
+
+def release_heap():
+    """Return freed heap memory to the OS (glibc keeps it after large temporary allocations)."""
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass  # not glibc
+
+
+def _renormalized(snapshot, metric):
+    return metric == "cosine" and not snapshot.meta.get("normalized", False)
+
+
+def private_derivations(snapshot, metric=None, quantization=None):
+    """What each worker would compute for itself to serve the snapshot as it is (empty when nothing)."""
+    stored_metric = snapshot.meta.get("metric", "l2")
+    metric = metric or stored_metric
+    derived = []
+    if snapshot.dtype != "float32":
+        derived.append(f"{snapshot.dtype} decoding")
+    if _renormalized(snapshot, metric):
+        derived.append("normalisation")
+    if metric == "l2" and (snapshot.dtype != "float32" or metric != stored_metric or not snapshot.has_section("norms")):
+        derived.append("norms")
+    if metric != stored_metric and snapshot.has_section("ivf.centroids"):
+        derived.append("IVF lists")
+    if quantization and (_renormalized(snapshot, metric)
+                         or not snapshot.has_section(f"{QUANTIZERS[quantization].prefix}.codes")):
+        derived.append(f"{quantization} codes")
+    return derived
+
+
+def write_serving_snapshot(snapshot, path, metric, quantization=None):
+    """Write what a worker serves from ``snapshot`` (float32 vectors, norms, IVF lists, codes) to path.
+
+    Rows are decoded a batch at a time, so the worker writing the file never
+    holds a private copy of the whole matrix.
+    """
+    stored_metric = snapshot.meta.get("metric", "l2")
+    renormalized = _renormalized(snapshot, metric)
+    rebuild_ivf = metric != stored_metric and snapshot.has_section("ivf.centroids")
+    scales = snapshot.section("scales") if snapshot.dtype == "int8" else None
+    writer = SnapshotWriter(path, snapshot.dimension)
+    for start in range(0, len(snapshot), SAVE_BATCH_ROWS):
+        end = min(start + SAVE_BATCH_ROWS, len(snapshot))
+        block = np.asarray(snapshot.embeddings[start:end], dtype=np.float32)
+        if scales is not None:
+            block *= scales[start:end, None]
+        writer.add_batch(snapshot.document_ids[start:end], snapshot.texts[start:end],
+                         normalize_rows(block) if renormalized else block)
+    # Norms always; IVF lists only when the stored ones were built for another metric.
+    add_index_sections(writer, metric, snapshot.meta.get("nprobe", DEFAULT_NPROBE),
+                       MIN_ROWS_FOR_IVF if rebuild_ivf else len(snapshot) + 1)
+    for name in snapshot.section_names():
+        if name in ROW_SECTIONS or name == "norms" or (rebuild_ivf and name.startswith("ivf.")):
+            continue
+        if renormalized and name.split(".")[0] in QUANTIZED_PREFIXES:
+            continue  # codes of the vectors before normalisation
+        writer.add_section(name, snapshot.section(name))
+    for key, value in snapshot.meta.items():
+        if key not in writer.meta and not (renormalized and key == "quantization"):
+            writer.meta[key] = value
+    if quantization and f"{QUANTIZERS[quantization].prefix}.codes" not in writer.sections:
+        add_quantized_sections(writer, quantization, metric)
+    writer.close()
+
+
+class SharedSnapshots:
+    """Snapshot files in a directory shared by the worker processes of one instance.
+
+    A memory-mapped snapshot is in the page cache once, however many workers
+    map it, but whatever a worker computes from it at load time is private to
+    that worker. ``load`` therefore writes those results once to a serving
+    snapshot that every worker maps instead, and ``publish`` lets workers
+    that compact their index to the same content share one file.
+
+    Files are created under an exclusive flock on the directory's lock file.
+    Each worker holds a shared flock on the snapshots it serves (``pin``), and
+    ``remove_unused`` deletes the derived snapshots that no process holds.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._pins = {}  # path -> file descriptor holding a shared flock
+
+    @contextlib.contextmanager
+    def lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)  # releases the lock
+
+    def pin(self, path):
+        """Mark a snapshot as in use by this process until ``unpin``."""
+        if path not in self._pins:
+            fd = os.open(path, os.O_RDONLY)
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            self._pins[path] = fd
+
+    def unpin(self, path):
+        fd = self._pins.pop(path, None)
+        if fd is not None:
+            os.close(fd)
+
+    def publish(self, name, write):
+        """Path of snapshot ``name``, written with ``write(path)`` unless another worker already did; pinned."""
+        path = os.path.join(self.directory, name)
+        with self.lock():
+            if not os.path.exists(path):
+                write(path)
+                release_heap()  # only this worker paid for writing the file; keep its resident memory like the others'
+            self.pin(path)
+        return path
+
+    def load(self, path, metric=None, nprobe=None, verify=True, quantization=None):
+        """VectorIndex over the snapshot at path, or over a serving snapshot derived from it once per instance."""
+        snapshot = Snapshot(path, verify=verify)
+        derived = private_derivations(snapshot, metric, quantization)
+        if not derived:
+            return VectorIndex.from_snapshot(snapshot, metric=metric, nprobe=nprobe)
+        metric = metric or snapshot.meta.get("metric", "l2")
+        key = hashlib.sha256(repr((snapshot.crc, snapshot.rows, snapshot.dtype, metric, quantization)).encode())
+        serving = self.publish(f"serving-{key.hexdigest()[:16]}.snapshot",
+                               lambda target: write_serving_snapshot(snapshot, target, metric, quantization))
+        print(f"Serving {path} from {serving}, shared by all workers ({', '.join(derived)})")
+        return VectorIndex.load(serving, metric=metric, nprobe=nprobe, verify=False)
+
+    def remove_unused(self):
+        """Delete the derived snapshots that no process has pinned; returns their names."""
+        removed = []
+        with self.lock():
+            for name in os.listdir(self.directory):
+                if not (name.startswith(DERIVED_PREFIXES) and name.endswith(".snapshot")):
+                    continue
+                path = os.path.join(self.directory, name)
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # still served by some worker
+                else:
+                    os.remove(path)  # workers that unpinned it keep their memory map
+                    removed.append(name)
+                finally:
+                    os.close(fd)
+        return removed
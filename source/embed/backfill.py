@@ -0,0 +1,182 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class FakeEmbedding:
+    def __init__(self, values):
+        self.values = values
+
+
+class FakeEmbeddingModel:
+    """Local stand-in for TextEmbeddingModel: deterministic vectors, configurable latency and failures."""
+
+    def __init__(self, dimension=768, latency=0.05, failure_rate=0.0):
+        self.dimension = dimension
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def get_embeddings(self, texts):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise RuntimeError("429 Quota exceeded (fake)")
+        return [FakeEmbedding(self.vector(text)) for text in texts]
+
+    def vector(self, text):
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=64).digest()
+        # Repeat the 64 digest bytes to fill the vector; stable across runs and processes.
+        return [(digest[i % 64] - 127.5) / 127.5 for i in range(self.dimension)]
+
+
+class RequestQuota:
+    """Blocks callers so that at most requests_per_minute calls start per minute."""
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self.next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+class LocalCheckpoint:
+    """Backfill state in a local JSON file (tests and local runs)."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self, state):
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class GcsCheckpoint:
+    """Backfill state as a JSON object in GCS, so a restarted Cloud Function resumes."""
+
+    def __init__(self, storage_client, bucket_name, blob_name="checkpoints/embedding_backfill.json"):
+        self.blob = storage_client.bucket(bucket_name).blob(blob_name)
+
+    def load(self):
+        if not self.blob.exists():
+            return None
+        return json.loads(self.blob.download_as_text())
+
+    def save(self, state):
+        self.blob.upload_from_string(json.dumps(state), content_type="application/json")
+
+    def clear(self):
+        if self.blob.exists():
+            self.blob.delete()
+
+
+class EmbeddingBackfill:
+    """Embeds every pending document once, in parallel shards, resumably.
+
+    * ``list_pending()`` returns the pending document_ids; it is called once
+      per backfill and the ids are split, in document_id order, into shards
+      of ``shard_size``.
+    * ``process_shard(document_ids)`` fetches, embeds and stores one shard
+      and returns the number of documents stored.
+
+    ``workers`` shards run concurrently. The shard plan and the finished
+    shards are saved to ``checkpoint`` after every shard, so an interrupted
+    run skips the finished shards instead of recomputing the pending set.
+    A shard that fails ``max_attempts`` runs in a row is given up. The
+    checkpoint is cleared once every shard is done or given up, so the next
+    run calls ``list_pending()`` again. That new plan includes documents
+    added since, and the documents of the shards that were given up.
+    """
+
+    def __init__(self, list_pending, process_shard, checkpoint, shard_size=200, workers=4, max_attempts=3):
+        self.list_pending = list_pending
+        self.process_shard = process_shard
+        self.checkpoint = checkpoint
+        self.shard_size = shard_size
+        self.workers = workers
+        self.max_attempts = max_attempts
+
+    def plan(self):
+        """Load the saved shard plan, or compute the pending set and split it."""
+        state = self.checkpoint.load()
+        if state:
+            state.setdefault("attempts", [0] * len(state["shards"]))  # checkpoints saved before attempts were kept
+            state.setdefault("abandoned", [])
+            logging.info(f"Resuming backfill: {len(state['done'])}/{len(state['shards'])} shards already done.")
+            return state
+        ids = sorted(self.list_pending())
+        shards = [ids[i:i + self.shard_size] for i in range(0, len(ids), self.shard_size)]
+        state = {"shards": shards, "done": [], "stored": 0, "attempts": [0] * len(shards), "abandoned": []}
+        self.checkpoint.save(state)
+        return state
+
+    def run(self):
+        """Process the remaining shards and return a summary with docs/sec."""
+        started = time.monotonic()
+        state = self.plan()
+        finished = set(state["done"]) | set(state["abandoned"])
+        remaining = [i for i in range(len(state["shards"])) if i not in finished]
+        stored = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self.process_shard, state["shards"][i]): i for i in remaining}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    count = future.result()
+                except Exception as e:
+                    state["attempts"][index] += 1
+                    if state["attempts"][index] >= self.max_attempts:
+                        # Its documents are still pending and come back in the next fresh plan.
+                        state["abandoned"].append(index)
+                        logging.error(f"Shard {index} failed {state['attempts'][index]} times, giving up: {e}")
+                    else:
+                        logging.error(f"Shard {index} failed, retried by the next run: {e}")
+                    self.checkpoint.save(state)
+                    continue
+                stored += count
+                state["done"].append(index)
+                state["stored"] += count
+                self.checkpoint.save(state)
+                logging.info(f"Shard {index} stored {count} documents "
+                             f"({len(state['done'])}/{len(state['shards'])} shards done).")
+
+        elapsed = time.monotonic() - started
+        pending = len(state["shards"]) - len(state["done"]) - len(state["abandoned"])
+        if not pending:
+            self.checkpoint.clear()
+        summary = {
+            "shards": len(state["shards"]),
+            "shards_pending": pending,
+            "shards_abandoned": len(state["abandoned"]),
+            "documents_stored": stored,
+            "seconds": round(elapsed, 2),
+            "docs_per_second": round(stored / elapsed, 2) if elapsed else 0.0,
+        }
+        logging.info(f"Backfill finished: {summary}")
+        return summary
@@ -0,0 +1,127 @@
+import math
+import re
+
+# Token counts are estimated: the multilingual embedding model uses a subword
+# vocabulary that produces roughly 1.4 tokens per Dutch word or punctuation mark.
+TOKENS_PER_PIECE = 1.4
+MAX_CHUNK_TOKENS = 512
+OVERLAP_TOKENS = 64
+
+_PIECE = re.compile(r"\w+|[^\w\s]")
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*\s+")
+# Abbreviations that end in a period but do not end a sentence.
+_ABBREVIATIONS = {"art", "nr", "nrs", "blz", "bijv", "d.w.z", "o.a", "m.b.t", "i.p.v", "t.a.v", "e.d", "etc", "dhr", "mevr", "mr", "dr", "prof", "jl", "vgl", "zgn"}
+
+
+def estimate_tokens(text):
+    """Approximate model token count of a text."""
+    return math.ceil(len(_PIECE.findall(text)) * TOKENS_PER_PIECE)
+
+
+def sentence_spans(text):
+    """Yield (start, end) character spans of sentences, never crossing paragraphs."""
+    paragraph_start = 0
+    for paragraph_end in [m.start() for m in _PARAGRAPH_BREAK.finditer(text)] + [len(text)]:
+        start = paragraph_start
+        for match in _SENTENCE_END.finditer(text, paragraph_start, paragraph_end):
+            words = text[start:match.start()].rsplit(None, 1)
+            if words and match.group().startswith(".") and words[-1].lower().rstrip(".") in _ABBREVIATIONS:
+                continue  # "art. 5", "nr. 12", "o.a. de VVD"
+            yield from _trimmed(text, start, match.end())
+            start = match.end()
+        yield from _trimmed(text, start, paragraph_end)
+        paragraph_start = paragraph_end
+
+
+def _trimmed(text, start, end):
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    if start < end:
+        yield start, end
+
+
+def _split_long_span(text, start, end, max_tokens):
+    """Hard-split a span that is longer than max_tokens on word boundaries."""
+    pieces = list(re.finditer(r"\S+", text[start:end]))
+    per_chunk = max(1, int(max_tokens / TOKENS_PER_PIECE))
+    for i in range(0, len(pieces), per_chunk):
+        group = pieces[i:i + per_chunk]
+        yield start + group[0].start(), start + group[-1].end()
+
+
+def chunk_text(text, max_tokens=MAX_CHUNK_TOKENS, overlap_tokens=OVERLAP_TOKENS):
+    """Yield (char_start, char_end) spans of overlapping, sentence-aligned chunks.
+
+    Sentences are packed greedily up to max_tokens. Each chunk starts with the
+    trailing sentences of the previous one, up to overlap_tokens, so context
+    is not lost at the boundary.
+    """
+    sentences = []
+    for start, end in sentence_spans(text):
+        tokens = estimate_tokens(text[start:end])
+        if tokens > max_tokens:
+            sentences.extend((s, e, estimate_tokens(text[s:e])) for s, e in _split_long_span(text, start, end, max_tokens))
+        else:
+            sentences.append((start, end, tokens))
+
+    window = []
+    window_tokens = 0
+    for sentence in sentences:
+        if window and window_tokens + sentence[2] > max_tokens:
+            yield window[0][0], window[-1][1]
+            # Carry the tail of this chunk over as overlap for the next one.
+            overlap = []
+            overlap_total = 0
+            for previous in reversed(window):
+                if overlap_total + previous[2] > overlap_tokens or overlap_total + previous[2] + sentence[2] > max_tokens:
+                    break
+                overlap.insert(0, previous)
+                overlap_total += previous[2]
+            window, window_tokens = overlap, overlap_total
+        window.append(sentence)
+        window_tokens += sentence[2]
+    if window:
+        yield window[0][0], window[-1][1]
+
+
+def chunk_document(document_id, text, max_tokens=MAX_CHUNK_TOKENS, overlap_tokens=OVERLAP_TOKENS):
+    """Yield chunk records with ids and character offsets into the document text."""
+    for index, (start, end) in enumerate(chunk_text(text or "", max_tokens, overlap_tokens)):
+        passage = text[start:end]
+        yield {
+            "chunk_id": f"{document_id}:{index}",
+            "document_id": document_id,
+            "chunk_index": index,
+            "char_start": start,
+            "char_end": end,
+            "token_count": estimate_tokens(passage),
+            "text": passage,
+        }
+
+
+def iter_chunks(documents, max_tokens=MAX_CHUNK_TOKENS, overlap_tokens=OVERLAP_TOKENS):
+    """Stream chunk records for an iterable of documents (dicts with document_id and text).
+
+    Any other document fields (title, subject, ...) are copied onto each chunk.
+    """
+    for document in documents:
+        extra = {key: value for key, value in document.items() if key not in ("document_id", "text")}
+        for chunk in chunk_document(document["document_id"], document["text"], max_tokens, overlap_tokens):
+            yield dict(extra, **chunk)
+
+
+def batch_chunks(chunks, max_texts=32, max_tokens=15_000):
+    """Group chunks into embedding requests bounded by text count and total tokens."""
+    batch = []
+    batch_tokens = 0
+    for chunk in chunks:
+        if batch and (len(batch) >= max_texts or batch_tokens + chunk["token_count"] > max_tokens):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(chunk)
+        batch_tokens += chunk["token_count"]
+    if batch:
+        yield batch
@@ -2,9 +2,14 @@ import functions_framework
 from google.cloud import bigquery, aiplatform, storage
 import numpy as np
 import pandas as pd
-import json
 import logging
+import os
+import time
+from google.api_core.exceptions import PreconditionFailed
 from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
+from backfill import EmbeddingBackfill, FakeEmbeddingModel, GcsCheckpoint, LocalCheckpoint, RequestQuota
+from chunking import batch_chunks, iter_chunks
+from hashStore import BigQueryHashStore, SqliteHashStore, content_hash, source_hash
 
 # Google Cloud Config
 PROJECT_ID = "corded-forge-417909"
@@ -12,24 +17,92 @@ REGION = "europe-west4"
 BQ_DATASET_ID = "ProjectRAGMart"
 BQ_TABLE_ID = f"{PROJECT_ID}.{BQ_DATASET_ID}.processed_documents"
 EMBEDDING_TABLE_ID = f"{PROJECT_ID}.{BQ_DATASET_ID}.document_embeddings"
-BATCH_SIZE = 10  # Adjust as needed based on your quota and model performance.
+EMBEDDING_HASH_TABLE_ID = f"{PROJECT_ID}.{BQ_DATASET_ID}.embedding_hashes"  # content_hash -> embedding
+SHARD_SIZE = int(os.environ.get("BACKFILL_SHARD_SIZE", 100))  # Documents per shard (one load job each)
+BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", 4))  # Shards embedded concurrently
+BACKFILL_MAX_ATTEMPTS = int(os.environ.get("BACKFILL_MAX_ATTEMPTS", 3))  # Runs a shard may fail before it is given up
+EMBEDDING_REQUESTS_PER_MINUTE = int(os.environ.get("EMBEDDING_REQUESTS_PER_MINUTE", 300))  # Vertex AI quota
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "text-multilingual-embedding-002")  # "fake" for local runs
+BACKFILL_CHECKPOINT = os.environ.get("BACKFILL_CHECKPOINT")  # local checkpoint file; GCS when unset
+EMBEDDING_HASH_STORE = os.environ.get("EMBEDDING_HASH_STORE")  # local SQLite hash store; BigQuery when unset
+CHUNK_TOKENS = 512  # Passage size; the model truncates inputs beyond 2048 tokens
+CHUNK_OVERLAP_TOKENS = 64
+EMBED_BATCH_TEXTS = 32  # Texts per embedding request
+EMBED_BATCH_TOKENS = 15_000  # Stay under the 20k tokens per request limit
+GCS_BUCKET = "projectragmart"
+GENERATION_BLOB = "corpus_generation"  # Polled by app.py to invalidate cached retrieval results
 
 aiplatform.init(project=PROJECT_ID, location=REGION)
-model = TextEmbeddingModel.from_pretrained("text-multilingual-embedding-002")
+model = FakeEmbeddingModel() if EMBEDDING_MODEL == "fake" else TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL)
+quota = RequestQuota(EMBEDDING_REQUESTS_PER_MINUTE)
 bq_client = bigquery.Client()
+storage_client = storage.Client()
+if EMBEDDING_HASH_STORE:
+    hash_store = SqliteHashStore(EMBEDDING_HASH_STORE)
+else:
+    hash_store = BigQueryHashStore(bq_client, EMBEDDING_HASH_TABLE_ID)
 
-def fetch_documents(limit, offset):
-    """Retrieve documents in batches from BigQuery."""
+EMBEDDING_COLUMNS = [
+    bigquery.SchemaField("chunk_id", "STRING"),
+    bigquery.SchemaField("chunk_index", "INT64"),
+    bigquery.SchemaField("char_start", "INT64"),
+    bigquery.SchemaField("char_end", "INT64"),
+    bigquery.SchemaField("token_count", "INT64"),
+    bigquery.SchemaField("content_hash", "STRING"),
+    bigquery.SchemaField("source_hash", "STRING"),
+    bigquery.SchemaField("embedding_f16", "BYTES"),
+]
+
+def ensure_embedding_columns():
+    """Add the chunk and hash columns to an older document_embeddings table."""
+    table = bq_client.get_table(EMBEDDING_TABLE_ID)
+    existing = {field.name for field in table.schema}
+    missing = [field for field in EMBEDDING_COLUMNS if field.name not in existing]
+    if missing:
+        table.schema = list(table.schema) + missing
+        bq_client.update_table(table, ["schema"])
+        logging.info(f"Added columns {[field.name for field in missing]} to {EMBEDDING_TABLE_ID}.")
+
+def list_pending_documents():
+    """Return the ids of processed documents that are new or changed since they were embedded.
+
+    A document has changed when the SHA-256 of its text differs from the
+    source_hash stored with its embeddings (rows from before source_hash
+    existed count as changed). A blank text has no passages, so it is only
+    pending while embeddings of an earlier text are left to delete; otherwise
+    it would be selected again on every run. One anti-join per backfill.
+    """
+    query = f"""
+    SELECT p.document_id
+    FROM `{BQ_TABLE_ID}` AS p
+    LEFT JOIN (
+        SELECT document_id, ANY_VALUE(source_hash) AS source_hash
+        FROM `{EMBEDDING_TABLE_ID}`
+        GROUP BY document_id
+    ) AS e USING (document_id)
+    WHERE p.text IS NOT NULL
+      AND (e.document_id IS NULL OR e.source_hash IS DISTINCT FROM TO_HEX(SHA256(p.text)))
+      AND (REGEXP_CONTAINS(p.text, r'\\S') OR e.document_id IS NOT NULL)
+    ORDER BY p.document_id
+    """
+    ensure_embedding_columns()
+    return [row["document_id"] for row in bq_client.query(query).result()]
+
+def fetch_documents(document_ids):
+    """Retrieve the given documents from BigQuery."""
     query = f"""
     SELECT document_id, text, subject, title 
     FROM `{BQ_TABLE_ID}`
-    WHERE text IS NOT NULL AND document_id NOT IN (SELECT document_id FROM `{EMBEDDING_TABLE_ID}`)
-    LIMIT {limit} OFFSET {offset}
+    WHERE document_id IN UNNEST(@ids)
     """
-    return bq_client.query(query).to_dataframe()
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("ids", "STRING", list(document_ids))]
+    )
+    return bq_client.query(query, job_config=job_config).to_dataframe()
 
 def generate_embeddings_batch(texts):
     """Generate embeddings for a batch of texts."""
+    quota.acquire()
     try:
         response = model.get_embeddings(texts)
         return [embedding.values for embedding in response]
@@ -38,37 +111,123 @@ def generate_embeddings_batch(texts):
         return None
 
 def store_embeddings_batch(df):
-    """Store a batch of embeddings in BigQuery."""
+    """Store a batch of embeddings in BigQuery and return the number of rows stored."""
     if df.empty:
-        return
-    print(f"Embeddings data before JSON conversion:\n{df['embedding'].head()}")
-
-    #df["embedding"] = df["embedding"].apply(json.dumps)
-    df["embedding"] = df[["embedding"]].apply(lambda x: json.dumps(x) if isinstance(x, list) else x)
+        return 0
+    # Native ARRAY<FLOAT64> for SQL, plus the vector packed as little-endian float16
+    # bytes: a quarter of the bytes scanned when exporting snapshots.
+    df["embedding_f16"] = [np.asarray(embedding, dtype="<f2").tobytes() for embedding in df["embedding"]]
 
     table_ref = bq_client.dataset(BQ_DATASET_ID).table("document_embeddings")
+    job_config = bigquery.LoadJobConfig(
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION],
+    )
     try:
-        bq_client.load_table_from_dataframe(df, table_ref).result()
+        bq_client.load_table_from_dataframe(df, table_ref, job_config=job_config).result()
         logging.info(f"Stored {len(df)} embeddings in BigQuery.")
+        return len(df)
     except Exception as e:
         logging.error(f"Error storing embeddings: {e}")
+        return 0
+
+def bump_corpus_generation():
+    """Increment the corpus generation counter so serving caches drop stale results."""
+    blob = storage_client.bucket(GCS_BUCKET).blob(GENERATION_BLOB)
+    for _ in range(5):
+        try:
+            if blob.exists():
+                blob.reload()
+                expected = blob.generation
+                current = int(blob.download_as_text(if_generation_match=expected).strip() or 0)
+            else:
+                expected, current = 0, 0  # 0 means "only if the object does not exist yet"
+            blob.upload_from_string(str(current + 1), if_generation_match=expected)
+            logging.info(f"Corpus generation is now {current + 1}.")
+            return current + 1
+        except PreconditionFailed:
+            # Another writer bumped the counter concurrently; re-read and retry.
+            continue
+    logging.error("Could not update the corpus generation after 5 attempts.")
+    return None
 
 
+def embed_chunks(documents):
+    """Split documents into overlapping passages and embed them.
+
+    Passages are keyed by content hash: hashes already in the hash store,
+    or repeated within the shard, reuse the stored vector instead of calling
+    the model. Returns a DataFrame with one row per passage. Documents with
+    a passage that failed to embed are left out entirely, so they are
+    retried as a whole on the next run.
+    """
+    documents = [dict(document, source_hash=source_hash(document["text"])) for document in documents]
+    chunks = list(iter_chunks(documents, max_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS))
+    hashes = [content_hash(chunk["text"], EMBEDDING_MODEL) for chunk in chunks]
+    known = hash_store.get_many(set(hashes))
+    hits = sum(1 for key in hashes if key in known)
+
+    missing = {}  # content_hash -> chunk, one model call per distinct text
+    for chunk, key in zip(chunks, hashes):
+        if key not in known:
+            missing.setdefault(key, dict(chunk, content_hash=key))
+    started = time.monotonic()
+    for batch in batch_chunks(missing.values(), max_texts=EMBED_BATCH_TEXTS, max_tokens=EMBED_BATCH_TOKENS):
+        embeddings = generate_embeddings_batch([chunk["text"] for chunk in batch])
+        if not embeddings:
+            continue
+        new = {chunk["content_hash"]: embedding for chunk, embedding in zip(batch, embeddings)}
+        hash_store.put_many(new)
+        known.update(new)
+    elapsed = time.monotonic() - started
+    logging.info(f"Embedding cache: {hits}/{len(chunks)} passages reused, {len(missing)} distinct texts embedded "
+                 f"in {elapsed:.1f}s ({len(missing) / elapsed if elapsed else 0.0:.1f} texts/sec).")
+
+    failed = {chunk["document_id"] for chunk, key in zip(chunks, hashes) if key not in known}
+    rows = [
+        dict(chunk, content_hash=key, embedding=known[key])
+        for chunk, key in zip(chunks, hashes)
+        if chunk["document_id"] not in failed
+    ]
+    return pd.DataFrame(rows)
+
+def delete_embeddings(document_ids):
+    """Delete all stored embeddings of the given documents."""
+    query = f"DELETE FROM `{EMBEDDING_TABLE_ID}` WHERE document_id IN UNNEST(@ids)"
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("ids", "STRING", document_ids)]
+    )
+    bq_client.query(query, job_config=job_config).result()
+
+def embed_shard(document_ids):
+    """Fetch, embed and store one backfill shard; return the number of documents stored."""
+    documents = fetch_documents(document_ids).to_dict("records")
+    # Documents whose text became blank have no passages; only their old embeddings are dropped.
+    blank = [document["document_id"] for document in documents if not document["text"].strip()]
+    df = embed_chunks(documents)
+    if df.empty and not blank:
+        return 0
+    # Changed documents: drop the embeddings of their previous text first. If the
+    # load below fails, the documents have no embeddings and are pending again.
+    delete_embeddings((df["document_id"].unique().tolist() if not df.empty else []) + blank)
+    if df.empty:
+        return 0
+    if not store_embeddings_batch(df):
+        raise RuntimeError(f"storing {len(df)} embeddings failed")
+    return df["document_id"].nunique()
+
 def store_embeddings():
-    """Main function to fetch, process, and store embeddings in batches."""
-    offset = 0
-    while True:
-        df = fetch_documents(BATCH_SIZE, offset)
-        if df.empty:
-            break
-
-        texts = df["text"].tolist()
-        embeddings = generate_embeddings_batch(texts)
-        if embeddings:
-            df["embedding"] = embeddings
-            store_embeddings_batch(df)
-        offset += BATCH_SIZE
-    return "Embeddings processed successfully."
+    """Main function: embed every pending document with a resumable, sharded backfill."""
+    if BACKFILL_CHECKPOINT:
+        checkpoint = LocalCheckpoint(BACKFILL_CHECKPOINT)
+    else:
+        checkpoint = GcsCheckpoint(storage_client, GCS_BUCKET)
+    backfill = EmbeddingBackfill(list_pending_documents, embed_shard, checkpoint,
+                                 shard_size=SHARD_SIZE, workers=BACKFILL_WORKERS, max_attempts=BACKFILL_MAX_ATTEMPTS)
+    summary = backfill.run()
+    if summary["documents_stored"]:
+        bump_corpus_generation()
+    return f"Embeddings processed successfully: {summary}"
 
 @functions_framework.http
 def generate_embeddings(request):
@@ -0,0 +1,99 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import unicodedata
+from array import array
+
+import pandas as pd
+from google.cloud import bigquery
+
+
+def content_hash(text, namespace=""):
+    """Key of a chunk's embedding: SHA-256 of the model name and the NFC-normalised, whitespace-collapsed text."""
+    normalised = " ".join(unicodedata.normalize("NFC", text).split())
+    return hashlib.sha256(f"{namespace}\n{normalised}".encode("utf-8")).hexdigest()
+
+
+def source_hash(text):
+    """Hash of a document's full text; equals TO_HEX(SHA256(text)) in BigQuery."""
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+class BigQueryHashStore:
+    """content_hash -> embedding table in BigQuery, clustered on content_hash so lookups prune."""
+
+    def __init__(self, bq_client, table_id):
+        self.bq_client = bq_client
+        self.table_id = table_id
+        table = bigquery.Table(table_id, schema=[
+            bigquery.SchemaField("content_hash", "STRING", mode="REQUIRED"),
+            bigquery.SchemaField("embedding", "FLOAT64", mode="REPEATED"),
+        ])
+        table.clustering_fields = ["content_hash"]
+        bq_client.create_table(table, exists_ok=True)
+
+    def get_many(self, hashes):
+        """Return {content_hash: embedding} for the hashes that are stored."""
+        if not hashes:
+            return {}
+        query = f"""
+        SELECT content_hash, ANY_VALUE(embedding) AS embedding
+        FROM `{self.table_id}`
+        WHERE content_hash IN UNNEST(@hashes)
+        GROUP BY content_hash
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("hashes", "STRING", list(hashes))]
+        )
+        try:
+            rows = self.bq_client.query(query, job_config=job_config).result()
+            return {row["content_hash"]: list(row["embedding"]) for row in rows}
+        except Exception as e:
+            logging.error(f"Error reading embedding hashes: {e}")
+            return {}
+
+    def put_many(self, embeddings):
+        """Append new {content_hash: embedding} entries with one load job."""
+        if not embeddings:
+            return
+        df = pd.DataFrame({"content_hash": list(embeddings), "embedding": list(embeddings.values())})
+        job_config = bigquery.LoadJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+        try:
+            self.bq_client.load_table_from_dataframe(df, self.table_id, job_config=job_config).result()
+        except Exception as e:
+            # Only costs a model call the next time the same text is seen.
+            logging.error(f"Error storing embedding hashes: {e}")
+
+
+class SqliteHashStore:
+    """content_hash -> embedding table in a local SQLite file, for local runs."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (content_hash TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+            )
+
+    def get_many(self, hashes):
+        hashes = list(hashes)
+        found = {}
+        with self._lock:
+            for i in range(0, len(hashes), 500):  # stay under SQLite's bound-parameter limit
+                part = hashes[i:i + 500]
+                rows = self._connection.execute(
+                    f"SELECT content_hash, vector FROM embeddings WHERE content_hash IN ({','.join('?' * len(part))})",
+                    part,
+                ).fetchall()
+                found.update((key, array("d", vector).tolist()) for key, vector in rows)
+        return found
+
+    def put_many(self, embeddings):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (content_hash, vector) VALUES (?, ?)",
+                [(key, array("d", vector).tobytes()) for key, vector in embeddings.items()],
+            )
@@ -0,0 +1 @@
+../store/documentSink.py
\ No newline at end of file
@@ -1,29 +1,42 @@
 import functions_framework
-import requests
+import os
+import time
 import pandas as pd
 import logging
-from google.cloud import bigquery
+from google.cloud import bigquery, storage
+from rateLimiter import RateLimitedSession
+from odataStream import GcsWatermarkStore, batched, build_url, iter_pages, iter_records, load_parquet, records_to_parquet
 
 # Google Cloud Configuration
 PROJECT_ID = "corded-forge-417909"  # Your Google Cloud Project ID
 BQ_DATASET_ID = "ProjectRAGMart"  # Your BigQuery Dataset
 BQ_TABLE_ID = f"{PROJECT_ID}.{BQ_DATASET_ID}.documents"  # BigQuery Table
+GCS_BUCKET = "projectragmart"  # Holds the incremental-sync watermarks
+INGEST_MODE = os.environ.get("INGEST_MODE", "stream")  # "stream" (nextLink + watermark) or "skip" (legacy paging)
+PAGE_PREFETCH = 4  # OData pages fetched ahead of the uploader
+# Parties involved in a document, stored as the Fracties column for filtered retrieval
+DOCUMENT_EXPAND = "DocumentActor($select=ActorFractie)"
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-# Initialize BigQuery client
+# Initialize BigQuery and Storage clients
 bq_client = bigquery.Client()
+storage_client = storage.Client()
+watermarks = GcsWatermarkStore(storage_client, GCS_BUCKET)
 
 BASE_URL = "https://gegevensmagazijn.tweedekamer.nl/OData/v4/2.0/"
 
+# Shared by all requests to the OData API: adaptive rate limit, Retry-After and backoff
+http = RateLimitedSession()
+
 def fetch_data(entity, top=100, skip=0, expand=None):
     """Fetch data from the overheid API."""
     url = f"{BASE_URL}{entity}?$top={top}&$skip={skip}"
     if expand:
         url += f"&$expand={expand}"
     
-    response = requests.get(url)
+    response = http.get(url, timeout=60)
     if response.status_code == 200:
         return response.json()
     else:
@@ -33,7 +46,7 @@ def fetch_data(entity, top=100, skip=0, expand=None):
 def get_total_count(entity):
     """Retrieve total document count from the overheid API."""
     url = f"{BASE_URL}{entity}/$count"
-    response = requests.get(url)
+    response = http.get(url, timeout=60)
     if response.status_code == 200:
         return int(response.text)
     else:
@@ -84,8 +97,65 @@ def gather_data(entity, expand=None, save_every=500):
     if data:
         upload_to_bigquery(data)
 
+    logging.info(f"Request metrics: {http.metrics()}")
+
     return f"Fetched and stored {len(existing_docs)} unique records."
 
+def get_stored_versions(ids):
+    """(Id, GewijzigdOp) pairs already stored in BigQuery for the given Ids."""
+    query = f"SELECT Id, GewijzigdOp FROM `{BQ_TABLE_ID}` WHERE Id IN UNNEST(@ids)"
+    job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ArrayQueryParameter("ids", "STRING", ids)])
+    return {(row["Id"], row["GewijzigdOp"]) for row in bq_client.query(query, job_config=job_config).result()}
+
+def with_fracties(records):
+    """Replace the expanded DocumentActor list by the distinct party names (Fracties)."""
+    for record in records:
+        actors = record.pop("DocumentActor", None) or []
+        record["Fracties"] = sorted({actor["ActorFractie"] for actor in actors if actor.get("ActorFractie")})
+        yield record
+
+def stream_data(entity, expand=None, batch_size=5000):
+    """Incrementally ingest records changed since the last watermark.
+
+    Pages are followed through @odata.nextLink (prefetched in the
+    background) and flow through a generator into Parquet batches of at
+    most batch_size records, so memory stays flat however large the
+    backlog is. The watermark is saved after every uploaded batch, so an
+    interrupted run resumes where it stopped.
+    """
+    since = watermarks.get(entity)
+    logging.info(f"Streaming {entity} records changed since {since or 'the beginning'}...")
+    url = build_url(BASE_URL, entity, expand=expand, since=since)
+
+    started = time.monotonic()
+    seen_at_watermark = set()  # (Id, GewijzigdOp) already stored with the current watermark timestamp
+    resume_since = since
+    total = 0
+    records = iter_records(iter_pages(http, url, prefetch=PAGE_PREFETCH))
+    if expand and expand.startswith("DocumentActor"):
+        records = with_fracties(records)
+    for batch in batched(records, batch_size):
+        if resume_since and batch[0]["GewijzigdOp"] == resume_since:
+            # Records at the saved watermark may already have been uploaded by the previous run.
+            seen_at_watermark |= get_stored_versions([row["Id"] for row in batch if row["GewijzigdOp"] == resume_since])
+        batch = [row for row in batch if (row["Id"], row.get("GewijzigdOp")) not in seen_at_watermark]
+        if not batch:
+            continue
+        load_parquet(bq_client, BQ_TABLE_ID, records_to_parquet(batch))
+        total += len(batch)
+
+        # Records arrive ordered by GewijzigdOp, so the last one holds the new watermark.
+        since = batch[-1]["GewijzigdOp"]
+        seen_at_watermark = {(row["Id"], since) for row in batch if row["GewijzigdOp"] == since}
+        watermarks.set(entity, since)
+        logging.info(f"Uploaded {len(batch)} {entity} records ({total} this run).")
+
+    elapsed = time.monotonic() - started
+    logging.info(f"Streamed {total} {entity} records in {elapsed:.1f}s "
+                 f"({total / elapsed if elapsed else 0.0:.1f} records/sec).")
+    logging.info(f"Request metrics: {http.metrics()}")
+    return f"Streamed {total} new or changed records."
+
 def upload_to_bigquery(data):
     """Upload document metadata to BigQuery, avoiding duplicates."""
     df = pd.DataFrame(data)
@@ -107,7 +177,10 @@ def upload_to_bigquery(data):
 def fetch_and_store_documents(request):
     """Cloud Function HTTP Entry Point."""
     try:
-        result = gather_data("Document", save_every=5000)
+        if INGEST_MODE == "stream":
+            result = stream_data("Document", expand=DOCUMENT_EXPAND, batch_size=5000)
+        else:
+            result = gather_data("Document", save_every=5000)
         return (result, 200)
     except Exception as e:
         logging.error(f"Error during execution: {e}")
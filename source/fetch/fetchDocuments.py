@@ -1,15 +1,17 @@
 import os
-import requests
-import time
 import logging
 from PyPDF2 import PdfReader
 from google.cloud import bigquery, storage
+from rateLimiter import RateLimitedSession
+from documentSink import BigQueryParquetBackend, DocumentSink, LocalParquetBackend
 
 # Google Cloud Configuration
 PROJECT_ID = "corded-forge-417909"  # Your Google Cloud Project ID
 BQ_DATASET_ID = "ProjectRAGMart"  # Your BigQuery Dataset
 BQ_TABLE_ID = f"{PROJECT_ID}.{BQ_DATASET_ID}.documents"  # BigQuery Table
 GCS_BUCKET = "projectragmart"  # Google Cloud Storage Bucket for PDFs
+PROCESSED_TABLE = f"{PROJECT_ID}.{BQ_DATASET_ID}.processed_documents"
+DOCUMENT_SINK_DIR = os.environ.get("DOCUMENT_SINK_DIR")  # Local Parquet directory instead of BigQuery (tests)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -18,6 +20,15 @@ logging.basicConfig(level=logging.INFO)
 bq_client = bigquery.Client()
 storage_client = storage.Client()
 
+# Adaptive rate limit with Retry-After handling and backoff for the resource downloads
+http = RateLimitedSession()
+
+# Buffered Parquet writer for processed_documents
+sink = DocumentSink(
+    LocalParquetBackend(DOCUMENT_SINK_DIR) if DOCUMENT_SINK_DIR
+    else BigQueryParquetBackend(bq_client, PROCESSED_TABLE)
+)
+
 # Cloud Function entry point
 def fetch_and_process_documents(request):
     """Cloud Function to fetch PDFs, extract text, and upload to BigQuery."""
@@ -52,7 +63,9 @@ def fetch_and_process_documents(request):
             upload_text_to_bigquery(document_id, title, subject, pdf_text)
             processed_docs.append(document_id)
 
+    sink.flush()
     logging.info(f"Processed {len(processed_docs)} documents.")
+    logging.info(f"Download metrics: {http.metrics()}")
     return f"Processed {len(processed_docs)} documents."
 
 def download_and_extract_text(document_id):
@@ -60,19 +73,20 @@ def download_and_extract_text(document_id):
     pdf_url = f"https://gegevensmagazijn.tweedekamer.nl/OData/v4/2.0/Document({document_id})/resource"
 
     try:
-        response = requests.get(pdf_url, stream=True)
-        if response.status_code == 200:
-            pdf_text = extract_text_from_pdf(response.content)
-            return pdf_text
+        # Closing the response frees its download slot in the rate limiter.
+        with http.get(pdf_url, stream=True, timeout=60) as response:
+            if response.status_code == 200:
+                pdf_text = extract_text_from_pdf(response.content)
+                return pdf_text
 
-        elif response.status_code == 429:
-            logging.warning(f"Rate limit reached (429) for {pdf_url}. Retrying after delay...")
-            time.sleep(20)  # Wait and retry
-            return None
+            elif response.status_code == 429:
+                # The rate limiter already retried with backoff; the document is picked up on the next run.
+                logging.warning(f"Rate limit reached (429) for {pdf_url}, still throttled after retries.")
+                return None
 
-        else:
-            logging.error(f"Failed to download {pdf_url}: {response.status_code}")
-            return None
+            else:
+                logging.error(f"Failed to download {pdf_url}: {response.status_code}")
+                return None
 
     except Exception as e:
         logging.error(f"Error downloading PDF {document_id}: {e}")
@@ -90,18 +104,5 @@ def extract_text_from_pdf(pdf_content):
         return None
 
 def upload_text_to_bigquery(document_id, title, subject, text):
-    """Upload extracted text to BigQuery."""
-    table_ref = bq_client.dataset(BQ_DATASET_ID).table("processed_documents")
-    rows_to_insert = [{
-        "document_id": document_id,
-        "title": title,
-        "subject": subject,
-        "text": text
-    }]
-    errors = bq_client.insert_rows_json(table_ref, rows_to_insert)
-    
-    if errors:
-        logging.error(f"Failed to insert into BigQuery: {errors}")
-    else:
-        logging.info(f"Uploaded document {document_id} to BigQuery.")
-
+    """Buffer extracted text for the next Parquet load into BigQuery."""
+    sink.add(document_id, title, subject, text)
@@ -0,0 +1,132 @@
+import io
+import json
+import logging
+import queue
+import threading
+from urllib.parse import quote
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+
+# End-of-stream marker for the prefetch queue.
+_DONE = object()
+WATERMARK_FIELD = "GewijzigdOp"
+
+
+def build_url(base_url, entity, top=250, expand=None, since=None):
+    """First page URL, ordered by modification time and optionally filtered on it."""
+    url = f"{base_url}{entity}?$top={top}&$orderby={WATERMARK_FIELD},Id"
+    if since:
+        # ge rather than gt: records sharing the watermark timestamp are re-read and deduplicated.
+        url += "&$filter=" + quote(f"{WATERMARK_FIELD} ge {since}")
+    if expand:
+        url += f"&$expand={expand}"
+    return url
+
+
+def iter_pages(http, first_url, prefetch=4):
+    """Yield OData pages by following @odata.nextLink.
+
+    A background thread fetches up to ``prefetch`` pages ahead of the
+    consumer, so downloading the next pages overlaps with processing (and
+    uploading) the current one. Errors are re-raised in the consumer.
+    """
+    pages = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def fetch():
+        url = first_url
+        try:
+            while url and not stop.is_set():
+                response = http.get(url, timeout=60)
+                response.raise_for_status()
+                page = response.json()
+                pages.put(page)
+                url = page.get("@odata.nextLink")
+            pages.put(_DONE)
+        except Exception as e:
+            pages.put(e)
+
+    thread = threading.Thread(target=fetch, name="odata-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is _DONE:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        stop.set()
+        # Unblock the fetcher if it is waiting on a full queue.
+        while thread.is_alive():
+            try:
+                pages.get_nowait()
+            except queue.Empty:
+                thread.join(timeout=0.1)
+
+
+def iter_records(pages):
+    """Flatten pages into records, dropping OData annotations."""
+    for page in pages:
+        for record in page.get("value", []):
+            yield {key: value for key, value in record.items() if not key.startswith("@")}
+
+
+def batched(records, size):
+    """Group an iterator into lists of at most size items."""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def records_to_parquet(records):
+    """Serialise a batch of records to an in-memory Parquet file."""
+    table = pa.Table.from_pylist(records)
+    for i, field in enumerate(table.schema):
+        # A batch where every list is empty infers list<null>; keep the column a string array.
+        if pa.types.is_list(field.type) and pa.types.is_null(field.type.value_type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.list_(pa.string())))
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression="snappy")
+    buffer.seek(0)
+    return buffer
+
+
+def load_parquet(bq_client, table_id, buffer):
+    """Append a Parquet buffer to a BigQuery table with a load job."""
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION],
+    )
+    # Load Parquet lists as ARRAY columns instead of nested list.element records.
+    job_config.parquet_options = bigquery.ParquetOptions()
+    job_config.parquet_options.enable_list_inference = True
+    bq_client.load_table_from_file(buffer, table_id, job_config=job_config).result()
+
+
+class GcsWatermarkStore:
+    """Persists the incremental-sync watermark per entity as a small JSON object in GCS."""
+
+    def __init__(self, storage_client, bucket_name, prefix="watermarks/"):
+        self.bucket = storage_client.bucket(bucket_name)
+        self.prefix = prefix
+
+    def get(self, entity):
+        blob = self.bucket.blob(f"{self.prefix}{entity}.json")
+        if not blob.exists():
+            return None
+        return json.loads(blob.download_as_text()).get(WATERMARK_FIELD)
+
+    def set(self, entity, watermark):
+        blob = self.bucket.blob(f"{self.prefix}{entity}.json")
+        blob.upload_from_string(json.dumps({WATERMARK_FIELD: watermark}), content_type="application/json")
+        logging.info(f"Watermark for {entity} is now {watermark}")
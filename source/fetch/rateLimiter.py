@@ -0,0 +1 @@
+../store/rateLimiter.py
\ No newline at end of file
@@ -0,0 +1,150 @@
+import atexit
+import glob
+import io
+import logging
+import os
+import threading
+import time
+import uuid
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+
+PROCESSED_SCHEMA = pa.schema([
+    ("document_id", pa.string()),
+    ("title", pa.string()),
+    ("subject", pa.string()),
+    ("text", pa.string()),
+])
+
+
+class BigQueryParquetBackend:
+    """Appends Arrow tables to a BigQuery table with Parquet load jobs."""
+
+    def __init__(self, bq_client, table_id):
+        self.bq_client = bq_client
+        self.table_id = table_id
+
+    def existing_ids(self, document_ids):
+        query = f"SELECT DISTINCT document_id FROM `{self.table_id}` WHERE document_id IN UNNEST(@ids)"
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("ids", "STRING", list(document_ids))]
+        )
+        return {row["document_id"] for row in self.bq_client.query(query, job_config=job_config).result()}
+
+    def write(self, table):
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, compression="snappy")
+        buffer.seek(0)
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        )
+        self.bq_client.load_table_from_file(buffer, self.table_id, job_config=job_config).result()
+
+
+class LocalParquetBackend:
+    """Writes Parquet files to a local directory; stands in for BigQuery in tests."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def existing_ids(self, document_ids):
+        wanted = set(document_ids)
+        found = set()
+        for path in glob.glob(os.path.join(self.directory, "*.parquet")):
+            ids = pq.read_table(path, columns=["document_id"]).column("document_id").to_pylist()
+            found.update(wanted.intersection(ids))
+        return found
+
+    def write(self, table):
+        path = os.path.join(self.directory, f"part-{int(time.time())}-{uuid.uuid4().hex[:8]}.parquet")
+        pq.write_table(table, f"{path}.tmp", compression="snappy")
+        os.replace(f"{path}.tmp", path)
+
+
+class DocumentSink:
+    """Buffers extracted documents and writes them as Arrow/Parquet batches.
+
+    A batch is flushed when it reaches ``max_rows`` rows or ``max_bytes`` of
+    text, when the oldest buffered row is ``max_age`` seconds old, and on
+    interpreter shutdown. Flushes are idempotent per document_id: ids already
+    written by this sink or already present in the backend are dropped.
+    """
+
+    def __init__(self, backend, max_rows=1000, max_bytes=64 * 1024 * 1024, max_age=60.0):
+        self.backend = backend
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.written = 0
+        self._buffer = {}  # document_id -> row, keeps the last version of a duplicate
+        self._buffer_bytes = 0
+        self._oldest = None
+        self._written_ids = set()
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        self._timer = threading.Thread(target=self._flush_on_age, name="document-sink", daemon=True)
+        self._timer.start()
+        atexit.register(self.close)
+
+    def add(self, document_id, title, subject, text):
+        """Buffer one document, flushing when the size limits are reached."""
+        with self._lock:
+            if document_id in self._written_ids:
+                return
+            previous = self._buffer.pop(document_id, None)
+            if previous is not None:
+                self._buffer_bytes -= len(previous["text"] or "")
+            self._buffer[document_id] = {"document_id": document_id, "title": title,
+                                         "subject": subject, "text": text}
+            self._buffer_bytes += len(text or "")
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if len(self._buffer) >= self.max_rows or self._buffer_bytes >= self.max_bytes:
+                self.flush()
+
+    def flush(self):
+        """Write the buffered documents and return the number written (errors are re-raised).
+
+        The buffer is only emptied once the batch is written; after a failure
+        the documents stay buffered for the next flush.
+        """
+        with self._lock:
+            if not self._buffer:
+                return 0
+            rows = list(self._buffer.values())
+            try:
+                existing = self.backend.existing_ids([row["document_id"] for row in rows])
+                rows = [row for row in rows if row["document_id"] not in existing]
+                if rows:
+                    self.backend.write(pa.Table.from_pylist(rows, schema=PROCESSED_SCHEMA))
+            except Exception as e:
+                logging.error(f"❌ Failed to write {len(rows)} documents: {e}")
+                self._oldest = time.monotonic()  # the age timer retries after another max_age
+                raise
+            self._buffer = {}
+            self._buffer_bytes = 0
+            self._oldest = None
+            self._written_ids.update(row["document_id"] for row in rows)
+            self.written += len(rows)
+            logging.info(f"✅ Wrote {len(rows)} documents ({len(existing)} already present).")
+            return len(rows)
+
+    def _flush_on_age(self):
+        while not self._closed.wait(1.0):
+            with self._lock:
+                expired = self._oldest is not None and time.monotonic() - self._oldest >= self.max_age
+            if expired:
+                try:
+                    self.flush()
+                except Exception:
+                    pass  # already logged; the rows stay buffered for the next flush
+
+    def close(self):
+        """Stop the age timer and write what is left in the buffer."""
+        if not self._closed.is_set():
+            self._closed.set()
+            self.flush()
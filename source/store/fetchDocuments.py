@@ -1,17 +1,50 @@
 import os
-import requests
-import time
 import logging
-from io import BytesIO
-from PyPDF2 import PdfReader
+from datetime import datetime, timezone
+import pyarrow as pa
 from google.cloud import bigquery, storage
+from pipeline import DocumentPipeline, make_session
+from rateLimiter import RateLimitedSession
+from documentSink import BigQueryParquetBackend, DocumentSink, LocalParquetBackend
+from pdfExtract import ISSUE_SCHEMA, ExtractionPool, SpooledPdf
 
 # Google Cloud Configuration
 PROJECT_ID = "corded-forge-417909"
 BQ_DATASET_ID = "ProjectRAGMart"
 BQ_TABLE_ID = f"{PROJECT_ID}.{BQ_DATASET_ID}.documents"
 PROCESSED_TABLE = f"{PROJECT_ID}.{BQ_DATASET_ID}.processed_documents"
+ISSUES_TABLE = f"{PROJECT_ID}.{BQ_DATASET_ID}.extraction_issues"
 GCS_BUCKET = "projectragmart"
+# Base URL is configurable so the pipeline can be run against a local HTTP server with sample PDFs
+DOCUMENT_BASE_URL = os.environ.get("DOCUMENT_BASE_URL", "https://gegevensmagazijn.tweedekamer.nl/OData/v4/2.0")
+DOCUMENT_URL = DOCUMENT_BASE_URL + "/Document({document_id})/resource"
+QUERY_BATCH_SIZE = 1000
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 8))
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", 0)) or None  # None = one per core
+UPLOAD_BATCH_SIZE = 50
+# Optional local directory that receives the Parquet batches instead of BigQuery (for tests)
+DOCUMENT_SINK_DIR = os.environ.get("DOCUMENT_SINK_DIR")
+DOWNLOAD_TIMEOUT = 60  # seconds
+# Per-document extraction limits. Downloads are spooled to SPOOL_DIR (default: the temp dir, which is
+# memory-backed on Cloud Functions, so MAX_PDF_BYTES also bounds that) and parsed page by page.
+MAX_PDF_BYTES = int(os.environ.get("MAX_PDF_BYTES", 50 * 1024 * 1024))
+MAX_PDF_PAGES = int(os.environ.get("MAX_PDF_PAGES", 500))
+MAX_TEXT_CHARS = int(os.environ.get("MAX_TEXT_CHARS", 2_000_000))
+MAX_EXTRACT_SECONDS = float(os.environ.get("MAX_EXTRACT_SECONDS", 120))
+MAX_EXTRACT_MEMORY_MB = int(os.environ.get("MAX_EXTRACT_MEMORY_MB", 0))  # 0 = no address-space limit per worker
+SPOOL_DIR = os.environ.get("SPOOL_DIR") or None
+ISSUES_BQ_SCHEMA = [
+    bigquery.SchemaField("document_id", "STRING"),
+    bigquery.SchemaField("status", "STRING"),
+    bigquery.SchemaField("detail", "STRING"),
+    bigquery.SchemaField("bytes", "INTEGER"),
+    bigquery.SchemaField("pages", "INTEGER"),
+    bigquery.SchemaField("seconds", "FLOAT"),
+    bigquery.SchemaField("max_bytes", "INTEGER"),
+    bigquery.SchemaField("max_pages", "INTEGER"),
+    bigquery.SchemaField("max_seconds", "FLOAT"),
+    bigquery.SchemaField("recorded_at", "TIMESTAMP"),
+]
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -20,92 +53,148 @@ logging.basicConfig(level=logging.INFO)
 bq_client = bigquery.Client()
 storage_client = storage.Client()
 
-def fetch_and_process_documents(request):
-    """Cloud Function to fetch PDFs, extract text, and upload to BigQuery."""
-    logging.info("Starting document processing...")
-
-    while True:  # 🚀 Keep processing until there are no more documents
-        # Query BigQuery for unprocessed documents
-        query = f"""
-        SELECT Id, Titel, Onderwerp, ContentType
-        FROM `{BQ_TABLE_ID}`
-        WHERE ContentType = 'application/pdf'
-        AND Id NOT IN (SELECT document_id FROM `{PROCESSED_TABLE}`)
-        LIMIT 100  -- Process in batches of 100
-        """
-        query_job = bq_client.query(query)
-        results = query_job.result()
-
-        # If no more results, stop processing
-        if results.total_rows == 0:
-            logging.info("✅ All documents have been processed.")
-            return "✅ All documents have been processed."
-
-        processed_docs = []
+# Shared pooled session with an adaptive rate limit, Retry-After handling and backoff
+http = RateLimitedSession(make_session(DOWNLOAD_WORKERS), max_concurrency=DOWNLOAD_WORKERS)
 
-        for row in results:
-            document_id = row["Id"]
-            title = row["Titel"]
-            subject = row["Onderwerp"]
+# Buffered Parquet writer for processed_documents (flushed by size, age, after each batch and at exit)
+sink = DocumentSink(
+    LocalParquetBackend(DOCUMENT_SINK_DIR) if DOCUMENT_SINK_DIR
+    else BigQueryParquetBackend(bq_client, PROCESSED_TABLE)
+)
 
-            # Download PDF
-            pdf_text = download_and_extract_text(document_id)
+# Truncated and skipped documents, with the limits in force when they were recorded
+issues_backend = (
+    LocalParquetBackend(os.path.join(DOCUMENT_SINK_DIR, "extraction_issues")) if DOCUMENT_SINK_DIR
+    else BigQueryParquetBackend(bq_client, ISSUES_TABLE)
+)
 
-            if pdf_text:
-                # Upload text to BigQuery
-                upload_text_to_bigquery(document_id, title, subject, pdf_text)
-                processed_docs.append(document_id)
+def make_extraction_pool(workers):
+    """Extraction worker processes with the configured per-document limits."""
+    return ExtractionPool(workers=workers, max_pages=MAX_PDF_PAGES, max_chars=MAX_TEXT_CHARS,
+                          max_seconds=MAX_EXTRACT_SECONDS,
+                          memory_limit=MAX_EXTRACT_MEMORY_MB * 1024 * 1024 or None)
 
-        logging.info(f"✅ Processed {len(processed_docs)} documents.")
-
-        # Short delay to prevent API rate limits (optional)
-        time.sleep(2)
+def fetch_and_process_documents(request):
+    """Cloud Function to fetch PDFs, extract text, and upload to BigQuery."""
+    logging.info("Starting document processing...")
+    if not DOCUMENT_SINK_DIR:
+        # The selection query reads this table, so it has to exist before the first issue is written.
+        bq_client.create_table(bigquery.Table(ISSUES_TABLE, schema=ISSUES_BQ_SCHEMA), exists_ok=True)
+    with make_extraction_pool(EXTRACT_WORKERS) as extractor:
+        pipeline = DocumentPipeline(
+            download=download_pdf,
+            extract=extractor.extract,
+            store=upload_texts_to_bigquery,
+            download_workers=DOWNLOAD_WORKERS,
+            extract_workers=extractor.workers,
+            batch_size=UPLOAD_BATCH_SIZE,
+            session=http,
+        )
+        skipped = set()  # Documents that failed in this run, so they are not selected again
+
+        while True:  # 🚀 Keep processing until there are no more documents
+            # Query BigQuery for unprocessed documents. Documents that were skipped under limits at
+            # least as strict as the current ones are left out; raising a limit retries them.
+            issue_filter = "" if DOCUMENT_SINK_DIR else f"""
+            AND Id NOT IN (
+                SELECT document_id FROM `{ISSUES_TABLE}`
+                WHERE status != 'truncated'
+                AND max_bytes >= {MAX_PDF_BYTES} AND max_pages >= {MAX_PDF_PAGES}
+                AND max_seconds >= {MAX_EXTRACT_SECONDS}
+            )"""
+            query = f"""
+            SELECT Id, Titel, Onderwerp, ContentType
+            FROM `{BQ_TABLE_ID}`
+            WHERE ContentType = 'application/pdf'
+            AND Id NOT IN (SELECT document_id FROM `{PROCESSED_TABLE}`){issue_filter}
+            AND Id NOT IN UNNEST(@skipped)
+            LIMIT {QUERY_BATCH_SIZE}
+            """
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[bigquery.ArrayQueryParameter("skipped", "STRING", sorted(skipped))]
+            )
+            rows = list(bq_client.query(query, job_config=job_config).result())
+
+            # If no more results, stop processing
+            if not rows:
+                logging.info("✅ All documents have been processed.")
+                return "✅ All documents have been processed."
+
+            stats = pipeline.run(rows)
+            sink.flush()  # make the batch visible to the NOT IN query before selecting the next one
+            record_extraction_issues(pipeline.stats.issues)
+            logging.info(f"✅ Processed {stats['stored']} documents ({stats['docs_per_second']} docs/sec, "
+                         f"{stats['download_mb_per_second']} MB/s downloaded, {stats['extract_ms_per_page']} ms/page extracted, "
+                         f"{stats['truncated']} truncated, {stats['too_large']} too large, {stats['timeout']} timed out).")
+            logging.info(f"Download metrics: {http.metrics()}")
+
+            # Failed documents are skipped for the rest of this run and retried on the next invocation.
+            skipped.update(row["Id"] for row in pipeline.stats.failed)
+
+def record_extraction_issues(issues):
+    """Write the truncated and skipped documents of a batch to the extraction_issues table."""
+    if not issues:
+        return
+    recorded_at = datetime.now(timezone.utc)
+    rows = [{
+        "document_id": row["Id"],
+        "status": extraction.status,
+        "detail": extraction.detail,
+        "bytes": extraction.size,
+        "pages": extraction.pages,
+        "seconds": round(extraction.seconds, 3),
+        "max_bytes": MAX_PDF_BYTES,
+        "max_pages": MAX_PDF_PAGES,
+        "max_seconds": MAX_EXTRACT_SECONDS,
+        "recorded_at": recorded_at,
+    } for row, extraction in issues]
+    try:
+        issues_backend.write(pa.Table.from_pylist(rows, schema=ISSUE_SCHEMA))
+    except Exception as e:
+        # Not fatal: the documents are simply selected again on the next run.
+        logging.error(f"❌ Failed to record {len(rows)} extraction issues: {e}")
 
-def download_and_extract_text(document_id):
-    """Download a PDF and extract its text."""
-    pdf_url = f"https://gegevensmagazijn.tweedekamer.nl/OData/v4/2.0/Document({document_id})/resource"
+def download_pdf(session, row):
+    """Stream the PDF of a document row to a temporary file and return it as a SpooledPdf."""
+    document_id = row["Id"]
+    pdf_url = DOCUMENT_URL.format(document_id=document_id)
 
-    try:
-        response = requests.get(pdf_url, stream=True)
+    # Closing the response frees its download slot in the rate limiter.
+    with session.get(pdf_url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
         if response.status_code == 200:
-            return extract_text_from_pdf(response.content)
+            spooled = SpooledPdf.from_response(response, SPOOL_DIR, MAX_PDF_BYTES)
+            if spooled.too_large:
+                logging.warning(f"⚠️ Skipping {pdf_url}: larger than {MAX_PDF_BYTES} bytes.")
+            return spooled
 
         elif response.status_code == 429:
-            logging.warning(f"⚠️ Rate limit reached (429) for {pdf_url}. Retrying after delay...")
-            time.sleep(20)
+            # The rate limiter already retried with backoff; the document is retried on the next run.
+            logging.warning(f"⚠️ Rate limit reached (429) for {pdf_url}, still throttled after retries.")
             return None
 
         else:
             logging.error(f"❌ Failed to download {pdf_url}: {response.status_code}")
             return None
 
+def download_and_extract_text(document_id):
+    """Download a PDF and extract its text (within the same limits as the pipeline)."""
+    try:
+        spooled = download_pdf(http, {"Id": document_id})
+        if spooled is None:
+            return None
+        with make_extraction_pool(1) as extractor:
+            return extractor.extract(spooled).text
+
     except Exception as e:
         logging.error(f"❌ Error downloading PDF {document_id}: {e}")
         return None
 
-def extract_text_from_pdf(pdf_content):
-    """Extract text from a PDF byte stream."""
-    try:
-        pdf_file = BytesIO(pdf_content)
-        reader = PdfReader(pdf_file)
-        text = "".join(page.extract_text() or "" for page in reader.pages)
-        return text.strip() if text.strip() else None
-    except Exception as e:
-        logging.error(f"❌ Error extracting text: {e}")
-        return None
+def upload_texts_to_bigquery(records):
+    """Hand a batch of (row, text) records to the buffered sink; returns the records that failed."""
+    for row, text in records:
+        upload_text_to_bigquery(row["Id"], row["Titel"], row["Onderwerp"], text)
+    return []
 
 def upload_text_to_bigquery(document_id, title, subject, text):
-    """Upload extracted text to BigQuery."""
-    table_ref = bq_client.dataset(BQ_DATASET_ID).table("processed_documents")
-    rows_to_insert = [{
-        "document_id": document_id,
-        "title": title if title else "Unknown",
-        "subject": subject if subject else "Unknown",
-        "text": text
-    }]
-    errors = bq_client.insert_rows_json(table_ref, rows_to_insert)
-
-    if errors:
-        logging.error(f"❌ Failed to insert into BigQuery: {errors}")
-    else:
-        logging.info(f"✅ Uploaded document {document_id} to BigQuery.")
+    """Buffer extracted text for the next Parquet load into BigQuery."""
+    sink.add(document_id, title if title else "Unknown", subject if subject else "Unknown", text)
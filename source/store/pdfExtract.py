@@ -0,0 +1,241 @@
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import tempfile
+import time
+from collections import namedtuple
+
+import pyarrow as pa
+from PyPDF2 import PdfReader
+
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Outcome of one document. ``status`` is one of
+#   ok         all pages extracted
+#   truncated  a page, character or time limit was hit; ``text`` holds what was extracted before it
+#   too_large  the download exceeded the byte limit and was not parsed
+#   timeout    no page finished within the time limit (the worker was killed)
+#   empty      the PDF has no extractable text (e.g. scanned pages)
+#   failed     the PDF could not be parsed or the worker died
+# ``detail`` names the limit that was hit or the error, ``size`` is the downloaded size in bytes.
+Extraction = namedtuple("Extraction", "text pages status seconds detail size")
+
+ISSUE_SCHEMA = pa.schema([
+    ("document_id", pa.string()),
+    ("status", pa.string()),
+    ("detail", pa.string()),
+    ("bytes", pa.int64()),
+    ("pages", pa.int64()),
+    ("seconds", pa.float64()),
+    ("max_bytes", pa.int64()),
+    ("max_pages", pa.int64()),
+    ("max_seconds", pa.float64()),
+    ("recorded_at", pa.timestamp("us", tz="UTC")),
+])
+
+
+class SpooledPdf:
+    """A downloaded PDF in a temporary file; ``too_large`` downloads keep no file at all.
+
+    ``size`` is the (declared) size of the PDF, ``downloaded`` the bytes actually read.
+    """
+
+    def __init__(self, path, size, too_large=False, downloaded=None):
+        self.path = path
+        self.size = size
+        self.too_large = too_large
+        self.downloaded = size if downloaded is None else downloaded
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def from_chunks(cls, chunks, directory=None, max_bytes=None, expected_size=None):
+        """Write an iterable of byte chunks to a temporary file, stopping once it exceeds max_bytes."""
+        if max_bytes and expected_size and expected_size > max_bytes:
+            return cls(None, expected_size, too_large=True, downloaded=0)
+        handle = tempfile.NamedTemporaryFile(prefix="pdf-", suffix=".pdf", dir=directory, delete=False)
+        size = 0
+        try:
+            with handle:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if max_bytes and size > max_bytes:
+                        os.unlink(handle.name)
+                        return cls(None, size, too_large=True)
+                    handle.write(chunk)
+        except BaseException:
+            if os.path.exists(handle.name):
+                os.unlink(handle.name)
+            raise
+        return cls(handle.name, size)
+
+    @classmethod
+    def from_response(cls, response, directory=None, max_bytes=None):
+        """Stream a ``requests`` response (opened with stream=True) to disk."""
+        expected = response.headers.get("Content-Length")
+        try:
+            return cls.from_chunks(response.iter_content(DOWNLOAD_CHUNK_BYTES), directory, max_bytes,
+                                   int(expected) if expected and expected.isdigit() else None)
+        finally:
+            response.close()
+
+    def discard(self):
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+        self.path = None
+
+
+def iter_page_texts(reader):
+    """Yield the text of each page of a PdfReader, one page at a time."""
+    for page in reader.pages:
+        yield page.extract_text() or ""
+
+
+def _worker_main(connection, memory_limit):
+    """Extraction worker: receives (path, max_pages, max_chars) jobs and streams pages back."""
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    while True:
+        job = connection.recv()
+        if job is None:
+            return
+        path, max_pages, max_chars = job
+        try:
+            with open(path, "rb") as handle:
+                # An open file is parsed lazily; PdfReader(path) would load the whole file into memory.
+                reader = PdfReader(handle)
+                total, chars, limit = len(reader.pages), 0, None
+                for number, text in enumerate(iter_page_texts(reader)):
+                    if number >= max_pages:
+                        limit = "pages"
+                        break
+                    connection.send(("page", text))
+                    chars += len(text)
+                    if chars >= max_chars:
+                        limit = "chars"
+                        break
+            connection.send(("done", total, limit))
+        except MemoryError:
+            connection.send(("error", "out of memory"))
+        except Exception as e:
+            connection.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class _Worker:
+    def __init__(self, context, memory_limit):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child, memory_limit), daemon=True)
+        self.process.start()
+        child.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(timeout=5)
+        self.connection.close()
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+            self.process.join(timeout=5)
+        except (BrokenPipeError, OSError):
+            pass
+        if self.process.is_alive():
+            self.kill()
+
+
+class ExtractionPool:
+    """Worker processes that extract PDF text page by page under per-document limits.
+
+    ``extract(spooled)`` can be called from several threads; each call takes
+    an idle worker, which opens the file lazily and sends the pages back one
+    by one. The caller stops at ``max_pages`` pages or ``max_chars``
+    characters and kills the worker after ``max_seconds``; a killed or
+    crashed worker is replaced. With ``memory_limit`` (bytes of address space)
+    a worker fails with MemoryError instead of exhausting the instance.
+    Peak memory per worker therefore depends on the page, not the file size.
+    """
+
+    def __init__(self, workers=None, max_pages=500, max_chars=2_000_000, max_seconds=120.0, memory_limit=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pages = max_pages
+        self.max_chars = max_chars
+        self.max_seconds = max_seconds
+        self.memory_limit = memory_limit
+        # Not fork: the pipeline runs threads, whose locks a forked child could inherit held. The fork
+        # server imports this module (and PyPDF2) once, so new workers still start without imports.
+        self._context = multiprocessing.get_context("forkserver")
+        self._context.set_forkserver_preload([__name__])
+        self._idle = queue.Queue()
+        for _ in range(self.workers):
+            self._idle.put(self._spawn())
+
+    def _spawn(self):
+        return _Worker(self._context, self.memory_limit)
+
+    def extract(self, spooled):
+        """Extract the text of a SpooledPdf (the file is deleted afterwards); returns an Extraction."""
+        if spooled.too_large:
+            return Extraction(None, 0, "too_large", 0.0, "bytes", spooled.size)
+        pages = []
+        worker = self._idle.get()
+        started = time.monotonic()  # the time limit starts once a worker has the document
+        try:
+            try:
+                worker.connection.send((spooled.path, self.max_pages, self.max_chars))
+            except (BrokenPipeError, OSError):
+                # The worker died while idle (e.g. killed by the OOM killer); it must not go back in the pool.
+                worker.kill()
+                worker = self._spawn()
+                worker.connection.send((spooled.path, self.max_pages, self.max_chars))
+            while True:
+                remaining = started + self.max_seconds - time.monotonic()
+                if remaining <= 0 or not worker.connection.poll(remaining):
+                    worker.kill()
+                    worker = self._spawn()
+                    status, detail, total = ("truncated" if pages else "timeout"), "seconds", None
+                    break
+                try:
+                    message = worker.connection.recv()
+                except (EOFError, OSError):
+                    worker.kill()
+                    status, detail, total = "failed", f"worker exited ({worker.process.exitcode})", None
+                    worker = self._spawn()
+                    break
+                if message[0] == "page":
+                    pages.append(message[1])
+                elif message[0] == "done":
+                    total, detail = message[1], message[2]
+                    status = "truncated" if detail else "ok"
+                    break
+                else:
+                    status, detail, total = "failed", message[1], None
+                    break
+        finally:
+            self._idle.put(worker)
+            spooled.discard()
+
+        # Pages are joined without separator, exactly like the previous extraction, so
+        # unchanged documents keep their source_hash and are not re-embedded. A failed
+        # document returns no text, so a partial parse is never stored as complete.
+        text = None if status == "failed" else "".join(pages).strip() or None
+        if text is None and status in ("ok", "truncated"):
+            status, detail = "empty", None
+        if status == "truncated":
+            logging.warning(f"⚠️ Extraction stopped at the {detail} limit after {len(pages)} of {total or '?'} pages.")
+        return Extraction(text, len(pages), status, time.monotonic() - started, detail, spooled.size)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,213 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# End-of-stream marker passed between the stages.
+_DONE = object()
+
+
+def make_session(pool_size):
+    """A requests session whose connection pool is shared by all download workers."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class PipelineStats:
+    """Thread-safe counters for one pipeline run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"queued": 0, "downloaded": 0, "download_failed": 0, "bytes_downloaded": 0,
+                       "extracted": 0, "extract_failed": 0, "stored": 0,
+                       "pages_extracted": 0, "extract_seconds": 0.0,
+                       "truncated": 0, "too_large": 0, "timeout": 0, "empty": 0}
+        self.failed = []  # rows that were not stored, so callers can skip or retry them
+        self.issues = []  # (row, extraction) of documents that were truncated or could not be extracted
+        self.started_at = time.monotonic()
+
+    def fail(self, row, counter=None):
+        with self._lock:
+            self.failed.append(row)
+            if counter:
+                self.counts[counter] += 1
+
+    def issue(self, row, extraction):
+        with self._lock:
+            self.issues.append((row, extraction))
+            if extraction.status in self.counts:
+                self.counts[extraction.status] += 1
+
+    def add(self, name, amount=1):
+        with self._lock:
+            self.counts[name] += amount
+
+    def summary(self):
+        with self._lock:
+            elapsed = time.monotonic() - self.started_at
+            pages = self.counts["pages_extracted"]
+            return dict(self.counts, seconds=round(elapsed, 2),
+                        extract_seconds=round(self.counts["extract_seconds"], 2),
+                        docs_per_second=round(self.counts["stored"] / elapsed, 2) if elapsed else 0.0,
+                        download_mb_per_second=round(self.counts["bytes_downloaded"] / elapsed / 1e6, 2) if elapsed else 0.0,
+                        extract_ms_per_page=round(1000 * self.counts["extract_seconds"] / pages, 1) if pages else 0.0)
+
+
+class DocumentPipeline:
+    """Staged download -> extract -> store pipeline for PDF documents.
+
+    * ``download(session, row)`` runs in ``download_workers`` threads that
+      share one pooled HTTP session (``session``, or a new one per run) and
+      returns the downloaded PDF (or None); the payload only needs a length,
+      e.g. bytes or a pdfExtract.SpooledPdf. A payload with a ``discard``
+      method (the spooled file) is discarded once it has been extracted.
+    * ``extract(payload)`` runs in ``extract_workers`` threads and returns a
+      pdfExtract.Extraction; the parsing itself belongs in worker processes
+      (pdfExtract.ExtractionPool) so it uses every core and can be killed.
+      Truncated documents are stored with the text extracted so far; every
+      status other than ``ok`` is listed in ``stats.issues``.
+    * ``store(records)`` receives batches of ``(row, text)`` tuples of up to
+      ``batch_size`` records, flushed at least every ``flush_interval`` seconds,
+      and returns the records it could not store.
+
+    The stages are connected by bounded queues, so a slow stage blocks the
+    stage before it instead of buffering the whole backlog in memory.
+    """
+
+    def __init__(self, download, extract, store, download_workers=8, extract_workers=None,
+                 queue_size=64, batch_size=50, flush_interval=5.0, session=None):
+        self.download = download
+        self.extract = extract
+        self.store = store
+        self.download_workers = download_workers
+        self.extract_workers = extract_workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.session = session
+        self.stats = None
+
+    def run(self, rows):
+        """Process all rows and return the run statistics (``self.stats.failed`` lists failed rows)."""
+        self.stats = PipelineStats()
+        download_queue = queue.Queue(maxsize=self.queue_size)
+        extract_queue = queue.Queue(maxsize=self.queue_size)
+        store_queue = queue.Queue(maxsize=self.queue_size)
+        session = self.session or make_session(self.download_workers)
+
+        downloaders = [
+            threading.Thread(target=self._download_worker, args=(session, download_queue, extract_queue),
+                             name=f"pdf-download-{i}", daemon=True)
+            for i in range(self.download_workers)
+        ]
+        extractors = [
+            threading.Thread(target=self._extract_worker, args=(extract_queue, store_queue),
+                             name=f"pdf-extract-{i}", daemon=True)
+            for i in range(self.extract_workers)
+        ]
+        storer = threading.Thread(target=self._store_worker, args=(store_queue,), name="pdf-store", daemon=True)
+        for thread in downloaders + extractors + [storer]:
+            thread.start()
+
+        try:
+            for row in rows:
+                download_queue.put(row)  # blocks while the downloaders are saturated
+                self.stats.add("queued")
+        finally:
+            for _ in downloaders:
+                download_queue.put(_DONE)
+            for thread in downloaders:
+                thread.join()
+            for _ in extractors:
+                extract_queue.put(_DONE)
+            for thread in extractors:
+                thread.join()
+            store_queue.put(_DONE)
+            storer.join()
+            if self.session is None:
+                session.close()
+
+        summary = self.stats.summary()
+        logging.info(f"Pipeline finished: {summary}")
+        return summary
+
+    def _download_worker(self, session, download_queue, extract_queue):
+        while True:
+            row = download_queue.get()
+            if row is _DONE:
+                return
+            try:
+                payload = self.download(session, row)
+            except Exception as e:
+                logging.error(f"Error downloading {row}: {e}")
+                payload = None
+            if payload is not None:  # an empty PDF is still a download
+                self.stats.add("downloaded")
+                # A too_large SpooledPdf reports its declared size, but only part of it was read.
+                self.stats.add("bytes_downloaded", getattr(payload, "downloaded", len(payload)))
+                extract_queue.put((row, payload))
+            else:
+                self.stats.fail(row, "download_failed")
+
+    def _extract_worker(self, extract_queue, store_queue):
+        while True:
+            item = extract_queue.get()
+            if item is _DONE:
+                return
+            row, payload = item
+            try:
+                extraction = self.extract(payload)
+            except Exception as e:
+                logging.error(f"Error extracting text for {row}: {e}")
+                self.stats.fail(row, "extract_failed")
+                continue
+            finally:
+                discard = getattr(payload, "discard", None)
+                if discard is not None:
+                    discard()
+            self.stats.add("pages_extracted", extraction.pages)
+            self.stats.add("extract_seconds", extraction.seconds)
+            if extraction.status != "ok":
+                self.stats.issue(row, extraction)
+            if extraction.text:
+                self.stats.add("extracted")
+                store_queue.put((row, extraction.text))
+            else:
+                self.stats.fail(row, "extract_failed")
+
+    def _store_worker(self, store_queue):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = store_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+            if item is _DONE:
+                break
+            if item is not None:
+                batch.append(item)
+            if len(batch) >= self.batch_size or (batch and time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.flush_interval
+        if batch:
+            self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            failed = self.store(batch) or []
+        except Exception as e:
+            logging.error(f"Error storing {len(batch)} documents: {e}")
+            failed = batch
+        self.stats.add("stored", len(batch) - len(failed))
+        for row, _ in failed:
+            self.stats.fail(row)
@@ -0,0 +1,213 @@
+import email.utils
+import logging
+import random
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import requests
+
+# Status codes that mean "slow down" rather than "this request is wrong".
+THROTTLE_STATUSES = {429, 503}
+RETRY_STATUSES = THROTTLE_STATUSES | {500, 502, 504}
+RATE_WINDOW = 60.0  # seconds over which the effective request rate is measured
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class HostLimiter:
+    """Token bucket plus AIMD concurrency limit for a single host.
+
+    Every success raises the request rate additively (and the concurrency
+    limit after ``rate_increase_every`` successes); a throttle response
+    halves both and pauses the host until Retry-After has passed.
+    """
+
+    def __init__(self, rate, burst, max_rate, initial_concurrency, max_concurrency,
+                 rate_increase=0.1, rate_increase_every=10):
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max_rate
+        self.min_rate = 0.1
+        self.concurrency_limit = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.rate_increase = rate_increase
+        self.rate_increase_every = rate_increase_every
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.in_flight = 0
+        self.successes_since_increase = 0
+        self.counts = {"requests": 0, "succeeded": 0, "throttled": 0, "retries": 0, "failed": 0, "bytes": 0}
+        self.recent = deque()  # monotonic timestamps of requests in the last RATE_WINDOW seconds
+        self._condition = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        """Block until this host has a free concurrency slot and a token."""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = max(0.0, self.paused_until - now)
+                if not wait and self.in_flight < self.concurrency_limit and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    self.counts["requests"] += 1
+                    self.recent.append(now)
+                    return
+                if not wait and self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                # Slots are signalled by release(); token and pause waits are timed.
+                self._condition.wait(timeout=wait or None)
+
+    def release(self, outcome, retry_after=None):
+        """Return the slot and adapt the limits to the outcome of the request."""
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == "throttled":
+                self.counts["throttled"] += 1
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.concurrency_limit = max(1, self.concurrency_limit // 2)
+                self.successes_since_increase = 0
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            elif outcome == "succeeded":
+                self.counts["succeeded"] += 1
+                self.rate = min(self.max_rate, self.rate + self.rate_increase)
+                self.successes_since_increase += 1
+                if self.successes_since_increase >= self.rate_increase_every:
+                    self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1)
+                    self.successes_since_increase = 0
+            self._condition.notify_all()
+
+    def record(self, name, amount=1):
+        with self._condition:
+            self.counts[name] += amount
+
+    def metrics(self):
+        with self._condition:
+            now = time.monotonic()
+            while self.recent and now - self.recent[0] > RATE_WINDOW:
+                self.recent.popleft()
+            return dict(
+                self.counts,
+                rate_limit=round(self.rate, 2),
+                concurrency_limit=self.concurrency_limit,
+                effective_rate=round(len(self.recent) / RATE_WINDOW, 2),
+            )
+
+
+def release_on_close(response, limiter, outcome):
+    """Release the limiter slot of a streamed response once, when the response is closed."""
+    close = response.close
+    released = False
+
+    def close_and_release():
+        nonlocal released
+        try:
+            close()
+        finally:
+            if not released:
+                released = True
+                limiter.release(outcome)
+
+    response.close = close_and_release  # also used by ``with response:``
+
+
+class RateLimitedSession:
+    """requests-compatible ``get`` with per-host adaptive rate limiting and retries.
+
+    Throttled (429/503) and transient (5xx, connection error) responses are
+    retried with jittered exponential backoff, waiting at least as long as the
+    server's Retry-After. The last response is returned when the retries are
+    exhausted, so callers keep their own status handling. Only 2xx and 3xx
+    responses count as successes for the adaptive limits.
+
+    A ``stream=True`` response keeps its host's concurrency slot until it is
+    closed, so the concurrency limit covers the download of the body; callers
+    must close it (``with session.get(...) as response``).
+    """
+
+    def __init__(self, session=None, rate=5.0, burst=10, max_rate=50.0, initial_concurrency=4,
+                 max_concurrency=32, max_retries=6, base_delay=1.0, max_delay=120.0):
+        self.session = session or requests.Session()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._limiter_args = (rate, burst, max_rate, initial_concurrency, max_concurrency)
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = HostLimiter(*self._limiter_args)
+            return self._hosts[host]
+
+    def backoff(self, attempt, retry_after=None):
+        """Full-jitter exponential backoff, never shorter than Retry-After."""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+
+    def get(self, url, **kwargs):
+        limiter = self.limiter(url)
+        for attempt in range(self.max_retries + 1):
+            limiter.acquire()
+            try:
+                response = self.session.get(url, **kwargs)
+            except requests.RequestException as e:
+                limiter.release("error")
+                if attempt == self.max_retries:
+                    limiter.record("failed")
+                    raise
+                delay = self.backoff(attempt)
+                logging.warning(f"Request to {url} failed ({e}), retrying in {delay:.1f}s")
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    outcome = "succeeded" if response.status_code < 400 else "error"
+                    if kwargs.get("stream"):
+                        release_on_close(response, limiter, outcome)
+                    else:
+                        limiter.release(outcome)
+                        limiter.record("bytes", len(response.content))
+                    return response
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                throttled = response.status_code in THROTTLE_STATUSES
+                limiter.release("throttled" if throttled else "error", retry_after)
+                if attempt == self.max_retries:
+                    limiter.record("failed")
+                    logging.error(f"Giving up on {url} after {attempt + 1} attempts: {response.status_code}")
+                    return response
+                response.close()
+                delay = self.backoff(attempt, retry_after)
+                logging.warning(f"{response.status_code} from {url}, retrying in {delay:.1f}s")
+            limiter.record("retries")
+            time.sleep(delay)
+
+    def metrics(self):
+        """Per-host counters: requests, throttles, retries, bytes downloaded, limits and effective request rate."""
+        with self._lock:
+            hosts = dict(self._hosts)
+        return {host: limiter.metrics() for host, limiter in hosts.items()}
+
+    def close(self):
+        self.session.close()
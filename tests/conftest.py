@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The service modules sit at the top of the repository and are imported by name,
+# like app.py does; the directory is not a package. The ingestion modules shared
+# by the Cloud Functions (rateLimiter, documentSink) are imported from source/store.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.append(os.path.join(ROOT, "source", "store"))
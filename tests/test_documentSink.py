@@ -0,0 +1,75 @@
+import pyarrow.parquet as pq
+import pytest
+
+pytest.importorskip("google.cloud.bigquery")  # imported by documentSink for its BigQuery backend
+
+from documentSink import DocumentSink, LocalParquetBackend  # noqa: E402
+
+
+class FlakyBackend(LocalParquetBackend):
+    """Local backend whose first ``failures`` writes raise."""
+
+    def __init__(self, directory, failures):
+        super().__init__(directory)
+        self.failures = failures
+
+    def write(self, table):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("load job failed")
+        super().write(table)
+
+
+def stored(directory):
+    return sorted(document_id for path in directory.glob("*.parquet")
+                  for document_id in pq.read_table(str(path)).column("document_id").to_pylist())
+
+
+@pytest.fixture
+def sink_factory():
+    sinks = []
+
+    def make(backend, **kwargs):
+        sinks.append(DocumentSink(backend, **kwargs))
+        return sinks[-1]
+
+    yield make
+    for sink in sinks:
+        sink._closed.set()  # stop the age timers without a final flush
+
+
+def test_flushes_at_max_rows_and_drops_written_ids(tmp_path, sink_factory):
+    sink = sink_factory(LocalParquetBackend(str(tmp_path)), max_rows=2)
+    sink.add("a", "titel", "onderwerp", "tekst a")
+    sink.add("a", "titel", "onderwerp", "tekst a, tweede versie")
+    assert stored(tmp_path) == []
+    sink.add("b", "titel", "onderwerp", "tekst b")
+    sink.add("a", "titel", "onderwerp", "tekst a, derde versie")
+
+    assert stored(tmp_path) == ["a", "b"]
+    (path,) = tmp_path.glob("*.parquet")
+    assert pq.read_table(str(path)).column("text").to_pylist()[0] == "tekst a, tweede versie"
+    assert (sink.flush(), sink.written) == (0, 2)
+
+
+def test_existing_ids_are_not_written_again(tmp_path, sink_factory):
+    first = sink_factory(LocalParquetBackend(str(tmp_path)))
+    first.add("a", "titel", "onderwerp", "tekst")
+    first.flush()
+
+    second = sink_factory(LocalParquetBackend(str(tmp_path)))
+    second.add("a", "titel", "onderwerp", "tekst")
+    second.add("b", "titel", "onderwerp", "tekst")
+    assert second.flush() == 1
+    assert stored(tmp_path) == ["a", "b"]
+
+
+def test_failed_load_keeps_the_buffer(tmp_path, sink_factory):
+    sink = sink_factory(FlakyBackend(str(tmp_path), failures=1), max_rows=2)
+    sink.add("a", "titel", "onderwerp", "tekst")
+    with pytest.raises(OSError):
+        sink.add("b", "titel", "onderwerp", "tekst")
+
+    assert stored(tmp_path) == []
+    assert sink.flush() == 2
+    assert stored(tmp_path) == ["a", "b"]
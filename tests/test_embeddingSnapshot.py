@@ -0,0 +1,108 @@
+import struct
+
+import numpy as np
+import pytest
+
+from embeddingSnapshot import (HEADER_FORMAT, HEADER_SIZE, MAGIC, Snapshot, SnapshotError, SnapshotWriter,
+                               decode_source_hash, encode_source_hash)
+
+
+def write_snapshot(path, dtype="float32", rows=5, dimension=8):
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((rows, dimension)).astype(np.float32)
+    writer = SnapshotWriter(str(path), dimension, dtype=dtype)
+    writer.add_batch([f"doc-{i}" for i in range(rows)], [f"tekst {i} – één" for i in range(rows)], matrix)
+    writer.meta["metric"] = "cosine"
+    writer.add_section("extra", np.arange(rows, dtype=np.int32))
+    writer.close()
+    return matrix
+
+
+@pytest.mark.parametrize("dtype, tolerance", [("float32", 0), ("float16", 1e-2), ("int8", 2e-2)])
+def test_round_trip(tmp_path, dtype, tolerance):
+    path = tmp_path / "index.snapshot"
+    matrix = write_snapshot(path, dtype)
+
+    snapshot = Snapshot(str(path))
+    assert (len(snapshot), snapshot.dimension, snapshot.dtype) == (5, 8, dtype)
+    assert list(snapshot.document_ids) == [f"doc-{i}" for i in range(5)]
+    assert snapshot.texts[3] == "tekst 3 – één"
+    assert snapshot.meta == {"metric": "cosine"}
+    np.testing.assert_array_equal(snapshot.section("extra"), np.arange(5))
+    np.testing.assert_allclose(snapshot.float32_matrix(), matrix, atol=tolerance)
+    assert not path.with_name("index.snapshot.tmp").exists()
+
+
+def test_sections_are_aligned_views(tmp_path):
+    path = tmp_path / "index.snapshot"
+    write_snapshot(path)
+
+    snapshot = Snapshot(str(path))
+    for name in snapshot.section_names():
+        assert snapshot._sections[name]["offset"] % 64 == 0
+    assert np.shares_memory(snapshot.embeddings, snapshot._raw)
+
+
+def test_header(tmp_path):
+    path = tmp_path / "index.snapshot"
+    write_snapshot(path, "float16")
+
+    magic, version, dtype_code, dimension, rows, _, _, crc = struct.unpack_from(
+        HEADER_FORMAT, path.read_bytes()[:HEADER_SIZE])
+    assert (magic, version, dtype_code, dimension, rows) == (MAGIC, 1, 1, 8, 5)
+    assert crc == Snapshot(str(path)).checksum()
+
+
+def test_corrupt_byte_fails_the_checksum(tmp_path):
+    path = tmp_path / "index.snapshot"
+    write_snapshot(path)
+    data = bytearray(path.read_bytes())
+    data[HEADER_SIZE + 10] ^= 0xFF
+    path.write_bytes(bytes(data))
+
+    with pytest.raises(SnapshotError, match="Checksum mismatch"):
+        Snapshot(str(path))
+    assert len(Snapshot(str(path), verify=False)) == 5
+
+
+def test_truncated_file_fails_the_checksum(tmp_path):
+    path = tmp_path / "index.snapshot"
+    write_snapshot(path)
+    path.write_bytes(path.read_bytes()[:-20])
+
+    with pytest.raises(SnapshotError, match="Checksum mismatch"):
+        Snapshot(str(path))
+
+
+@pytest.mark.parametrize("header, message", [
+    (struct.pack(HEADER_FORMAT, b"NOTSNAP\x00", 1, 0, 8, 5, 0, 0, 0), "not an embedding snapshot"),
+    (struct.pack(HEADER_FORMAT, MAGIC, 99, 0, 8, 5, 0, 0, 0), "snapshot version 99"),
+])
+def test_unknown_header(tmp_path, header, message):
+    path = tmp_path / "index.snapshot"
+    write_snapshot(path)
+    path.write_bytes(header.ljust(HEADER_SIZE, b"\x00") + path.read_bytes()[HEADER_SIZE:])
+
+    with pytest.raises(SnapshotError, match=message):
+        Snapshot(str(path))
+
+
+def test_missing_or_short_file(tmp_path):
+    with pytest.raises(SnapshotError):
+        Snapshot(str(tmp_path / "missing.snapshot"))
+    (tmp_path / "short.snapshot").write_bytes(b"QRSNAP")
+    with pytest.raises(SnapshotError, match="too small"):
+        Snapshot(str(tmp_path / "short.snapshot"))
+
+
+def test_writer_rejects_wrong_dimension(tmp_path):
+    writer = SnapshotWriter(str(tmp_path / "index.snapshot"), 8)
+    with pytest.raises(ValueError, match="dimension 8"):
+        writer.add_batch(["a"], ["tekst"], np.zeros((1, 4)))
+    writer.close()
+
+
+def test_source_hash_encoding():
+    digest = "ab" * 32
+    assert decode_source_hash(encode_source_hash(digest)) == digest
+    assert decode_source_hash(encode_source_hash(None)) is None
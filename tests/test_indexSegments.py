@@ -0,0 +1,153 @@
+import numpy as np
+import pytest
+
+import indexSegments
+from indexSegments import DocumentRows, SegmentedIndex
+from sharedSnapshots import SharedSnapshots
+from vectorIndex import VectorIndex
+
+DIMENSION = 8
+
+
+def vectors(seed, rows):
+    return np.random.default_rng(seed).standard_normal((rows, DIMENSION)).astype(np.float32)
+
+
+def exact_search(index):
+    return lambda query, top_n, mask: index.top_matches(query, top_n, mask=mask)
+
+
+@pytest.fixture
+def base(tmp_path):
+    # Ten documents of two passages each.
+    document_ids = [f"doc-{i}" for i in range(10) for _ in range(2)]
+    texts = [f"{document_id} passage {row % 2}" for row, document_id in enumerate(document_ids)]
+    path = str(tmp_path / "index.snapshot")
+    VectorIndex(vectors(0, 20), document_ids, texts).save(path)
+    return VectorIndex.load(path)
+
+
+@pytest.fixture
+def index(base, tmp_path, monkeypatch):
+    index = SegmentedIndex(base, exact_search, SharedSnapshots(str(tmp_path / "shared")), compact_rows=1000)
+    started = []
+    monkeypatch.setattr(index, "compact_in_background", lambda: started.append(index.view))
+    index.started = started  # the tests compact in the foreground
+    return index
+
+
+def document(document_id, seed, passages=2):
+    return DocumentRows(document_id, f"{seed:064x}", [f"{document_id} v{seed} passage {i}" for i in range(passages)],
+                        vectors(seed, passages), None)
+
+
+def search_all(index, query):
+    return index.top_matches(query, 100)
+
+
+def test_upsert_replaces_the_base_rows(index, base):
+    old_query = np.asarray(base.matrix[6])  # doc-3 passage 0
+    new = document("doc-3", 42)
+
+    view = index.apply(upserts=[new])
+
+    texts = [match["text"] for match in search_all(index, old_query)]
+    assert "doc-3 passage 0" not in texts and "doc-3 passage 1" not in texts
+    assert texts.count("doc-3 v42 passage 0") == 1
+    assert index.top_matches(new.matrix[1], 1)[0]["text"] == "doc-3 v42 passage 1"
+    assert (view.deleted_rows, len(view.segment), view.version) == (2, 2, 1)
+
+
+def test_delete_removes_base_and_segment_rows(index):
+    index.apply(upserts=[document("doc-new", 7)])
+    index.apply(deletes=["doc-1", "doc-new"])
+
+    document_ids = {match["document_id"] for match in search_all(index, vectors(1, 1)[0])}
+    assert "doc-1" not in document_ids and "doc-new" not in document_ids
+    assert len(document_ids) == 9
+    assert "doc-1" not in index.source_hashes()
+
+
+def test_queries_keep_the_view_they_started_with(index):
+    before = index.view
+    index.apply(deletes=["doc-0"])
+
+    assert before.live is None and len(before.segment) == 0
+    assert any(match["document_id"] == "doc-0" for match in before.top_matches(vectors(2, 1)[0], 100))
+
+
+def test_dimension_mismatch_is_rejected(index):
+    with pytest.raises(ValueError, match="dimension"):
+        index.apply(upserts=[DocumentRows("doc-x", None, ["tekst"], np.zeros((1, 4)), None)])
+    assert index.view.version == 0
+
+
+def test_compaction_writes_live_rows_and_segment(index):
+    query = vectors(3, 1)[0]
+    index.apply(upserts=[document("doc-2", 11), document("doc-new", 12, passages=3)], deletes=["doc-5"])
+    expected = [(match["text"], round(match["distance"], 4)) for match in search_all(index, query)]
+    hashes = index.source_hashes()
+
+    assert index.compact() is True
+
+    view = index.view
+    assert (len(view.base), len(view.segment), view.live) == (20 - 4 + 5, 0, None)
+    assert [(match["text"], round(match["distance"], 4)) for match in search_all(index, query)] == expected
+    assert index.source_hashes() == hashes
+    assert index.stats()["compactions"] == 1
+
+
+def test_changes_during_compaction_are_replayed(index):
+    index.apply(upserts=[document("doc-new", 12)])
+    late = document("doc-late", 13)
+    index.prepare = lambda writer: index.apply(upserts=[late], deletes=["doc-0"])
+
+    index.compact()
+
+    view = index.view
+    assert list(view.segment.documents) == ["doc-late"]
+    assert view.deleted_rows == 2
+    assert index.top_matches(late.matrix[0], 1)[0]["text"] == "doc-late v13 passage 0"
+
+
+def test_compaction_is_triggered_by_segment_size(index):
+    index.compact_rows = 4
+
+    index.apply(upserts=[document("doc-new", 12)])
+    assert not index.started
+    view = index.apply(upserts=[document("doc-other", 13)])
+    assert index.started == [view]
+
+
+def test_compaction_is_triggered_by_deleted_rows(index):
+    index.apply(deletes=["doc-0"])
+    assert not index.started
+    view = index.apply(deletes=["doc-1"])
+    assert index.started == [view]
+
+
+def test_failed_compaction_backs_off(index):
+    def fail(name, write):
+        raise OSError("disk full")
+
+    publish = index.snapshots.publish
+    index.snapshots.publish = fail
+    index.compact_rows = 2
+
+    with pytest.raises(OSError):
+        index.compact()
+    for seed in range(5):
+        index.apply(upserts=[document(f"doc-new-{seed}", seed)])
+    assert not index.started
+    assert index.stats()["compaction_failures"] == 1
+    assert index._retry_at - indexSegments.time.monotonic() > indexSegments.COMPACT_RETRY_SECONDS - 5
+
+    with pytest.raises(OSError):
+        index.compact()
+    assert index.compaction_failures == 2
+    assert index._retry_at - indexSegments.time.monotonic() > 2 * indexSegments.COMPACT_RETRY_SECONDS - 5
+
+    index.snapshots.publish = publish
+    index._retry_at = 0.0
+    assert index.compact() is True
+    assert (index.compaction_failures, index._retry_at) == (0, 0.0)
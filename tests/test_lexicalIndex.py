@@ -0,0 +1,111 @@
+import math
+import types
+
+import numpy as np
+import pytest
+
+from lexicalIndex import LexicalIndex, decode_varints, encode_varints, reciprocal_rank_fusion, tokenize
+
+PASSAGES = [
+    ("doc-1", "De motie over stikstof en de landbouw wordt aangenomen."),
+    ("doc-1", "Stikstof, stikstof en nog eens stikstof: de financiële gevolgen voor boeren."),
+    ("doc-2", "Het amendement 36.410 van GL-PvdA over huurwoningen."),
+    ("doc-3", "Kamervragen over de woningbouw en huurwoningen in Groningen."),
+    ("doc-4", "Een lange tekst over defensie, begroting, pensioen, onderwijs en zorg in het algemeen."),
+]
+
+
+@pytest.fixture
+def index():
+    index = LexicalIndex()
+    for document_id, text in PASSAGES:
+        index.add(document_id, text)
+    return index
+
+
+def bm25(index, query, row):
+    """Reference BM25 score of one row, straight from the formula."""
+    documents = [tokenize(text) for _, text in PASSAGES]
+    average = sum(map(len, documents)) / len(documents)
+    score = 0.0
+    for term in set(tokenize(query)):
+        count = sum(term in terms for terms in documents)
+        if not count:
+            continue
+        idf = math.log1p((len(documents) - count + 0.5) / (count + 0.5))
+        tf = documents[row].count(term)
+        score += idf * tf * (index.k1 + 1) / (tf + index.k1 * (1 - index.b + index.b * len(documents[row]) / average))
+    return score
+
+
+def test_tokenize():
+    assert tokenize("De Financiële moties") == ["financiel", "moti"]
+    assert tokenize("amendement 36.410") == ["amendement", "36410", "36", "410"]
+    assert "gl-pvda" in tokenize("GL-PvdA")
+
+
+@pytest.mark.parametrize("values", [[], [0], [1, 127, 128, 300, 2 ** 35]])
+def test_varints_round_trip(values):
+    buffer = bytearray()
+    encode_varints(values, buffer)
+    assert decode_varints(bytes(buffer)).tolist() == values
+
+
+@pytest.mark.parametrize("query", ["stikstof", "huurwoningen groningen", "financiële landbouw stikstof"])
+def test_scores_match_bm25(index, query):
+    rows, scores = index.search(query, 10)
+    expected = {row: bm25(index, query, row) for row in range(len(PASSAGES))}
+    assert sorted(rows.tolist(), key=lambda row: -expected[row]) == rows.tolist()
+    for row, score in zip(rows, scores):
+        assert score == pytest.approx(expected[row], rel=1e-5)
+    assert set(rows.tolist()) == {row for row, score in expected.items() if score > 0}
+
+
+def test_top_matches(index):
+    assert [match["document_id"] for match in index.top_matches("36.410", 5)] == ["doc-2"]
+    assert index.top_matches("de het een", 5) == []
+    assert [match["text"] for match in index.top_matches("stikstof", 1)] == [PASSAGES[1][1]]
+
+
+def test_remove_hides_a_document_and_changes_the_version(index):
+    version = index.version
+    index.remove("doc-1")
+
+    assert index.top_matches("stikstof", 5) == []
+    assert len(index) == 3
+    assert index.version != version
+    assert "doc-1" not in index.indexed_documents()
+
+
+def test_row_mask(index):
+    mask = np.array([False, True, True])
+    assert index.search("stikstof huurwoningen", 10, mask)[0].tolist() == [1, 2]
+    assert index.search("groningen", 10, mask)[0].tolist() == []
+
+
+def test_base_rows_are_read_from_the_base():
+    base = types.SimpleNamespace(document_ids=[document_id for document_id, _ in PASSAGES[:3]],
+                                 texts=[text for _, text in PASSAGES[:3]])
+    index = LexicalIndex(base=base)
+    index.add_base(iter(["hash-1", "hash-1", "hash-2"]))
+    row = index.add("doc-5", "Nieuwe motie over stikstof.", "hash-5")
+
+    assert (index.base_rows, row, index.document_ids, len(index)) == (3, 3, ["doc-5"], 4)
+    assert index.texts == ["Nieuwe motie over stikstof."]
+    assert index.source_hashes == {"doc-1": "hash-1", "doc-2": "hash-2", "doc-5": "hash-5"}
+    assert {match["document_id"] for match in index.top_matches("stikstof", 5)} == {"doc-1", "doc-5"}
+    assert index.top_matches("36.410", 1)[0]["text"] == PASSAGES[2][1]
+    with pytest.raises(ValueError):
+        index.add_base()
+
+
+def test_reciprocal_rank_fusion():
+    vector = [{"document_id": "a", "text": "x", "distance": 0.1}, {"document_id": "b", "text": "y", "distance": 0.2}]
+    lexical = [{"document_id": "b", "text": "y", "score": 3.0}, {"document_id": "c", "text": "z", "score": 1.0}]
+
+    fused = reciprocal_rank_fusion([vector, lexical], top_n=3, k=60)
+
+    assert [match["document_id"] for match in fused] == ["b", "a", "c"]
+    assert fused[0]["rrf_score"] == pytest.approx(1 / 62 + 1 / 61)
+    assert fused[0]["distance"] == 0.2 and "score" not in fused[0]
+    assert reciprocal_rank_fusion([vector, lexical], top_n=1) == fused[:1]
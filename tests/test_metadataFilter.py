@@ -0,0 +1,93 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from embeddingSnapshot import Snapshot, SnapshotWriter
+from exactSearch import ExactSearch
+from metadataFilter import EPOCH, MetadataColumns, parse_filters
+from vectorIndex import VectorIndex
+
+RECORDS = [
+    {"soort": "Motie", "datum": "2023-03-01", "fracties": ["VVD", "SP"]},
+    {"soort": "Amendement", "datum": "2023-06-15T10:00:00", "fracties": ["SP"]},
+    {"soort": "Motie", "datum": None, "fracties": []},
+    {"soort": None, "datum": "2024-01-01", "fracties": ["GL-PvdA"]},
+]
+
+
+def day(value):
+    return (datetime.date.fromisoformat(value) - EPOCH).days
+
+
+@pytest.mark.parametrize("data", [None, {}, {"soort": ""}, {"fractie": []}])
+def test_no_filters(data):
+    assert parse_filters(data) is None
+
+
+def test_parse_filters():
+    filters = parse_filters({"soort": "Motie", "fractie": ["VVD", "SP"], "datum_van": "2023-01-01",
+                             "datum_tot": "2023-12-31T23:59:59"})
+    assert filters == {"soort": ["Motie"], "fractie": ["VVD", "SP"],
+                       "datum_van": day("2023-01-01"), "datum_tot": day("2023-12-31")}
+
+
+@pytest.mark.parametrize("data, message", [
+    ("Motie", "filters must be an object"),
+    (["soort"], "filters must be an object"),
+    ({"partij": "VVD"}, "Unknown filter fields"),
+    ({"soort": 5}, "soort must be a string or a list of strings"),
+    ({"fractie": {"VVD": True}}, "fractie must be a string or a list of strings"),
+    ({"fractie": ["VVD", 3]}, "fractie must be a string or a list of strings"),
+    ({"datum_van": "gisteren"}, "datum_van must be an ISO date"),
+    ({"datum_tot": "2023-13-01"}, "datum_tot must be an ISO date"),
+])
+def test_invalid_filters(data, message):
+    with pytest.raises(ValueError, match=message):
+        parse_filters(data)
+
+
+@pytest.mark.parametrize("filters, expected", [
+    ({"soort": ["motie"]}, [True, False, True, False]),
+    ({"soort": ["Wetsvoorstel"]}, [False, False, False, False]),
+    ({"fractie": ["SP"]}, [True, True, False, False]),
+    ({"fractie": ["VVD", "GL-PvdA"]}, [True, False, False, True]),
+    ({"fractie": ["PVV"]}, [False, False, False, False]),
+    ({"datum_van": day("2023-06-01")}, [False, True, False, True]),
+    ({"datum_tot": day("2023-06-15")}, [True, True, False, False]),
+    ({"soort": ["Motie"], "fractie": ["SP"]}, [True, False, False, False]),
+])
+def test_mask(filters, expected):
+    assert MetadataColumns.from_records(RECORDS).mask(filters).tolist() == expected
+
+
+def test_columns_round_trip_through_a_snapshot(tmp_path):
+    path = str(tmp_path / "index.snapshot")
+    writer = SnapshotWriter(path, 2)
+    writer.add_batch(["a", "b", "c", "d"], ["", "", "", ""], np.zeros((4, 2)))
+    MetadataColumns.from_records(RECORDS).add_sections(writer)
+    writer.close()
+
+    columns = MetadataColumns.from_snapshot(Snapshot(path))
+    assert columns.mask({"fractie": ["SP"], "datum_van": day("2023-01-01")}).tolist() == [True, True, False, False]
+    assert columns.to_records([3, 0]) == [
+        {"soort": "", "datum": "2024-01-01", "fracties": ["GL-PvdA"]},
+        {"soort": "Motie", "datum": "2023-03-01", "fracties": ["VVD", "SP"]},
+    ]
+
+
+@pytest.mark.parametrize("selected", [3, 400, 1500])
+def test_filtered_search_only_returns_selected_rows(selected):
+    rng = np.random.default_rng(1)
+    matrix = rng.standard_normal((2000, 16)).astype(np.float32)
+    ids = [str(row) for row in range(2000)]
+    mask = np.zeros(2000, dtype=bool)
+    mask[rng.choice(2000, selected, replace=False)] = True
+    query = rng.standard_normal(16).astype(np.float32)
+    expected = np.flatnonzero(mask)[np.argsort(((matrix[mask] - query) ** 2).sum(axis=1))[:10]]
+
+    ivf = VectorIndex(matrix, ids, ids, n_lists=40, min_rows_for_ivf=1000)
+    exact = ExactSearch(matrix, ids, ids)
+    for matches in (ivf.top_matches(query, 10, nprobe=40, mask=mask), exact.top_matches([query], 10, mask)[0]):
+        assert [int(match["document_id"]) for match in matches] == expected.tolist()
+    assert all(mask[int(match["document_id"])] for match in ivf.top_matches(query, 10, nprobe=1, mask=mask))
@@ -0,0 +1,131 @@
+import email.utils
+import threading
+import time
+
+import pytest
+import requests
+
+from rateLimiter import HostLimiter, RateLimitedSession, parse_retry_after
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, content=b"pdf"):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = content
+        self.closed = 0
+
+    def close(self):
+        self.closed += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FakeSession:
+    """Returns (or raises) the given outcomes in order."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def get(self, url, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def limited(*outcomes, **kwargs):
+    return RateLimitedSession(FakeSession(*outcomes), rate=10.0, burst=100, base_delay=0.0, **kwargs)
+
+
+URL = "https://opendata.invalid/Document/1/resource"
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("7") == 7.0
+    assert parse_retry_after("-3") == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    in_a_minute = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < parse_retry_after(in_a_minute) <= 60
+
+
+def test_success_raises_the_rate():
+    session = limited(FakeResponse(200))
+
+    assert session.get(URL).status_code == 200
+    metrics = session.metrics()["opendata.invalid"]
+    assert (metrics["requests"], metrics["succeeded"], metrics["bytes"]) == (1, 1, 3)
+    assert metrics["rate_limit"] == 10.1
+    assert session.limiter(URL).in_flight == 0
+
+
+def test_throttle_is_retried_and_backs_off():
+    session = limited(FakeResponse(429, {"Retry-After": "0"}), FakeResponse(503), FakeResponse(200))
+    limiter = session.limiter(URL)
+
+    assert session.get(URL).status_code == 200
+    metrics = limiter.metrics()
+    assert (metrics["requests"], metrics["throttled"], metrics["retries"], metrics["succeeded"]) == (3, 2, 2, 1)
+    assert metrics["rate_limit"] == pytest.approx(10 / 4 + 0.1)
+    assert metrics["concurrency_limit"] == 1
+
+
+def test_client_errors_are_returned_without_counting_as_successes():
+    session = limited(FakeResponse(404))
+
+    assert session.get(URL).status_code == 404
+    metrics = session.metrics()["opendata.invalid"]
+    assert (metrics["succeeded"], metrics["retries"], metrics["rate_limit"]) == (0, 0, 10.0)
+    assert session.session.calls == 1
+
+
+def test_retries_are_bounded():
+    responses = [FakeResponse(500) for _ in range(3)]
+    session = limited(*responses, max_retries=2)
+
+    assert session.get(URL) is responses[-1]
+    assert session.metrics()["opendata.invalid"]["failed"] == 1
+    assert [response.closed for response in responses] == [1, 1, 0]
+
+
+def test_connection_errors_are_retried_then_raised():
+    session = limited(requests.ConnectionError("reset"), FakeResponse(200))
+    assert session.get(URL).status_code == 200
+
+    session = limited(*[requests.ConnectionError("reset")] * 2, max_retries=1)
+    with pytest.raises(requests.ConnectionError):
+        session.get(URL)
+    assert session.metrics()["opendata.invalid"]["failed"] == 1
+    assert session.limiter(URL).in_flight == 0
+
+
+def test_streamed_response_holds_its_slot_until_closed():
+    session = limited(FakeResponse(200))
+    limiter = session.limiter(URL)
+
+    with session.get(URL, stream=True) as response:
+        assert limiter.in_flight == 1
+        assert limiter.metrics()["succeeded"] == 0
+    assert limiter.in_flight == 0
+    response.close()
+    assert (limiter.in_flight, limiter.metrics()["succeeded"], response.closed) == (0, 1, 2)
+
+
+def test_concurrency_limit_blocks_until_release():
+    limiter = HostLimiter(rate=100.0, burst=100, max_rate=100.0, initial_concurrency=1, max_concurrency=1)
+    limiter.acquire()
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+    thread.start()
+
+    assert not acquired.wait(0.1)
+    limiter.release("succeeded")
+    assert acquired.wait(1.0)
+    thread.join()
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from exactSearch import ExactSearch, batch_top_k, recall_at_k
+from vectorIndex import VectorIndex
+
+
+def clustered(rows, dimension=32, clusters=50, seed=0):
+    """Rows around random centres, like embeddings of related passages."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    matrix = centres[rng.integers(clusters, size=rows)] + 0.3 * rng.standard_normal((rows, dimension))
+    return matrix.astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    matrix = clustered(20_000)
+    ids = [f"doc-{row}" for row in range(len(matrix))]
+    queries = clustered(50, seed=1)
+    return matrix, ids, queries
+
+
+def test_batch_top_k():
+    distances = np.array([[5.0, 1.0, 3.0, 2.0], [0.0, 9.0, 8.0, 7.0]])
+    assert batch_top_k(distances, 2).tolist() == [[1, 3], [0, 3]]
+    assert batch_top_k(distances, 10).tolist() == [[1, 3, 2, 0], [0, 3, 2, 1]]
+
+
+def normalise(matrix):
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("metric", ["l2", "cosine", "dot"])
+def test_exact_search_matches_brute_force(corpus, metric):
+    matrix, ids, queries = corpus
+    matrix = matrix[:2000]
+    exact = ExactSearch(matrix, ids, ids, metric=metric)
+
+    rows, distances = exact.search(queries, 10)
+
+    if metric == "l2":
+        expected = np.linalg.norm(matrix[None, :, :] - queries[:, None, :], axis=2)
+    elif metric == "cosine":
+        expected = 1.0 - normalise(queries) @ normalise(matrix).T
+    else:
+        expected = -(queries @ matrix.T)
+    assert rows.tolist() == np.argsort(expected, axis=1, kind="stable")[:, :10].tolist()
+    np.testing.assert_allclose(distances, np.take_along_axis(expected, rows, axis=1), rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("metric", ["l2", "cosine"])
+def test_ivf_recall(corpus, metric):
+    matrix, ids, queries = corpus
+    index = VectorIndex(matrix, ids, ids, metric=metric, nprobe=8)
+    exact = ExactSearch.from_index(index)
+
+    assert len(index.centroids) == int(np.sqrt(len(matrix)))
+    approximate = [index.search(query, 10)[0] for query in queries]
+    assert recall_at_k(approximate, exact.search(queries, 10)[0]) >= 0.9
+    everything = [index.search(query, 10, nprobe=len(index.centroids))[0] for query in queries]
+    assert recall_at_k(everything, exact.search(queries, 10)[0]) == 1.0
+
+
+def test_small_corpus_is_searched_exactly(corpus):
+    matrix, ids, queries = corpus
+    index = VectorIndex(matrix[:500], ids[:500], ids[:500])
+
+    assert index.centroids is None
+    exact = ExactSearch(matrix[:500], ids[:500], ids[:500])
+    assert index.top_matches(queries[0], 5) == exact.top_matches([queries[0]], 5)[0]
+
+
+def test_snapshot_round_trip_keeps_the_ivf_lists(corpus, tmp_path):
+    matrix, ids, queries = corpus
+    index = VectorIndex(matrix, ids, ids, metric="cosine")
+    path = str(tmp_path / "index.snapshot")
+    index.save(path)
+
+    loaded = VectorIndex.load(path)
+    assert (loaded.metric, loaded.nprobe) == ("cosine", index.nprobe)
+    np.testing.assert_array_equal(loaded.list_ids, index.list_ids)
+    for query in queries[:5]:
+        assert loaded.top_matches(query, 10) == index.top_matches(query, 10)
+    with pytest.raises(ValueError, match="cosine snapshot"):
+        VectorIndex.load(path, metric="l2")
+
+
+def test_query_dimension_is_checked(corpus):
+    matrix, ids, _ = corpus
+    with pytest.raises(ValueError, match="index expects"):
+        VectorIndex(matrix[:10], ids[:10], ids[:10]).search(np.zeros(4), 1)
@@ -0,0 +1,282 @@
+import numpy as np
+
+from embeddingSnapshot import Snapshot, SnapshotWriter, export_from_bigquery, normalize_rows
+from exactSearch import METRICS, compute_distances, l2_distances_float64, mask_distances, selected_rows, top_k
+
+DEFAULT_NPROBE = 8
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_SIZE = 50_000
+MIN_ROWS_FOR_IVF = 10_000
+# Filtered searches selecting at most this many rows skip the IVF lists and score them all exactly.
+FILTERED_EXACT_ROWS = 20_000
+SAVE_BATCH_ROWS = 65_536
+
+
+def _as_matrix(vectors):
+    """Return the vectors as a contiguous float32 matrix."""
+    return np.ascontiguousarray(np.asarray(vectors, dtype=np.float32))
+
+
+def kmeans(matrix, n_clusters, iterations=KMEANS_ITERATIONS, seed=0):
+    """Plain Lloyd's k-means on (a sample of) the matrix, returns centroids."""
+    rng = np.random.default_rng(seed)
+    if len(matrix) > KMEANS_SAMPLE_SIZE:
+        sample = matrix[rng.choice(len(matrix), KMEANS_SAMPLE_SIZE, replace=False)]
+    else:
+        sample = matrix
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign_clusters(sample, centroids)
+        for cluster in range(n_clusters):
+            members = sample[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+            else:
+                # Re-seed empty clusters so every list stays usable.
+                centroids[cluster] = sample[rng.integers(len(sample))]
+    return centroids
+
+
+def assign_clusters(matrix, centroids, chunk_size=65_536):
+    """Nearest centroid (squared L2) for every row, computed in chunks."""
+    centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+    assignments = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), chunk_size):
+        block = matrix[start:start + chunk_size]
+        scores = centroid_norms[None, :] - 2.0 * (block @ centroids.T)
+        assignments[start:start + chunk_size] = np.argmin(scores, axis=1)
+    return assignments
+
+
+class VectorIndex:
+    """In-process IVF (inverted file) index over a float32 embedding matrix.
+
+    The rows are clustered with k-means; at query time only the ``nprobe``
+    closest clusters are scanned exactly. Small corpora (fewer rows than
+    ``min_rows_for_ivf``) are searched brute force.
+    """
+
+    def __init__(self, embeddings, document_ids, texts, metric="l2",
+                 n_lists=None, nprobe=DEFAULT_NPROBE, min_rows_for_ivf=MIN_ROWS_FOR_IVF):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric} (expected one of {METRICS})")
+        matrix = _as_matrix(embeddings)
+        if matrix.ndim != 2 or len(matrix) != len(document_ids) or len(matrix) != len(texts):
+            raise ValueError("embeddings, document_ids and texts must have the same length")
+
+        self.metric = metric
+        self.nprobe = nprobe
+        self.document_ids = document_ids
+        self.texts = texts
+        self.matrix = _as_matrix(normalize_rows(matrix)) if metric == "cosine" else matrix
+        self.norms = np.einsum("ij,ij->i", self.matrix, self.matrix) if metric == "l2" else None
+
+        self.centroids = None
+        self.list_offsets = None
+        self.list_ids = None
+        if len(matrix) >= min_rows_for_ivf:
+            self._build_ivf(n_lists or max(1, int(np.sqrt(len(matrix)))))
+
+    def __len__(self):
+        return len(self.matrix)
+
+    @property
+    def dimension(self):
+        return self.matrix.shape[1]
+
+    def _build_ivf(self, n_lists):
+        """Cluster the matrix and store the inverted lists in CSR layout."""
+        self.centroids = kmeans(self.matrix, n_lists)
+        assignments = assign_clusters(self.matrix, self.centroids)
+        # One permutation array plus offsets keeps every list contiguous.
+        self.list_ids = np.argsort(assignments, kind="stable").astype(np.int64)
+        counts = np.bincount(assignments, minlength=n_lists)
+        self.list_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+    def candidate_rows(self, query, nprobe=None, mask=None, min_rows=0):
+        """Row ids stored in the nprobe clusters closest to the query (all rows without IVF).
+
+        With a boolean ``mask`` only selected rows are returned. A selective
+        mask returns all selected rows (an exact scan of few rows); otherwise
+        clusters are probed in order of distance until at least ``min_rows``
+        selected rows were found, so filters never starve the result.
+        """
+        nprobe = nprobe or self.nprobe
+        if mask is not None:
+            if self.centroids is None or np.count_nonzero(mask) <= max(FILTERED_EXACT_ROWS, min_rows):
+                return np.flatnonzero(mask)
+        elif self.centroids is None:
+            return np.arange(len(self))
+        centroid_distances = compute_distances(self.centroids, query, "l2")
+        if mask is None:
+            probes = top_k(centroid_distances, nprobe)
+            return np.concatenate([
+                self.list_ids[self.list_offsets[p]:self.list_offsets[p + 1]] for p in probes
+            ])
+        lists, found = [], 0
+        for probed, p in enumerate(np.argsort(centroid_distances, kind="stable"), start=1):
+            rows = self.list_ids[self.list_offsets[p]:self.list_offsets[p + 1]]
+            rows = rows[mask[rows]]
+            lists.append(rows)
+            found += len(rows)
+            if probed >= nprobe and found >= min_rows:
+                break
+        return np.concatenate(lists)
+
+    def search(self, query_embedding, top_n, nprobe=None, mask=None):
+        """Return (row ids, distances) of the top_n nearest rows (only rows selected by ``mask``)."""
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if query.shape != (self.dimension,):
+            raise ValueError(f"Query has shape {query.shape}, index expects ({self.dimension},)")
+
+        if self.centroids is None:
+            candidates = selected_rows(mask) if mask is not None else None
+        else:
+            candidates = self.candidate_rows(query, nprobe, mask, min_rows=top_n)
+        if candidates is None:
+            # Every row is scored in place; rows outside a broad mask get an infinite distance.
+            candidates = np.arange(len(self))
+            distances = compute_distances(self.matrix, query, self.metric, self.norms)
+            if mask is not None:
+                mask_distances(distances, mask)
+                top_n = min(top_n, int(np.count_nonzero(mask)))
+        else:
+            norms = self.norms[candidates] if self.norms is not None else None
+            distances = compute_distances(self.matrix[candidates], query, self.metric, norms)
+        best = top_k(distances, top_n)
+        rows, distances = candidates[best], distances[best]
+        if self.metric == "l2":
+            # Report the same float64 Euclidean distances as the BigQuery query.
+            distances = l2_distances_float64(self.matrix, rows, query)
+            order = np.argsort(distances, kind="stable")
+            rows, distances = rows[order], distances[order]
+        return rows, distances
+
+    def top_matches(self, query_embedding, top_n, nprobe=None, mask=None):
+        """Search and return rows as dicts with document_id, text and distance."""
+        rows, distances = self.search(query_embedding, top_n, nprobe, mask)
+        return [
+            {
+                "document_id": self.document_ids[row],
+                "text": self.texts[row],
+                "distance": float(distance),
+            }
+            for row, distance in zip(rows, distances)
+        ]
+
+    def save(self, path, dtype="float32"):
+        """Write the index (vectors, side table and IVF lists) to a snapshot file."""
+        writer = SnapshotWriter(path, self.dimension, dtype)
+        for start in range(0, len(self), SAVE_BATCH_ROWS):
+            end = min(start + SAVE_BATCH_ROWS, len(self))
+            writer.add_batch(self.document_ids[start:end], self.texts[start:end], self.matrix[start:end])
+        writer.meta.update(metric=self.metric, nprobe=self.nprobe, normalized=self.metric == "cosine")
+        if self.norms is not None:
+            writer.add_section("norms", self.norms)
+        if self.centroids is not None:
+            writer.add_section("ivf.centroids", self.centroids)
+            writer.add_section("ivf.list_offsets", self.list_offsets)
+            writer.add_section("ivf.list_ids", self.list_ids)
+        writer.close()
+
+    @classmethod
+    def from_snapshot(cls, snapshot, metric=None, nprobe=None):
+        """Build an index on top of an open snapshot without copying float32 data.
+
+        The IVF lists are reused when the requested metric matches the stored
+        one; otherwise the lists are rebuilt for the new metric. A cosine
+        snapshot only holds normalised vectors and cannot be reloaded as l2/dot.
+        """
+        stored_metric = snapshot.meta.get("metric", "l2")
+        normalized = snapshot.meta.get("normalized", False)
+        metric = metric or stored_metric
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric} (expected one of {METRICS})")
+        if normalized and metric != "cosine":
+            raise ValueError("A cosine snapshot cannot be loaded with another metric; re-export it")
+
+        index = cls.__new__(cls)
+        index.snapshot = snapshot
+        index.metric = metric
+        index.nprobe = nprobe or snapshot.meta.get("nprobe", DEFAULT_NPROBE)
+        index.document_ids = snapshot.document_ids
+        index.texts = snapshot.texts
+        matrix = snapshot.float32_matrix()
+        index.matrix = _as_matrix(normalize_rows(matrix)) if metric == "cosine" and not normalized else matrix
+        index.norms = None
+        if metric == "l2":
+            # Stored norms only match the matrix when it was not decoded from float16/int8.
+            if snapshot.has_section("norms") and snapshot.dtype == "float32" and metric == stored_metric:
+                index.norms = snapshot.section("norms")
+            else:
+                index.norms = np.einsum("ij,ij->i", index.matrix, index.matrix)
+
+        index.centroids = index.list_offsets = index.list_ids = None
+        if snapshot.has_section("ivf.centroids"):
+            if metric == stored_metric:
+                index.centroids = snapshot.section("ivf.centroids")
+                index.list_offsets = snapshot.section("ivf.list_offsets")
+                index.list_ids = snapshot.section("ivf.list_ids")
+            else:
+                index._build_ivf(len(snapshot.section("ivf.centroids")))
+        return index
+
+    @classmethod
+    def load(cls, path, metric=None, nprobe=None, verify=True):
+        """Memory-map a snapshot written by ``save`` or ``export_index``."""
+        return cls.from_snapshot(Snapshot(path, verify=verify), metric=metric, nprobe=nprobe)
+
+
+def add_index_sections(writer, metric, nprobe, min_rows_for_ivf):
+    """Compute norms and IVF lists from the staged rows of a snapshot writer."""
+    matrix = writer.staged_matrix()
+    writer.meta.update(metric=metric, nprobe=nprobe, normalized=metric == "cosine")
+    if metric == "l2":
+        norms = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), SAVE_BATCH_ROWS):
+            block = np.asarray(matrix[start:start + SAVE_BATCH_ROWS])
+            norms[start:start + SAVE_BATCH_ROWS] = np.einsum("ij,ij->i", block, block)
+        writer.add_section("norms", norms)
+    if len(matrix) >= min_rows_for_ivf:
+        n_lists = max(1, int(np.sqrt(len(matrix))))
+        centroids = kmeans(matrix, n_lists)
+        assignments = assign_clusters(matrix, centroids)
+        counts = np.bincount(assignments, minlength=n_lists)
+        writer.add_section("ivf.centroids", centroids)
+        writer.add_section("ivf.list_offsets", np.concatenate(([0], np.cumsum(counts))).astype(np.int64))
+        writer.add_section("ivf.list_ids", np.argsort(assignments, kind="stable").astype(np.int64))
+
+
+def export_index(bq_client, table_id, path, metric="l2", dtype="float32",
+                 nprobe=DEFAULT_NPROBE, min_rows_for_ivf=MIN_ROWS_FOR_IVF, prepare=None, packed=False):
+    """Stream the BigQuery embedding table into an index snapshot at path.
+
+    ``prepare(writer)`` can add further sections (e.g. quantised codes, see
+    quantization.py) after the IVF lists.
+    """
+    def add_sections(writer):
+        add_index_sections(writer, metric, nprobe, min_rows_for_ivf)
+        if prepare is not None:
+            prepare(writer)
+
+    rows = export_from_bigquery(
+        bq_client, table_id, path, dtype=dtype, normalize=metric == "cosine", prepare=add_sections, packed=packed,
+    )
+    return rows
+
+
+if __name__ == "__main__":
+    import sys
+    from google.cloud import bigquery
+
+    from metadataFilter import export_metadata
+
+    # Usage: python vectorIndex.py <table_id> <output.snapshot> [metric] [float32|float16|int8]
+    table_id, output_path = sys.argv[1], sys.argv[2]
+    metric = sys.argv[3] if len(sys.argv) > 3 else "l2"
+    dtype = sys.argv[4] if len(sys.argv) > 4 else "float32"
+    client = bigquery.Client()
+    documents_table_id = table_id.rsplit(".", 1)[0] + ".documents"
+    exported = export_index(client, table_id, output_path, metric, dtype,
+                            prepare=lambda writer: export_metadata(client, documents_table_id, writer))
+    print(f"Exported {exported} embeddings to {output_path}")